@@ -16,6 +16,7 @@ from models.user import User
 from models.account import Account
 from models.order import Order, PaymentHistory
 from models.transaction import Transaction
+from models.usage_record import UsageRecord
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
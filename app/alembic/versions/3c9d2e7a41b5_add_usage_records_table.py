@@ -0,0 +1,55 @@
+"""add usage_records table
+
+Revision ID: 3c9d2e7a41b5
+Revises: fb01a79c62a3
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c9d2e7a41b5'
+down_revision: Union[str, None] = 'fb01a79c62a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 每个任务的 token 用量和实际收费，由 services/metering 批量写入
+    op.create_table(
+        'usage_records',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('task_id', sa.String(length=36), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=True),
+        sa.Column('source', sa.String(length=20), nullable=False),
+        sa.Column('programming_language', sa.String(length=50), nullable=True),
+        sa.Column('prompt_tokens', sa.Integer(), nullable=True),
+        sa.Column('completion_tokens', sa.Integer(), nullable=True),
+        sa.Column('image_tokens', sa.Integer(), nullable=True),
+        sa.Column('cached_tokens', sa.Integer(), nullable=True),
+        sa.Column('total_tokens', sa.Integer(), nullable=True),
+        sa.Column('image_bytes', sa.Integer(), nullable=True),
+        sa.Column('amount', sa.Numeric(precision=15, scale=2), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_usage_records_id'), 'usage_records', ['id'], unique=False)
+    op.create_index(op.f('ix_usage_records_task_id'), 'usage_records', ['task_id'], unique=False)
+    op.create_index(op.f('ix_usage_records_user_id'), 'usage_records', ['user_id'], unique=False)
+    op.create_index(op.f('ix_usage_records_created_at'), 'usage_records', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_usage_records_created_at'), table_name='usage_records')
+    op.drop_index(op.f('ix_usage_records_user_id'), table_name='usage_records')
+    op.drop_index(op.f('ix_usage_records_task_id'), table_name='usage_records')
+    op.drop_index(op.f('ix_usage_records_id'), table_name='usage_records')
+    op.drop_table('usage_records')
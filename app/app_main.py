@@ -5,6 +5,13 @@ from router import chat_rt, user_rt, account_rt, order_rt, invite_rt, sms_auth_r
 import os
 from dotenv import load_dotenv  # 需要安装 python-dotenv
 from services.redis_service import redis_service
+from services.vlm_client import vlm_client_manager
+from services.image_pipeline import image_pipeline
+from services.blob_storage import blob_storage
+from services.image_lifecycle import image_lifecycle
+from services.task_queue import task_queue, is_queue_mode
+from services.task_cancellation import task_cancellation
+from services.metering import metering
 from contextlib import asynccontextmanager
 
 # 加载环境变量
@@ -14,7 +21,34 @@ load_dotenv()
 async def lifespan(app: FastAPI):
     # 启动时连接Redis
     await redis_service.connect()
+    # 启动时创建共享的上游客户端并预热连接
+    await vlm_client_manager.start()
+    # 启动时连接图片存储后端
+    await blob_storage.start()
+    # 启动时创建图片预处理进程池
+    image_pipeline.start()
+    # 启动上传图片的过期清理
+    image_lifecycle.start()
+    # 订阅任务取消通知，客户端断开时停止本进程内的生成
+    task_cancellation.start()
+    # 启动用量记录的批量写入
+    metering.start()
+    if is_queue_mode():
+        # 队列模式下确保消费组存在
+        await task_queue.ensure_groups()
     yield
+    # 关闭时停止订阅取消通知
+    await task_cancellation.close()
+    # 关闭时写入剩余的用量记录
+    await metering.close()
+    # 关闭时停止图片清理
+    await image_lifecycle.close()
+    # 关闭时释放图片预处理进程池
+    image_pipeline.close()
+    # 关闭时断开图片存储后端
+    await blob_storage.close()
+    # 关闭时释放上游连接池
+    await vlm_client_manager.close()
     # 关闭时断开Redis连接
     await redis_service.disconnect()
 
@@ -45,10 +79,9 @@ app.include_router(
 # 挂载静态文件目录
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
-# 配置静态文件目录
+# 上传图片目录，/images/{上传ID} 由 chat_rt 通过引用映射到按内容存放的文件
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploaded_images")  # 设置默认值
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-app.mount("/images", StaticFiles(directory=UPLOAD_DIR), name="images")
 
 if __name__=='__main__':
     import uvicorn
@@ -0,0 +1,22 @@
+from sqlalchemy import Column, Integer, String, Numeric, DateTime
+from models.base import Base
+from datetime import datetime
+
+class UsageRecord(Base):
+    __tablename__ = "usage_records"
+
+    id = Column(Integer, primary_key=True, index=True)
+    task_id = Column(String(36), nullable=False, index=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    model = Column(String(100))
+    source = Column(String(20), nullable=False)  # upstream / single_flight / answer_cache
+    programming_language = Column(String(50))
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    image_tokens = Column(Integer)
+    cached_tokens = Column(Integer)
+    total_tokens = Column(Integer)
+    image_bytes = Column(Integer)  # 发送给上游的图片大小（编码前）
+    amount = Column(Numeric(15, 2), nullable=False, default=0)  # 实际收取的费用
+    status = Column(String(20), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
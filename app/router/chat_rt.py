@@ -1,64 +1,101 @@
-from fastapi import APIRouter, HTTPException, Security, UploadFile, File, Form, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
-from services.vlm import vlm
+from fastapi import APIRouter, HTTPException, Security, UploadFile, File, Form, BackgroundTasks, Request
+from fastapi.routing import APIRoute
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, PlainTextResponse
+from utils.sse import encode_event
+from services.vlm_task import start_task_in_background, load_task_image, refund_task, SERVICE_FEE
+from services.answer_cache import answer_cache, PHASH_MATCH_ENABLED
+from services.image_pipeline import image_pipeline
+from services.image_store import image_store
+from services.image_lifecycle import image_lifecycle
+from services.model_router import model_router
+from services.circuit_breaker import vlm_circuit_breaker
+from services.distributed_semaphore import vlm_semaphore
+from services.task_metrics import task_metrics
+from services.task_queue import task_queue, is_queue_mode
+from services.task_stream import task_stream, TaskStreamTimeout, END_EVENTS
+from services.task_cancellation import task_cancellation, REASON_USER
+from utils.image_hash import image_fingerprint
+from utils.image_format import sniff_image_mime, SNIFF_BYTES, SUPPORTED_FORMATS_MESSAGE, ImageSource
 from services.redis_service import redis_service
 from services.auth import access_security
-from services.accounts import update_balance, get_balance_by_user_id, pre_charge_balance, refund_balance
+from services.accounts import get_balance_by_user_id
 from fastapi_jwt import JwtAuthorizationCredentials
 from schemas.chat_schemas import ChatSubmitRequest, ChatSubmitResponse
-import base64
+import hmac
+import hashlib
 import logging
 import os
 import uuid
 import aiofiles
 from dotenv import load_dotenv  # 需要安装 python-dotenv
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Dict, Optional, Tuple
 import asyncio
 import json
 
 # 加载环境变量
 load_dotenv()
 
-router = APIRouter()
+# 上传分块大小和单个文件大小上限
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(64 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_TOO_LARGE_MESSAGE = f"图片过大，最大支持 {UPLOAD_MAX_BYTES // (1024 * 1024)}MB"
+# 请求体在图片之外允许的大小：multipart 边界、字段头和其他表单字段
+UPLOAD_FORM_OVERHEAD = 64 * 1024
 
-# 从环境变量获取服务费用
-SERVICE_FEE = float(os.getenv("SERVICE_FEE", "1.00"))  # 默认1元
+class BodySizeLimitRoute(APIRoute):
+    """在解析请求体之前限制请求大小
+
+    FastAPI 在调用接口函数之前就把 multipart 表单完整读入临时文件，接口内的检查无法提前中止超大的上传。
+    这里先按 Content-Length 直接拒绝；没有声明长度（分块传输）或声明不实时，在读取过程中累计，
+    超过上限立即中止。save_upload_stream 中的检查作为最后的保障。
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        limit = UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD
+
+        async def limited_handler(request: Request):
+            content_length = request.headers.get("content-length", "")
+            if content_length.isdigit() and int(content_length) > limit:
+                raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_MESSAGE)
+
+            received = 0
+            receive = request.receive
+
+            async def limited_receive():
+                nonlocal received
+                message = await receive()
+                if message["type"] == "http.request":
+                    received += len(message.get("body", b""))
+                    if received > limit:
+                        raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_MESSAGE)
+                return message
+
+            return await handler(Request(request.scope, limited_receive))
+
+        return limited_handler
+
+router = APIRouter(route_class=BodySizeLimitRoute)
+
+# 队列模式下等待 worker 产出事件的最长时间（秒）
+VLM_RELAY_IDLE_TIMEOUT = float(os.getenv("VLM_RELAY_IDLE_TIMEOUT", "300"))
+# inline 模式下提交时立即开始生成，事件先写入任务事件流，打开 stream 时从头补发再继续实时转发
+VLM_EAGER_START = os.getenv("VLM_EAGER_START", "false").lower() == "true"
+# Prometheus 抓取 metrics 接口时使用的令牌（Authorization: Bearer <令牌>），未设置时 metrics 接口不开放（返回404）
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
 
 @router.get("/hello")
 def hello_world():
     return {"message": "Hello, World!"}
 
-UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploaded_images") 
 @router.post("/upload_image", include_in_schema=True)  
 async def upload_image(
     image: UploadFile = File(...),
     credentials: JwtAuthorizationCredentials = Security(access_security)
 ):
     try:
-        # 检查用户余额
-        user_id = credentials.subject.get("user_id")
-        balance_info = get_balance_by_user_id(str(user_id))
-        current_balance = float(balance_info["balance"])
-        
-        if current_balance < SERVICE_FEE:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"余额不足，当前余额：{current_balance}，服务费用：{SERVICE_FEE}"
-            )
-        
-        # 确保上传目录存在
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
-        
-        # 生成唯一文件名
-        file_ext = os.path.splitext(image.filename)[1]
-        filename = f"{uuid.uuid4()}{file_ext}"
-        file_path = os.path.join(UPLOAD_DIR, filename)
-        
-        # 异步保存文件
-        content = await image.read()
-        async with aiofiles.open(file_path, mode='wb') as f:
-            await f.write(content)
-            
+        filename, _ = await store_upload(image, credentials.subject.get("user_id"))
+
         # 生成图片URL
         image_url = f"/images/{filename}"
         return JSONResponse(content={"image_url": image_url})
@@ -69,58 +106,193 @@ async def upload_image(
         logging.error(f"Upload failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
-async def process_vlm_stream(base64_image: str, user_question: str, task_id: str, user_id: str) -> AsyncGenerator[str, None]:
-    """处理VLM流式响应"""
-    try:
-        # 预扣费用
-        pre_charge_balance(
-            user_id=int(user_id),
-            amount=SERVICE_FEE,
-            task_id=task_id
+async def store_upload(image: UploadFile, user_id) -> Tuple[str, str]:
+    """检查余额、保存上传图片并生成衍生图，返回 (上传ID, MIME类型)"""
+    # 检查用户余额
+    balance_info = get_balance_by_user_id(str(user_id))
+    current_balance = float(balance_info["balance"])
+    
+    if current_balance < SERVICE_FEE:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"余额不足，当前余额：{current_balance}，服务费用：{SERVICE_FEE}"
         )
-        
-        async for chunk in vlm(base64_image, user_question):
-            yield chunk
-            # 添加小延迟避免过快输出
-            await asyncio.sleep(0.01)
-            
-        # 流式响应完成后，确认扣费
-        try:
-            new_balance = update_balance(
-                user_id=int(user_id),
-                amount=-SERVICE_FEE,  # 负数表示扣费
-                trans_type="扣费",
-                desc=f"VLM服务费用 - 任务ID: {task_id}"
-            )
-            logging.info(f"服务费用扣除成功 | 用户：{user_id} | 扣除金额：{SERVICE_FEE} | 剩余余额：{new_balance}")
-        except Exception as e:
-            logging.error(f"服务费用扣除失败：{str(e)}", exc_info=True)
-            # 这里我们不抛出异常，因为服务已经完成
-            
-        # 更新任务状态为已完成
-        await redis_service.update_task_status(task_id, "completed")
-            
+    
+    # 分块写入临时文件，同时计算内容哈希和识别图片类型，超过大小限制时提前中止
+    temp_path = image_store.new_temp_path()
+    mime_type, sha256, size = await save_upload_stream(image, temp_path)
+    filename = image_store.new_upload_id(mime_type)
+
+    try:
+        # 模糊、过暗或分辨率过低的图片直接拒绝，避免预扣费后生成无用的回答再退款
+        rejection = await image_pipeline.check_quality(filename, temp_path)
+        if rejection is not None:
+            raise HTTPException(status_code=422, detail=rejection)
+    except Exception:
+        remove_upload(temp_path)
+        raise
+
+    # 按内容哈希存放，相同图片只保存一份；本次上传只记录一条引用
+    key, deduplicated = await image_store.commit(temp_path, sha256, mime_type)
+    blob_path = await image_store.local_path(key)
+    # 图片类型和内容哈希随引用保存，后续不再重复识别和计算
+    await image_store.add_reference(
+        filename, str(user_id), key, {"mime_type": mime_type, "sha256": sha256, "size": size}
+    )
+    if deduplicated:
+        logging.info(f"图片内容已存在，复用存储 | 上传：{filename} | 内容：{key}")
+
+    if blob_path is not None:
+        # 计算近似匹配指纹，用于答案缓存的近似匹配
+        await save_image_fingerprint(filename, blob_path)
+
+        # 在进程池中生成缩小、重新压缩后的衍生图，解题时代替原图发送给上游
+        await image_pipeline.process_upload(filename, blob_path, key)
+
+    return filename, mime_type
+
+@router.get("/images/{upload_id}", include_in_schema=False)
+async def get_image(upload_id: str):
+    """按上传ID返回图片，通过引用映射到按内容存放的文件"""
+    file_path = await image_store.resolve(upload_id)
+    if file_path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(file_path, headers={"Cache-Control": "private, max-age=86400"})
+
+def remove_upload(file_path: str) -> None:
+    """删除未完成或被拒绝的上传文件"""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+async def save_upload_stream(image: UploadFile, file_path: str) -> Tuple[str, str, int]:
+    """按固定大小分块把上传内容写入磁盘，返回 (MIME类型, SHA-256, 字节数)
+
+    内存中只保留一个分块；文件头不是支持的图片格式或超过大小限制时中止并删除已写入的部分
+    """
+    # 请求体大小已由 BodySizeLimitRoute 在解析前限制，这里按文件本身的大小再检查一次
+    declared_size = getattr(image, "size", None)
+    if declared_size is not None and declared_size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_MESSAGE)
+
+    digest = hashlib.sha256()
+    header = b""
+    mime_type = None
+    size = 0
+    try:
+        async with aiofiles.open(file_path, mode='wb') as f:
+            while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_MESSAGE)
+
+                # 根据文件头识别图片类型，不支持的格式不再继续接收
+                if mime_type is None:
+                    header += chunk[:SNIFF_BYTES - len(header)]
+                    if len(header) >= SNIFF_BYTES:
+                        mime_type = sniff_image_mime(header)
+                        if not mime_type:
+                            raise HTTPException(status_code=400, detail=SUPPORTED_FORMATS_MESSAGE)
+
+                digest.update(chunk)
+                await f.write(chunk)
+
+        if mime_type is None:
+            # 文件小于文件头长度
+            mime_type = sniff_image_mime(header)
+            if not mime_type:
+                raise HTTPException(status_code=400, detail=SUPPORTED_FORMATS_MESSAGE)
+    except BaseException:
+        remove_upload(file_path)
+        raise
+
+    return mime_type, digest.hexdigest(), size
+
+async def save_image_fingerprint(filename: str, source: ImageSource) -> None:
+    """在线程池中计算近似匹配指纹并保存，近似匹配关闭时跳过；失败时不影响上传"""
+    if not PHASH_MATCH_ENABLED:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+        fingerprint = await loop.run_in_executor(None, image_fingerprint, source)
+        await answer_cache.save_image_fingerprint(filename, fingerprint)
     except Exception as e:
-        logging.error(f"Error in VLM processing: {str(e)}")
-        # 发生错误时，退还预扣的费用
-        try:
-            refund_balance(
-                user_id=int(user_id),
-                amount=SERVICE_FEE,
-                task_id=task_id
-            )
-            logging.info(f"预扣费用退还成功 | 用户：{user_id} | 退还金额：{SERVICE_FEE}")
-        except Exception as refund_error:
-            logging.error(f"预扣费用退还失败：{str(refund_error)}", exc_info=True)
-            
-        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
-        # 发生错误时，更新任务状态为失败
-        await redis_service.update_task_status(task_id, "failed", str(e))
+        logging.warning(f"感知哈希计算失败 | 文件：{filename} | 原因：{str(e)}")
+
+async def relay_task_stream(
+    task_id: str,
+    last_event_id: str = "0",
+    compact: bool = False,
+    request: Optional[Request] = None
+) -> AsyncGenerator[bytes, None]:
+    """转发任务事件流，从 last_event_id 之后开始，每一帧带上事件ID用于断线续传
+
+    客户端断开时（写入下一帧失败，或空闲时检测到断开）注销连接，最后一个连接断开后由 task_cancellation 取消生成
+    """
+    await task_cancellation.attach(task_id)
+    finished = False
+    try:
+        async for event_id, event, data in task_stream.read(
+            task_id, last_event_id, idle_timeout=VLM_RELAY_IDLE_TIMEOUT
+        ):
+            if event == "idle":
+                if request is not None and await request.is_disconnected():
+                    return
+                task = await redis_service.get_task(task_id)
+                if not task or task["status"] == "cancelled":
+                    # 任务在开始执行前被取消或已过期
+                    finished = True
+                    yield encode_event("error", {"error": "Task was cancelled"})
+                    return
+                continue
+            if event in END_EVENTS:
+                finished = True
+            yield encode_event(event, data, event_id, compact)
+        finished = True
+    except TaskStreamTimeout as e:
+        finished = True
+        yield encode_event("error", {"error": str(e)})
+    finally:
+        task_cancellation.detach(task_id, disconnected=not finished)
+
+async def start_task_if_inline(task_id: str, task: Dict[str, Any]) -> None:
+    """队列模式下由 worker 执行；inline 模式下第一次打开时在本进程后台执行，
+    之后的连接（包括重连）都只转发任务事件流，不会重新调用模型"""
+    if is_queue_mode() or not await redis_service.claim_task(task_id):
+        return
+    try:
+        image = await load_task_image(task)
+    except FileNotFoundError:
+        await redis_service.update_task_status(task_id, "failed", "Image not found")
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    # 更新任务状态为处理中
+    await redis_service.update_task_status(task_id, "processing")
+    task["status"] = "processing"
+    start_task_in_background(task_id, task, image)
+
+def sse_response(content: AsyncGenerator[bytes, None]) -> StreamingResponse:
+    """创建SSE响应"""
+    # 设置正确的响应头
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",  # 禁用 Nginx 缓冲
+    }
+    return StreamingResponse(
+        content=content,
+        media_type="text/event-stream",
+        headers=headers
+    )
 
 @router.get("/chat_with_vlm/stream/{task_id}")
 async def stream_chat(
     task_id: str, 
+    request: Request,
     background_tasks: BackgroundTasks,
+    last_event_id: Optional[str] = None,
+    compact: bool = False,
     credentials: JwtAuthorizationCredentials = Security(access_security)
 ):
     try:
@@ -136,51 +308,17 @@ async def stream_chat(
         
         if task["status"] == "cancelled":
             raise HTTPException(status_code=400, detail="Task was cancelled")
-            
-        # 更新任务状态为处理中
-        await redis_service.update_task_status(task_id, "processing")
-            
-        # 从URL中提取文件名
-        filename = os.path.basename(task["image_url"])
-        file_path = os.path.join(UPLOAD_DIR, filename)
-        
-        if not os.path.exists(file_path):
-            raise HTTPException(status_code=404, detail="Image not found")
-            
-        # 异步读取图片并转换为Base64
-        async with aiofiles.open(file_path, "rb") as f:
-            image_content = await f.read()
-        base64_image = base64.b64encode(image_content).decode("utf-8")
-
-        user_question = f"""
-        请仔细分析图片中的算法题目，并按照以下格式用 {task["programming_language"]} 语言提供解决方案：
-
-        ### 解题思路
-        - 分析问题的关键点
-        - 提供清晰的解题步骤
-        - 说明算法的时间和空间复杂度
-        
-        ### 代码实现
-        ```{task["programming_language"]}
-        // 在这里实现具体代码
-        // 每行代码都添加清晰的注释
-        ```
-        """
-
-        # 设置正确的响应头
-        headers = {
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",  # 禁用 Nginx 缓冲
-        }
-
-        # 创建SSE响应
-        return StreamingResponse(
-            content=process_vlm_stream(base64_image, user_question, task_id, user_id),
-            media_type="text/event-stream",
-            headers=headers
+
+        # 断线重连时从 Last-Event-ID 之后继续（小程序等不支持自定义请求头的客户端可用查询参数）
+        resume_from = task_stream.normalize_last_id(
+            request.headers.get("Last-Event-ID") or last_event_id
         )
 
+        await start_task_if_inline(task_id, task)
+
+        # compact=true 时使用精简的 message 帧格式
+        return sse_response(relay_task_stream(task_id, resume_from, compact, request))
+
     except HTTPException as e:
         raise
     except Exception as e:
@@ -203,20 +341,140 @@ async def submit_chat(
     credentials: JwtAuthorizationCredentials = Security(access_security)
 ):
     try:
-        task_id = str(uuid.uuid4())
-        
-        # 创建任务
-        await redis_service.create_task(task_id, {
-            "image_url": request.image_url,
-            "programming_language": request.programming_language,
-            "user_id": credentials.subject.get("user_id")  # 添加用户ID到任务信息中
-        })
-        
-        return ChatSubmitResponse(task_id=task_id, status="pending")
+        # 读取上传时识别的图片类型
+        image_meta = await redis_service.get_image_meta(os.path.basename(request.image_url))
+        # 任务引用的图片至少保留到任务过期
+        await image_store.touch_reference(request.image_url)
+
+        task_id, task = await create_chat_task(
+            credentials.subject.get("user_id"), request.image_url, image_meta.get("mime_type"),
+            request.programming_language, request.flush_interval_ms, request.flush_bytes
+        )
+
+        # 队列模式提交即入队，同样是提前开始生成
+        if VLM_EAGER_START or is_queue_mode():
+            await start_task_if_inline(task_id, task)
+            # 客户端迟迟不打开事件流时取消并退款，避免白白占用上游并发
+            task_cancellation.watch_attach(task_id)
+        return ChatSubmitResponse(task_id=task_id, status=task["status"])
         
+    except HTTPException as e:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
+
+async def create_chat_task(
+    user_id,
+    image_url: str,
+    mime_type: Optional[str],
+    programming_language: str,
+    flush_interval_ms: Optional[int] = None,
+    flush_bytes: Optional[int] = None
+) -> Tuple[str, Dict[str, Any]]:
+    """创建解题任务，队列模式下同时入队，返回 (任务ID, 任务信息)"""
+    task_id = str(uuid.uuid4())
+    task = {
+        "image_url": image_url,
+        "mime_type": mime_type,
+        "programming_language": programming_language,
+        "flush_interval_ms": flush_interval_ms,
+        "flush_bytes": flush_bytes,
+        "user_id": user_id  # 添加用户ID到任务信息中
+    }
+    await redis_service.create_task(task_id, task)
+
+    if is_queue_mode():
+        # 队列模式：提交即入队，由 worker 开始生成
+        lane = await task_queue.enqueue(task_id, user_id)
+        await redis_service.update_task_status(task_id, "queued")
+        task["status"] = "queued"
+        logging.info(f"任务已入队 | 任务：{task_id} | 队列：{lane}")
+
+    return task_id, task
+
+@router.post("/chat_with_vlm/solve")
+async def upload_and_solve(
+    request: Request,
+    image: UploadFile = File(...),
+    programming_language: str = Form(..., max_length=50),
+    flush_interval_ms: Optional[int] = Form(None, ge=0, le=1000),
+    flush_bytes: Optional[int] = Form(None, ge=0, le=65536),
+    compact: bool = Form(False),
+    credentials: JwtAuthorizationCredentials = Security(access_security)
+):
+    """上传图片并直接返回解题事件流，合并 upload_image、submit 和 stream 三次请求
+
+    第一帧为 task 事件，带有任务ID和图片URL；断线后使用 /chat_with_vlm/stream/{task_id} 续传
+    """
+    user_id = credentials.subject.get("user_id")
+    try:
+        filename, mime_type = await store_upload(image, user_id)
+        image_url = f"/images/{filename}"
+        # 刚上传的图片已有引用，不需要再刷新
+        task_id, task = await create_chat_task(
+            user_id, image_url, mime_type, programming_language, flush_interval_ms, flush_bytes
+        )
+    except HTTPException as e:
+        raise
+    except Exception as e:
+        logging.error(f"Upload and solve failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
+
+    try:
+        await start_task_if_inline(task_id, task)
+    except HTTPException as e:
+        raise
     except Exception as e:
+        await redis_service.update_task_status(task_id, "failed", str(e))
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
 
+    async def content() -> AsyncGenerator[bytes, None]:
+        yield encode_event("task", {"task_id": task_id, "image_url": image_url, "status": task["status"]})
+        async for frame in relay_task_stream(task_id, compact=compact, request=request):
+            yield frame
+
+    return sse_response(content())
+
+@router.get("/chat_with_vlm/cache/stats")
+async def get_answer_cache_stats(
+    credentials: JwtAuthorizationCredentials = Security(access_security)
+):
+    """获取答案缓存命中统计"""
+    return await answer_cache.get_stats()
+
+@router.get("/chat_with_vlm/image_pipeline/stats")
+async def get_image_pipeline_stats(
+    credentials: JwtAuthorizationCredentials = Security(access_security)
+):
+    """获取图片预处理统计（节省的上游传输字节数）"""
+    return await image_pipeline.get_stats()
+
+@router.get("/chat_with_vlm/storage/stats")
+async def get_image_storage_stats(
+    credentials: JwtAuthorizationCredentials = Security(access_security)
+):
+    """获取图片存储用量、过期清理统计和内存缓存命中率"""
+    return await image_lifecycle.get_stats()
+
+@router.get("/chat_with_vlm/upstream/stats")
+async def get_upstream_stats(
+    credentials: JwtAuthorizationCredentials = Security(access_security)
+):
+    """获取各上游后端的首token延迟、错误率和对冲统计（当前进程），以及熔断状态和集群并发窗口"""
+    stats = model_router.get_stats()
+    stats["circuit_breaker"] = vlm_circuit_breaker.get_stats()
+    stats["concurrency"] = await vlm_semaphore.get_usage()
+    return stats
+
+@router.get("/chat_with_vlm/metrics", response_class=PlainTextResponse)
+async def get_task_metrics(request: Request):
+    """以 Prometheus 文本格式导出任务性能直方图（排队、首token、首字节、生成速度等），标签为 model 和 language"""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(await task_metrics.export(), media_type="text/plain; version=0.0.4")
+
 @router.get("/chat_with_vlm/status/{task_id}")
 async def get_task_status(
     task_id: str,
@@ -247,19 +505,16 @@ async def cancel_task(
     if task.get("user_id") != credentials.subject.get("user_id"):
         raise HTTPException(status_code=403, detail="Not authorized to cancel this task")
         
-    success = await redis_service.cancel_task(task_id)
+    # 已经开始执行的任务由执行方在取消时结算（可能已从缓存返回或已扣费），这里只处理从未开始的任务
+    never_started = task["status"] in ("pending", "queued") \
+        and not task_cancellation.is_running(task_id) and not await task_queue.is_running(task_id)
+
+    # 正在生成时同时停止上游调用
+    success = await task_cancellation.request(task_id, REASON_USER)
     if not success:
         raise HTTPException(status_code=400, detail="Cannot cancel task")
-        
-    # 如果任务被取消，退还预扣的费用
-    try:
-        refund_balance(
-            user_id=int(task.get("user_id")),
-            amount=SERVICE_FEE,
-            task_id=task_id
-        )
-        logging.info(f"任务取消，预扣费用退还成功 | 用户：{task.get('user_id')} | 退还金额：{SERVICE_FEE}")
-    except Exception as e:
-        logging.error(f"任务取消，预扣费用退还失败：{str(e)}", exc_info=True)
-        
+
+    if never_started:
+        refund_task(task["user_id"], task_id, SERVICE_FEE)
+
     return {"status": "cancelled"}
\ No newline at end of file
@@ -1,4 +1,5 @@
 from pydantic import BaseModel, Field
+from typing import Optional
 
 # 定义请求体的 Pydantic 模型
 class VLMRequest(BaseModel):
@@ -8,7 +9,9 @@ class VLMRequest(BaseModel):
 class ChatSubmitRequest(BaseModel):
     """聊天提交请求模型"""
     image_url: str = Field(..., description="图片URL路径")
-    programming_language: str = Field(..., description="编程语言")
+    programming_language: str = Field(..., max_length=50, description="编程语言")
+    flush_interval_ms: Optional[int] = Field(None, ge=0, le=1000, description="合并输出的最长等待时间（毫秒），0表示逐字输出")
+    flush_bytes: Optional[int] = Field(None, ge=0, le=65536, description="合并输出的字节数阈值，0表示逐字输出")
 
 class ChatSubmitResponse(BaseModel):
     """聊天提交响应模型"""
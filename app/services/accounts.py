@@ -1,6 +1,7 @@
 from fastapi import HTTPException
 from utils.database import get_db
-from models.account import Account, Transaction
+from models.account import Account
+from models.transaction import Transaction
 from typing import Optional, List, Dict
 from decimal import Decimal
 from sqlalchemy.exc import SQLAlchemyError
@@ -0,0 +1,304 @@
+import json
+import base64
+import time
+import asyncio
+import logging
+import os
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service
+from utils.image_hash import BKTree, ImageFingerprint, HASH_SIZE, thumbnail_distance
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 答案缓存配置
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 60 * 60)))  # 缓存过期时间（秒），默认7天
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))  # 最大缓存条目数，超出后按LRU淘汰
+ANSWER_CACHE_REPLAY_DELAY = float(os.getenv("ANSWER_CACHE_REPLAY_DELAY", "0"))  # 回放时每帧之间的间隔（秒）
+# 感知哈希近似匹配配置；近似命中会把另一张图片的回答发给用户并收费，默认关闭
+PHASH_MATCH_ENABLED = os.getenv("PHASH_MATCH_ENABLED", "false").lower() == "true"
+# 题目区域256位dHash允许的最大汉明距离，只用于筛选候选
+PHASH_DISTANCE_THRESHOLD = int(os.getenv("PHASH_DISTANCE_THRESHOLD", "12"))
+# 候选的整图缩略图逐块比较，差异最大的分块平均灰度差不超过该值才算命中
+PHASH_MAX_BLOCK_DIFF = float(os.getenv("PHASH_MAX_BLOCK_DIFF", "4"))
+PHASH_MAX_CANDIDATES = 5  # 每次最多确认的候选数
+PHASH_INDEX_REFRESH = float(os.getenv("PHASH_INDEX_REFRESH", "30"))  # 本地索引从Redis同步的间隔（秒）
+IMAGE_PHASH_TTL = 24 * 60 * 60  # 上传图片感知哈希的保存时间，与任务过期时间一致
+
+# Redis 键
+CACHE_KEY_PREFIX = "answer_cache"
+LRU_KEY = f"{CACHE_KEY_PREFIX}:lru"
+STATS_KEY = f"{CACHE_KEY_PREFIX}:stats"
+PHASH_INDEX_PREFIX = f"{CACHE_KEY_PREFIX}:phash{HASH_SIZE * HASH_SIZE}"
+THUMBNAIL_PREFIX = f"{CACHE_KEY_PREFIX}:thumb"
+# 缓存键 -> 该条目在感知哈希索引中的位置（JSON），淘汰时据此清理索引
+PHASH_REF_KEY = f"{CACHE_KEY_PREFIX}:phash_ref"
+IMAGE_PHASH_PREFIX = "image_fingerprint"
+PHASH_HEX_WIDTH = HASH_SIZE * HASH_SIZE // 4
+
+
+def format_phash(phash: int) -> str:
+    return f"{phash:0{PHASH_HEX_WIDTH}x}"
+
+
+class PerceptualIndex:
+    """进程内的感知哈希索引
+
+    Redis 哈希表 ``answer_cache:phash256:{版本}:{语言}`` 保存 感知哈希 -> 图片SHA-256 的映射，
+    每个进程按间隔同步到本地 BK 树，查询完全在内存中完成。
+    """
+
+    def __init__(self):
+        # (提示词版本, 语言) -> (BK树, 感知哈希->图片SHA-256, 上次同步时间)
+        self._indexes: Dict[Tuple[str, str], Tuple[BKTree, Dict[int, str], float]] = {}
+
+    @staticmethod
+    def redis_key(language: str, prompt_version: str) -> str:
+        return f"{PHASH_INDEX_PREFIX}:{prompt_version}:{language.lower()}"
+
+    async def _load(self, language: str, prompt_version: str) -> Tuple[BKTree, Dict[int, str]]:
+        index_key = (prompt_version, language.lower())
+        cached = self._indexes.get(index_key)
+        if cached and time.monotonic() - cached[2] < PHASH_INDEX_REFRESH:
+            return cached[0], cached[1]
+
+        raw = await redis_service.redis.hgetall(self.redis_key(language, prompt_version))
+        entries = {int(phash, 16): image_hash for phash, image_hash in raw.items()}
+        tree = cached[0] if cached else BKTree()
+        # 已删除的条目留在树中，查询时按 entries 过滤；过期节点过多时重建
+        if len(tree) > 2 * len(entries) + 1000:
+            tree = BKTree()
+        for phash in entries:
+            tree.add(phash)
+        self._indexes[index_key] = (tree, entries, time.monotonic())
+        return tree, entries
+
+    async def add(self, phash: int, image_hash: str, language: str, prompt_version: str) -> None:
+        await redis_service.redis.hset(self.redis_key(language, prompt_version), format_phash(phash), image_hash)
+        cached = self._indexes.get((prompt_version, language.lower()))
+        if cached:
+            cached[0].add(phash)
+            cached[1][phash] = image_hash
+
+    async def remove(self, phash: int, language: str, prompt_version: str) -> None:
+        await redis_service.redis.hdel(self.redis_key(language, prompt_version), format_phash(phash))
+        cached = self._indexes.get((prompt_version, language.lower()))
+        if cached:
+            cached[1].pop(phash, None)
+
+    async def find(self, phash: int, language: str, prompt_version: str) -> List[Tuple[int, int, str]]:
+        """按距离升序查找已缓存的候选图片，返回 [(距离, 感知哈希, 图片SHA-256)]"""
+        tree, entries = await self._load(language, prompt_version)
+        matches = []
+        for distance, candidate in tree.search(phash, PHASH_DISTANCE_THRESHOLD):
+            image_hash = entries.get(candidate)
+            if image_hash:
+                matches.append((distance, candidate, image_hash))
+                if len(matches) >= PHASH_MAX_CANDIDATES:
+                    break
+        return matches
+
+
+class AnswerCache:
+    """按内容寻址的答案缓存
+
+    以 (图片 SHA-256, 编程语言, 提示词版本) 为键，缓存一次完整生成的 message 事件序列，
+    命中时按原有的 ``event: message`` 帧逐条回放，不再调用上游模型。
+    """
+
+    @staticmethod
+    def make_key(image_hash: str, language: str, prompt_version: str) -> str:
+        return f"{CACHE_KEY_PREFIX}:{prompt_version}:{language.lower()}:{image_hash}"
+
+    @staticmethod
+    def thumbnail_key(key: str) -> str:
+        """缓存条目对应的缩略图键，与条目一起写入和淘汰"""
+        return f"{THUMBNAIL_PREFIX}{key[len(CACHE_KEY_PREFIX):]}"
+
+    @staticmethod
+    async def get(image_hash: str, language: str, prompt_version: str) -> Optional[List[str]]:
+        """查找缓存的回答，返回 message 内容列表；未命中返回 None"""
+        if not ANSWER_CACHE_ENABLED:
+            return None
+
+        key = AnswerCache.make_key(image_hash, language, prompt_version)
+        try:
+            data = await redis_service.redis.get(key)
+            if data is None:
+                await redis_service.redis.hincrby(STATS_KEY, "miss", 1)
+                return None
+
+            # 命中时刷新LRU访问时间和过期时间
+            await redis_service.redis.zadd(LRU_KEY, {key: time.time()})
+            await redis_service.redis.expire(key, ANSWER_CACHE_TTL)
+            await redis_service.redis.expire(AnswerCache.thumbnail_key(key), ANSWER_CACHE_TTL)
+            await redis_service.redis.hincrby(STATS_KEY, "hit", 1)
+            return json.loads(data)["transcript"]
+        except Exception as e:
+            # 缓存故障不影响正常生成
+            logger.warning(f"读取答案缓存失败：{str(e)}")
+            return None
+
+    @staticmethod
+    async def get_similar(
+        fingerprint: ImageFingerprint,
+        language: str,
+        prompt_version: str
+    ) -> Optional[List[str]]:
+        """按感知哈希查找近似重复图片的缓存回答，用于精确匹配未命中之后
+
+        哈希相近的候选还要用整图缩略图确认，同一布局下不同题目的截图会在这一步被排除。
+        """
+        if not ANSWER_CACHE_ENABLED or not PHASH_MATCH_ENABLED:
+            return None
+
+        try:
+            for distance, candidate, image_hash in await perceptual_index.find(
+                fingerprint.phash, language, prompt_version
+            ):
+                key = AnswerCache.make_key(image_hash, language, prompt_version)
+                data, thumbnail = await redis_service.redis.mget(key, AnswerCache.thumbnail_key(key))
+                if data is None:
+                    # 对应的缓存已被淘汰，清理索引
+                    await perceptual_index.remove(candidate, language, prompt_version)
+                    continue
+
+                block_diff = thumbnail_distance(
+                    fingerprint.thumbnail, base64.b64decode(thumbnail) if thumbnail else b""
+                )
+                if block_diff > PHASH_MAX_BLOCK_DIFF:
+                    await redis_service.redis.hincrby(STATS_KEY, "near_rejected", 1)
+                    continue
+
+                await redis_service.redis.zadd(LRU_KEY, {key: time.time()})
+                await redis_service.redis.expire(key, ANSWER_CACHE_TTL)
+                await redis_service.redis.expire(AnswerCache.thumbnail_key(key), ANSWER_CACHE_TTL)
+                await redis_service.redis.hincrby(STATS_KEY, "near_hit", 1)
+                logger.info(
+                    f"感知哈希近似命中 | 距离：{distance} | 分块差异：{block_diff:.1f} | 原图：{image_hash}"
+                )
+                return json.loads(data)["transcript"]
+
+            await redis_service.redis.hincrby(STATS_KEY, "near_miss", 1)
+            return None
+        except Exception as e:
+            logger.warning(f"感知哈希查找失败：{str(e)}")
+            return None
+
+    @staticmethod
+    async def set(
+        image_hash: str,
+        language: str,
+        prompt_version: str,
+        transcript: List[str],
+        fingerprint: Optional[ImageFingerprint] = None
+    ) -> None:
+        """写入一次完整生成的 message 内容列表，提供指纹时同时加入近似匹配索引"""
+        if not ANSWER_CACHE_ENABLED or not transcript:
+            return
+
+        key = AnswerCache.make_key(image_hash, language, prompt_version)
+        try:
+            payload = json.dumps({
+                "transcript": transcript,
+                "created_at": time.time(),
+            }, ensure_ascii=False)
+            await redis_service.redis.set(key, payload, ex=ANSWER_CACHE_TTL)
+            await redis_service.redis.zadd(LRU_KEY, {key: time.time()})
+            await redis_service.redis.hincrby(STATS_KEY, "store", 1)
+            if fingerprint is not None and PHASH_MATCH_ENABLED:
+                await redis_service.redis.set(
+                    AnswerCache.thumbnail_key(key),
+                    base64.b64encode(fingerprint.thumbnail).decode("ascii"),
+                    ex=ANSWER_CACHE_TTL
+                )
+                await perceptual_index.add(fingerprint.phash, image_hash, language, prompt_version)
+                await redis_service.redis.hset(PHASH_REF_KEY, key, json.dumps({
+                    "index": perceptual_index.redis_key(language, prompt_version),
+                    "phash": format_phash(fingerprint.phash),
+                }))
+            await AnswerCache._evict()
+        except Exception as e:
+            logger.warning(f"写入答案缓存失败：{str(e)}")
+
+    @staticmethod
+    async def _evict() -> None:
+        """清理已过期的条目，条目数超过上限时淘汰最久未访问的缓存
+
+        答案和缩略图过期后由 Redis 删除，但 LRU 有序集合和感知哈希索引中的记录不会随之删除，
+        在这里一并清理，索引大小不超过条目上限。
+        """
+        redis = redis_service.redis
+        # 每次访问都会同时刷新访问时间和过期时间，访问时间早于有效期的条目已经过期
+        expired = await redis.zrangebyscore(LRU_KEY, "-inf", time.time() - ANSWER_CACHE_TTL)
+        overflow = await redis.zcard(LRU_KEY) - len(expired) - ANSWER_CACHE_MAX_ENTRIES
+        evicted = await redis.zrange(LRU_KEY, len(expired), len(expired) + overflow - 1) if overflow > 0 else []
+        if not expired and not evicted:
+            return
+
+        keys = expired + evicted
+        await redis.delete(*keys, *[AnswerCache.thumbnail_key(key) for key in keys])
+        for key, ref in zip(keys, await redis.hmget(PHASH_REF_KEY, keys)):
+            if ref is None:
+                continue
+            ref = json.loads(ref)
+            # 相同感知哈希可能已被其他图片覆盖，只删除仍指向本条目的记录
+            if await redis.hget(ref["index"], ref["phash"]) == key.rsplit(":", 1)[-1]:
+                await redis.hdel(ref["index"], ref["phash"])
+        await redis.hdel(PHASH_REF_KEY, *keys)
+        await redis.zrem(LRU_KEY, *keys)
+        if evicted:
+            await redis.hincrby(STATS_KEY, "evict", len(evicted))
+
+    @staticmethod
+    async def replay(
+        transcript: List[str],
+        delay: float = ANSWER_CACHE_REPLAY_DELAY
+    ) -> AsyncGenerator[Tuple[str, Any], None]:
+        """按原始 message 事件序列回放缓存的回答"""
+        for content in transcript:
+            yield "message", content
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield "done", None
+
+    @staticmethod
+    async def save_image_fingerprint(filename: str, fingerprint: ImageFingerprint) -> None:
+        """保存上传图片的近似匹配指纹，供执行任务时使用"""
+        payload = json.dumps({
+            "phash": format_phash(fingerprint.phash),
+            "thumbnail": base64.b64encode(fingerprint.thumbnail).decode("ascii"),
+        })
+        await redis_service.redis.set(f"{IMAGE_PHASH_PREFIX}:{filename}", payload, ex=IMAGE_PHASH_TTL)
+
+    @staticmethod
+    async def get_image_fingerprint(filename: str) -> Optional[ImageFingerprint]:
+        """读取上传图片的近似匹配指纹，近似匹配关闭或没有计算过时返回 None"""
+        if not PHASH_MATCH_ENABLED:
+            return None
+        value = await redis_service.redis.get(f"{IMAGE_PHASH_PREFIX}:{filename}")
+        if not value:
+            return None
+        payload = json.loads(value)
+        return ImageFingerprint(int(payload["phash"], 16), base64.b64decode(payload["thumbnail"]))
+
+    @staticmethod
+    async def get_stats() -> Dict[str, float]:
+        """获取命中/未命中等计数及近似匹配率"""
+        stats = await redis_service.redis.hgetall(STATS_KEY)
+        result = {k: int(v) for k, v in stats.items()}
+        result["entries"] = await redis_service.redis.zcard(LRU_KEY)
+        near_total = result.get("near_hit", 0) + result.get("near_miss", 0)
+        result["near_match_rate"] = result.get("near_hit", 0) / near_total if near_total else 0.0
+        result["phash_threshold"] = PHASH_DISTANCE_THRESHOLD
+        return result
+
+
+# 创建全局感知哈希索引和答案缓存实例
+perceptual_index = PerceptualIndex()
+answer_cache = AnswerCache()
@@ -0,0 +1,317 @@
+import os
+import uuid
+import shutil
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Optional
+
+import aiofiles
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploaded_images")
+
+# 存储后端：local 为本地目录（多节点时需要共享卷），s3 为 S3 兼容的对象存储（如 MinIO、OSS、COS）
+IMAGE_STORAGE_BACKEND = os.getenv("IMAGE_STORAGE_BACKEND", "local").lower()
+IMAGE_STORAGE_CHUNK_SIZE = int(os.getenv("IMAGE_STORAGE_CHUNK_SIZE", str(64 * 1024)))  # 流式读写的分块大小
+
+# S3 兼容存储配置
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # 例如 http://minio:9000，使用 AWS 时留空
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_BUCKET = os.getenv("S3_BUCKET", "paijie-images")
+S3_PREFIX = os.getenv("S3_PREFIX", "blobs/")
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
+
+# 对象存储的本地读穿透缓存：图片按内容寻址、写入后不再变化，缓存不需要失效，只需要按容量淘汰
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(UPLOAD_DIR, "cache"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))  # 默认1GB
+
+
+class BlobStorage(ABC):
+    """图片存储后端接口，键为 ab/cd/<sha256>.<ext> 形式的相对路径"""
+
+    async def start(self) -> None:
+        """初始化连接，由 FastAPI lifespan 和 worker 调用"""
+
+    async def close(self) -> None:
+        """释放连接"""
+
+    @abstractmethod
+    async def exists(self, key: str) -> bool:
+        """内容是否存在于权威存储中（不以本节点的缓存为准），写入前据此判断能否跳过上传"""
+
+    @abstractmethod
+    async def write(self, key: str, chunks: AsyncIterator[bytes]) -> None:
+        """流式写入"""
+
+    @abstractmethod
+    async def put_file(self, key: str, file_path: str) -> None:
+        """保存本地文件，调用后 file_path 不再可用（被移动或删除）"""
+
+    @abstractmethod
+    def read(self, key: str) -> AsyncIterator[bytes]:
+        """流式读取，不存在时抛出 FileNotFoundError"""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """删除内容，不存在时忽略"""
+
+    @abstractmethod
+    async def local_path(self, key: str) -> str:
+        """返回内容所在的本地文件路径，供解码、哈希和 FileResponse 使用；不存在时抛出 FileNotFoundError"""
+
+
+class LocalBlobStorage(BlobStorage):
+    """本地目录存储"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def _temp_path(self, path: str) -> str:
+        return f"{path}.{uuid.uuid4().hex}.part"
+
+    async def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    async def write(self, key: str, chunks: AsyncIterator[bytes]) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再重命名，读者不会看到写了一半的文件
+        temp_path = self._temp_path(path)
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                async for chunk in chunks:
+                    await f.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 临时目录可能与存储目录不在同一文件系统（os.replace 会失败），先移动到目标目录内的临时文件，
+        # 同一文件系统时只是一次重命名；再原子地重命名为最终文件，并发写入相同内容时后完成的覆盖先完成的
+        temp_path = self._temp_path(path)
+        try:
+            await asyncio.to_thread(shutil.move, file_path, temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    async def read(self, key: str) -> AsyncIterator[bytes]:
+        async with aiofiles.open(self.path(key), "rb") as f:
+            while chunk := await f.read(IMAGE_STORAGE_CHUNK_SIZE):
+                yield chunk
+
+    async def delete(self, key: str) -> None:
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    async def local_path(self, key: str) -> str:
+        path = self.path(key)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(key)
+        return path
+
+
+class S3BlobStorage(BlobStorage):
+    """S3 兼容的对象存储，任意节点都能读取任意任务的图片
+
+    读取时先查本地缓存，未命中时从对象存储流式下载到缓存目录（读穿透）；
+    写入时上传后把本地文件放入缓存，上传节点后续的解码、预处理不需要再下载。
+    """
+
+    def __init__(self):
+        self.cache = LocalBlobStorage(IMAGE_CACHE_DIR)
+        self._client = None
+        self._client_context = None
+        self._cache_bytes: Optional[int] = None
+        self._trim_lock = asyncio.Lock()
+
+    def _object_key(self, key: str) -> str:
+        return f"{S3_PREFIX}{key}"
+
+    async def start(self) -> None:
+        if self._client is not None:
+            return
+        # aiobotocore 只在使用对象存储时需要
+        from aiobotocore.session import get_session
+
+        self._client_context = get_session().create_client(
+            "s3",
+            endpoint_url=S3_ENDPOINT_URL,
+            region_name=S3_REGION,
+            aws_access_key_id=S3_ACCESS_KEY_ID,
+            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+        )
+        self._client = await self._client_context.__aenter__()
+        try:
+            await self._ensure_bucket()
+        except Exception:
+            await self.close()
+            raise
+        logger.info(f"图片对象存储已连接 | 地址：{S3_ENDPOINT_URL or 'AWS'} | 存储桶：{S3_BUCKET}")
+
+    async def _ensure_bucket(self) -> None:
+        """存储桶不存在时自动创建，便于使用本地 MinIO 开发测试"""
+        try:
+            await self._client.head_bucket(Bucket=S3_BUCKET)
+        except self._client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchBucket", "NotFound"):
+                raise
+            await self._client.create_bucket(Bucket=S3_BUCKET)
+            logger.info(f"已创建存储桶：{S3_BUCKET}")
+
+    async def close(self) -> None:
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+            self._client = None
+            self._client_context = None
+
+    async def exists(self, key: str) -> bool:
+        # 只以对象存储为准：其他节点的清理可能已经删除了对象，而本节点的缓存还在，
+        # 此时以缓存判断会跳过上传，内容只留在本节点。读取仍然优先使用缓存
+        try:
+            await self._client.head_object(Bucket=S3_BUCKET, Key=self._object_key(key))
+            return True
+        except self._client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    async def write(self, key: str, chunks: AsyncIterator[bytes]) -> None:
+        # 图片最大只有几十MB，先落到本地缓存再整体上传，同时完成缓存写入
+        await self.cache.write(key, chunks)
+        await self._upload(key, self.cache.path(key))
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        await self._upload(key, file_path)
+        size = os.path.getsize(file_path)
+        await self.cache.put_file(key, file_path)
+        await self._account_cache(size)
+
+    async def _upload(self, key: str, file_path: str) -> None:
+        # 以文件对象作为请求体，由 HTTP 客户端分块发送，不把整个文件读入内存
+        with open(file_path, "rb") as body:
+            await self._client.put_object(Bucket=S3_BUCKET, Key=self._object_key(key), Body=body)
+
+    async def read(self, key: str) -> AsyncIterator[bytes]:
+        if await self.cache.exists(key):
+            async for chunk in self.cache.read(key):
+                yield chunk
+            return
+
+        # 未命中缓存：边从对象存储读取边写入缓存
+        queue: asyncio.Queue = asyncio.Queue(maxsize=8)
+
+        async def tee() -> AsyncIterator[bytes]:
+            while (chunk := await queue.get()) is not None:
+                yield chunk
+
+        writer = asyncio.create_task(self.cache.write(key, tee()))
+        size = 0
+        try:
+            async for chunk in self._download(key):
+                size += len(chunk)
+                await queue.put(chunk)
+                yield chunk
+            await queue.put(None)
+            await writer
+            await self._account_cache(size)
+        finally:
+            if not writer.done():
+                writer.cancel()
+
+    async def _download(self, key: str) -> AsyncIterator[bytes]:
+        try:
+            response = await self._client.get_object(Bucket=S3_BUCKET, Key=self._object_key(key))
+        except self._client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+        async with response["Body"] as body:
+            while chunk := await body.read(IMAGE_STORAGE_CHUNK_SIZE):
+                yield chunk
+
+    async def delete(self, key: str) -> None:
+        await self.cache.delete(key)
+        await self._client.delete_object(Bucket=S3_BUCKET, Key=self._object_key(key))
+
+    async def local_path(self, key: str) -> str:
+        if not await self.cache.exists(key):
+            size = 0
+            async def download() -> AsyncIterator[bytes]:
+                nonlocal size
+                async for chunk in self._download(key):
+                    size += len(chunk)
+                    yield chunk
+            await self.cache.write(key, download())
+            await self._account_cache(size)
+        path = self.cache.path(key)
+        # 更新访问时间，淘汰时优先删除最久未使用的文件
+        os.utime(path)
+        return path
+
+    async def _account_cache(self, size: int) -> None:
+        """记录缓存占用，超过容量时按最久未使用淘汰"""
+        if self._cache_bytes is None:
+            self._cache_bytes = await asyncio.to_thread(self._scan_cache_bytes)
+        self._cache_bytes += size
+        if self._cache_bytes > IMAGE_CACHE_MAX_BYTES and not self._trim_lock.locked():
+            async with self._trim_lock:
+                self._cache_bytes = await asyncio.to_thread(self._trim_cache)
+
+    def _cache_files(self):
+        for directory, _, names in os.walk(self.cache.root):
+            for name in names:
+                if not name.endswith(".part"):
+                    path = os.path.join(directory, name)
+                    try:
+                        yield path, os.stat(path)
+                    except FileNotFoundError:
+                        continue
+
+    def _scan_cache_bytes(self) -> int:
+        return sum(stat.st_size for _, stat in self._cache_files())
+
+    def _trim_cache(self) -> int:
+        """删除最久未使用的缓存文件，直到占用降到容量的80%"""
+        files = sorted(self._cache_files(), key=lambda item: item[1].st_mtime)
+        total = sum(stat.st_size for _, stat in files)
+        target = IMAGE_CACHE_MAX_BYTES * 0.8
+        for path, stat in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= stat.st_size
+            except FileNotFoundError:
+                continue
+        logger.info(f"图片缓存已清理 | 当前占用：{total} 字节")
+        return total
+
+
+def create_blob_storage() -> BlobStorage:
+    """根据 IMAGE_STORAGE_BACKEND 创建存储后端"""
+    if IMAGE_STORAGE_BACKEND == "s3":
+        return S3BlobStorage()
+    if IMAGE_STORAGE_BACKEND == "local":
+        return LocalBlobStorage(os.path.join(UPLOAD_DIR, "blobs"))
+    raise ValueError(f"不支持的图片存储后端：{IMAGE_STORAGE_BACKEND}")
+
+
+# 创建全局图片存储后端实例
+blob_storage = create_blob_storage()
@@ -0,0 +1,85 @@
+import os
+import time
+import logging
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 上游熔断配置
+VLM_BREAKER_ENABLED = os.getenv("VLM_BREAKER_ENABLED", "true").lower() == "true"
+VLM_BREAKER_FAILURES = int(os.getenv("VLM_BREAKER_FAILURES", "5"))  # 连续失败多少次后熔断
+VLM_BREAKER_OPEN_SECONDS = float(os.getenv("VLM_BREAKER_OPEN_SECONDS", "30"))  # 熔断后多久放行一个试探请求
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """上游熔断器（进程内）
+
+    所有后端都返回限流、5xx 或连接失败时计为一次失败，连续失败达到阈值后熔断：
+    熔断期间的请求直接失败，不再排队占用并发许可；经过 open_seconds 后放行一个试探请求，
+    成功则恢复，失败则继续熔断。
+    """
+
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float, enabled: bool = True):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.enabled = enabled
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._probe_started_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        """是否放行请求，熔断期间返回 False"""
+        if not self.enabled or self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self._probe_started_at = None
+        if self.state == HALF_OPEN:
+            # 同时只放行一个试探请求；试探请求被取消、没有结果时，超过 open_seconds 后再放行下一个
+            if self._probe_started_at is None or now - self._probe_started_at >= self.open_seconds:
+                self._probe_started_at = now
+                return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info(f"上游恢复，熔断关闭 | {self.name}")
+        self.state = CLOSED
+        self.failures = 0
+        self._probe_started_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self._probe_started_at = None
+            logger.error(f"上游连续失败 {self.failures} 次，熔断 {self.open_seconds} 秒 | {self.name}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+# 创建全局上游熔断器实例
+vlm_circuit_breaker = CircuitBreaker(
+    "vlm", VLM_BREAKER_FAILURES, VLM_BREAKER_OPEN_SECONDS, enabled=VLM_BREAKER_ENABLED
+)
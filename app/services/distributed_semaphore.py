@@ -0,0 +1,281 @@
+import asyncio
+import time
+import uuid
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, AsyncIterator
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 全局并发配置
+VLM_GLOBAL_CONCURRENCY = int(os.getenv("VLM_GLOBAL_CONCURRENCY", "20"))  # 整个集群的上游并发上限
+VLM_USER_CONCURRENCY = int(os.getenv("VLM_USER_CONCURRENCY", "2"))  # 单个用户的上游并发上限
+VLM_SEMAPHORE_LEASE_TTL = int(os.getenv("VLM_SEMAPHORE_LEASE_TTL", "30"))  # 许可租约时间（秒），持有期间自动续期
+VLM_SEMAPHORE_POLL_INTERVAL = float(os.getenv("VLM_SEMAPHORE_POLL_INTERVAL", "0.2"))  # 排队时轮询间隔（秒）
+VLM_SEMAPHORE_MAX_WAIT = float(os.getenv("VLM_SEMAPHORE_MAX_WAIT", "120"))  # 最长排队时间（秒）
+
+# 自适应并发（AIMD）：上游健康时窗口加性增长，遇到限流、5xx 或首token延迟突增时乘性减小
+# 窗口保存在 Redis 中，整个集群共享，从 VLM_GLOBAL_CONCURRENCY 开始
+VLM_AIMD_ENABLED = os.getenv("VLM_AIMD_ENABLED", "true").lower() == "true"
+VLM_AIMD_MIN_CONCURRENCY = int(os.getenv("VLM_AIMD_MIN_CONCURRENCY", "2"))
+VLM_AIMD_MAX_CONCURRENCY = int(os.getenv("VLM_AIMD_MAX_CONCURRENCY", str(VLM_GLOBAL_CONCURRENCY * 2)))
+VLM_AIMD_INCREASE = float(os.getenv("VLM_AIMD_INCREASE", "1"))  # 每个窗口的请求都健康时窗口增加的许可数
+VLM_AIMD_DECREASE = float(os.getenv("VLM_AIMD_DECREASE", "0.7"))  # 拥塞时窗口乘以的系数
+VLM_AIMD_LATENCY_THRESHOLD = float(os.getenv("VLM_AIMD_LATENCY_THRESHOLD", "8"))  # 首token延迟超过该值（秒）视为拥塞
+VLM_AIMD_COOLDOWN_MS = int(os.getenv("VLM_AIMD_COOLDOWN_MS", "2000"))  # 两次减小之间的最短间隔（毫秒）
+
+# 原子地清理过期租约、维护排队顺序并尝试获取许可
+# 返回 0 表示获取成功，-1 表示达到用户并发上限，正数表示在全局队列中的位置
+ACQUIRE_SCRIPT = """
+local holders, user_holders, queue, heartbeat, ticket_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local lease, ttl, global_limit, user_limit = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local window = redis.call('GET', KEYS[6])
+if window then
+    global_limit = math.floor(tonumber(window))
+end
+global_limit = math.max(tonumber(ARGV[5]), math.min(tonumber(ARGV[6]), global_limit))
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+redis.call('ZREMRANGEBYSCORE', user_holders, '-inf', now)
+local stale = redis.call('ZRANGEBYSCORE', heartbeat, '-inf', now)
+for _, member in ipairs(stale) do
+    redis.call('ZREM', queue, member)
+end
+redis.call('ZREMRANGEBYSCORE', heartbeat, '-inf', now)
+
+if redis.call('ZCARD', user_holders) >= user_limit then
+    redis.call('ZREM', queue, lease)
+    redis.call('ZREM', heartbeat, lease)
+    return -1
+end
+
+if not redis.call('ZSCORE', queue, lease) then
+    redis.call('ZADD', queue, redis.call('INCR', ticket_key), lease)
+end
+redis.call('ZADD', heartbeat, now + ttl, lease)
+
+local rank = redis.call('ZRANK', queue, lease)
+local free = global_limit - redis.call('ZCARD', holders)
+if rank < free then
+    redis.call('ZREM', queue, lease)
+    redis.call('ZREM', heartbeat, lease)
+    redis.call('ZADD', holders, now + ttl, lease)
+    redis.call('ZADD', user_holders, now + ttl, lease)
+    redis.call('EXPIRE', user_holders, ttl)
+    return 0
+end
+return rank + 1
+"""
+
+# 仅当租约仍然存在时续期
+RENEW_SCRIPT = """
+local t = redis.call('TIME')
+local expiry = tonumber(t[1]) + tonumber(t[2]) / 1000000 + tonumber(ARGV[2])
+local renewed = redis.call('ZADD', KEYS[1], 'XX', 'CH', expiry, ARGV[1])
+redis.call('ZADD', KEYS[2], 'XX', expiry, ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return renewed
+"""
+
+
+# 调整自适应窗口：increase 加性增长（每个许可增加 步长/窗口），其他为乘性减小
+ADJUST_SCRIPT = """
+local limit = tonumber(redis.call('GET', KEYS[1]) or ARGV[2])
+local min_limit, max_limit = tonumber(ARGV[3]), tonumber(ARGV[4])
+if ARGV[1] == 'increase' then
+    -- 占用不到窗口一半时窗口不是瓶颈，不再增长
+    if redis.call('ZCARD', KEYS[2]) < limit / 2 then
+        return tostring(limit)
+    end
+    limit = math.min(max_limit, limit + tonumber(ARGV[5]) / limit)
+else
+    -- 同一次拥塞会让很多请求同时失败，冷却期内只减小一次
+    if tonumber(ARGV[7]) > 0 and not redis.call('SET', KEYS[3], '1', 'NX', 'PX', ARGV[7]) then
+        return tostring(limit)
+    end
+    limit = math.max(min_limit, limit * tonumber(ARGV[6]))
+end
+redis.call('SET', KEYS[1], tostring(limit))
+return tostring(limit)
+"""
+
+
+class SemaphoreTimeout(Exception):
+    """排队超时"""
+    pass
+
+
+class DistributedSemaphore:
+    """基于 Redis 的集群级信号量
+
+    每个许可是带过期时间的租约（有序集合成员，分数为过期时间），持有期间后台续期，
+    进程崩溃后租约自动过期，不会泄漏许可。同时限制全局并发和单用户并发，
+    排队的请求按到达顺序获得许可，并可以查询自己在队列中的位置。
+    adaptive=True 时全局并发为 Redis 中的自适应窗口，由调用方根据上游的响应调整（AIMD）。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        per_user_limit: int,
+        lease_ttl: int = VLM_SEMAPHORE_LEASE_TTL,
+        adaptive: bool = False,
+        min_limit: int = VLM_AIMD_MIN_CONCURRENCY,
+        max_limit: int = VLM_AIMD_MAX_CONCURRENCY
+    ):
+        self.name = name
+        self.limit = limit
+        self.per_user_limit = per_user_limit
+        self.lease_ttl = lease_ttl
+        self.adaptive = adaptive
+        # 不自适应时窗口固定为 limit
+        self.min_limit = min(min_limit, limit) if adaptive else limit
+        self.max_limit = max(max_limit, limit) if adaptive else limit
+        self._script = None
+        self._renew_script = None
+        self._adjust_script = None
+
+    def _keys(self, user_id: str):
+        prefix = f"semaphore:{self.name}"
+        return [
+            f"{prefix}:holders",
+            f"{prefix}:user:{user_id}",
+            f"{prefix}:queue",
+            f"{prefix}:heartbeat",
+            f"{prefix}:ticket",
+            f"{prefix}:limit",
+        ]
+
+    async def try_acquire(self, user_id: str, lease_id: str) -> int:
+        """尝试获取一次许可，返回 0 表示成功，-1 表示用户并发已满，正数为排队位置"""
+        if self._script is None:
+            self._script = redis_service.redis.register_script(ACQUIRE_SCRIPT)
+        return int(await self._script(
+            keys=self._keys(user_id),
+            args=[lease_id, self.lease_ttl, self.limit, self.per_user_limit, self.min_limit, self.max_limit],
+        ))
+
+    async def acquire(
+        self,
+        user_id: str,
+        lease_id: str,
+        max_wait: float = VLM_SEMAPHORE_MAX_WAIT
+    ) -> AsyncGenerator[int, None]:
+        """排队获取许可，位置变化时产出排队位置（-1 表示等待自己的其他任务完成），获取成功后结束"""
+        deadline = time.monotonic() + max_wait
+        last_position = None
+        while True:
+            position = await self.try_acquire(user_id, lease_id)
+            if position == 0:
+                return
+            if position != last_position:
+                last_position = position
+                yield position
+            if time.monotonic() > deadline:
+                await self.release(user_id, lease_id)
+                raise SemaphoreTimeout("排队等待超时，请稍后重试")
+            await asyncio.sleep(VLM_SEMAPHORE_POLL_INTERVAL)
+
+    async def release(self, user_id: str, lease_id: str) -> None:
+        """释放许可或退出队列"""
+        holders, user_holders, queue, heartbeat, _, _ = self._keys(user_id)
+        pipe = redis_service.redis.pipeline(transaction=False)
+        pipe.zrem(holders, lease_id)
+        pipe.zrem(user_holders, lease_id)
+        pipe.zrem(queue, lease_id)
+        pipe.zrem(heartbeat, lease_id)
+        await pipe.execute()
+
+    async def _renew_loop(self, user_id: str, lease_id: str) -> None:
+        if self._renew_script is None:
+            self._renew_script = redis_service.redis.register_script(RENEW_SCRIPT)
+        holders, user_holders, _, _, _, _ = self._keys(user_id)
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self._renew_script(keys=[holders, user_holders], args=[lease_id, self.lease_ttl])
+            except Exception as e:
+                logger.warning(f"信号量租约续期失败 | 租约：{lease_id} | 原因：{str(e)}")
+
+    @asynccontextmanager
+    async def hold(self, user_id: str, lease_id: str) -> AsyncIterator[None]:
+        """持有已获取的许可，期间自动续期，退出时释放"""
+        renew_task = asyncio.create_task(self._renew_loop(user_id, lease_id))
+        try:
+            yield
+        finally:
+            renew_task.cancel()
+            await self.release(user_id, lease_id)
+
+    @staticmethod
+    def new_lease_id() -> str:
+        return str(uuid.uuid4())
+
+    async def get_user_usage(self, user_id: str) -> int:
+        """某个用户当前持有的许可数"""
+        _, user_holders, _, _, _, _ = self._keys(user_id)
+        await redis_service.redis.zremrangebyscore(user_holders, "-inf", time.time())
+        return await redis_service.redis.zcard(user_holders)
+
+    async def record_success(self, ttft: float) -> None:
+        """上游在 ttft 秒后开始输出：延迟正常时增大窗口，延迟突增时视为拥塞"""
+        if ttft > VLM_AIMD_LATENCY_THRESHOLD:
+            await self._adjust("decrease", f"首token延迟 {ttft:.1f} 秒")
+        else:
+            await self._adjust("increase")
+
+    async def record_overload(self, reason: str) -> None:
+        """上游限流或 5xx，减小窗口"""
+        await self._adjust("decrease", reason)
+
+    async def _adjust(self, mode: str, reason: str = "") -> None:
+        if not self.adaptive:
+            return
+        if self._adjust_script is None:
+            self._adjust_script = redis_service.redis.register_script(ADJUST_SCRIPT)
+        holders, _, _, _, _, limit_key = self._keys("_")
+        try:
+            before = await self.current_limit()
+            after = float(await self._adjust_script(
+                keys=[limit_key, holders, f"{limit_key}:cooldown"],
+                args=[mode, self.limit, self.min_limit, self.max_limit,
+                      VLM_AIMD_INCREASE, VLM_AIMD_DECREASE, VLM_AIMD_COOLDOWN_MS],
+            ))
+            if int(after) < int(before):
+                logger.warning(f"上游并发窗口减小 | {int(before)} -> {int(after)} | 原因：{reason}")
+        except Exception as e:
+            # 调整失败不影响请求本身
+            logger.warning(f"上游并发窗口调整失败：{str(e)}")
+
+    async def current_limit(self) -> float:
+        """当前生效的全局并发窗口"""
+        _, _, _, _, _, limit_key = self._keys("_")
+        window = await redis_service.redis.get(limit_key)
+        current = float(window) if window is not None else self.limit
+        return max(self.min_limit, min(self.max_limit, current))
+
+    async def get_usage(self) -> dict:
+        """当前并发窗口、持有许可数和排队数"""
+        holders, _, queue, _, _, _ = self._keys("_")
+        return {
+            "limit": int(await self.current_limit()),
+            "adaptive": self.adaptive,
+            "in_use": await redis_service.redis.zcard(holders),
+            "waiting": await redis_service.redis.zcard(queue),
+        }
+
+
+# 创建全局上游并发信号量实例
+vlm_semaphore = DistributedSemaphore(
+    "vlm", VLM_GLOBAL_CONCURRENCY, VLM_USER_CONCURRENCY, adaptive=VLM_AIMD_ENABLED
+)
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service, TASK_TTL
+from services.blob_storage import blob_storage
+from services.image_store import (
+    image_store, memory_cache, derivative_key, INVENTORY_KEY, SIZES_KEY, USAGE_KEY, DELETING_PREFIX, UPLOAD_DIR, TMP_DIR
+)
+from utils.image_preprocess import OUTPUT_FORMATS
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 生命周期管理配置
+IMAGE_GC_ENABLED = os.getenv("IMAGE_GC_ENABLED", "true").lower() == "true"
+IMAGE_GC_DRY_RUN = os.getenv("IMAGE_GC_DRY_RUN", "false").lower() == "true"  # 只统计不删除
+IMAGE_GC_INTERVAL = float(os.getenv("IMAGE_GC_INTERVAL", "600"))  # 清理间隔（秒）
+IMAGE_GC_GRACE = float(os.getenv("IMAGE_GC_GRACE", "3600"))  # 任务过期后额外保留的时间（秒）
+IMAGE_GC_BATCH_SIZE = int(os.getenv("IMAGE_GC_BATCH_SIZE", "100"))  # 每批检查的文件数
+IMAGE_GC_DELETES_PER_SECOND = float(os.getenv("IMAGE_GC_DELETES_PER_SECOND", "20"))  # 删除速率上限
+IMAGE_GC_MAX_DELETES = int(os.getenv("IMAGE_GC_MAX_DELETES", "10000"))  # 单轮最多删除的文件数
+IMAGE_GC_TEMP_MAX_AGE = float(os.getenv("IMAGE_GC_TEMP_MAX_AGE", "3600"))  # 上传中断遗留临时文件的保留时间（秒）
+
+LOCK_KEY = "image_gc:lock"
+STATS_KEY = "image_gc:stats"
+DELETING_TTL = 60  # 删除标记的有效期（秒），节点在删除中途崩溃时自动释放
+
+# 删除前的检查与加删除标记在一个脚本中完成：
+# 仍被引用时刷新清单时间；清单时间晚于 cutoff 说明期间被重新上传；否则加删除标记。
+# 标记存在期间 mark_referenced 会等待，检查之后新的上传和引用不会被删除
+CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    if ARGV[5] == '0' then
+        redis.call('ZADD', KEYS[2], ARGV[6], ARGV[1])
+    end
+    return 0
+end
+local score = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if score and tonumber(score) > tonumber(ARGV[2]) then
+    return 0
+end
+if ARGV[5] == '1' then
+    return 1
+end
+if redis.call('SET', KEYS[3], ARGV[3], 'NX', 'EX', ARGV[4]) then
+    return 1
+end
+return 0
+"""
+
+# 只释放自己加的删除标记
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ImageLifecycleManager:
+    """上传图片生命周期管理
+
+    图片引用与任务一样在24小时后过期，按内容存放的文件在最后一个引用过期后即可删除。
+    后台定期从存储清单中取出超过 任务有效期 + 宽限期 未被引用的文件，
+    再次确认引用已经过期并加删除标记后分批限速删除（连同衍生图），
+    同时清理改为按内容存放之前的平铺文件和中断上传的临时文件。
+    多个节点同时运行时通过 Redis 锁保证每个周期只有一个节点执行。
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        # 目录扫描在线程池中执行，取消协程不会中断线程，通过该事件通知线程退出
+        self._stopping = threading.Event()
+        self._owner = f"{socket.gethostname()}-{os.getpid()}"
+
+    def start(self) -> None:
+        """启动后台清理任务，由 FastAPI lifespan 调用"""
+        if IMAGE_GC_ENABLED and self._task is None:
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run_loop())
+            logger.info(f"图片生命周期管理已启动 | 间隔：{IMAGE_GC_INTERVAL}秒 | 仅统计：{IMAGE_GC_DRY_RUN}")
+
+    async def close(self) -> None:
+        """取消后台清理任务，不等待本轮清理完成；正在删除的文件释放删除标记后退出"""
+        if self._task is not None:
+            self._stopping.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run_loop(self) -> None:
+        while True:
+            try:
+                # 锁的有效期等于清理间隔，保证每个周期只有一个节点执行
+                if await redis_service.redis.set(LOCK_KEY, self._owner, nx=True, ex=int(IMAGE_GC_INTERVAL)):
+                    await self.run_once()
+            except Exception as e:
+                logger.error(f"图片清理出错：{str(e)}", exc_info=True)
+            await asyncio.sleep(IMAGE_GC_INTERVAL)
+
+    async def run_once(self, dry_run: Optional[bool] = None) -> Dict[str, Any]:
+        """执行一轮清理，返回本轮统计"""
+        dry_run = IMAGE_GC_DRY_RUN if dry_run is None else dry_run
+        started = time.time()
+        cutoff = started - TASK_TTL - IMAGE_GC_GRACE
+        summary = {"dry_run": dry_run, "scanned": 0, "kept": 0, "deleted": 0, "deleted_bytes": 0}
+
+        offset = 0
+        while summary["deleted"] < IMAGE_GC_MAX_DELETES:
+            keys = await redis_service.redis.zrangebyscore(
+                INVENTORY_KEY, "-inf", cutoff, start=offset, num=IMAGE_GC_BATCH_SIZE
+            )
+            if not keys:
+                break
+            for key in keys:
+                summary["scanned"] += 1
+                if not await self._claim(key, cutoff, dry_run):
+                    summary["kept"] += 1
+                    continue
+                if dry_run:
+                    summary["deleted"] += 1
+                    summary["deleted_bytes"] += await self._blob_bytes(key)
+                    continue
+                summary["deleted_bytes"] += await self._delete_blob(key)
+                summary["deleted"] += 1
+                await asyncio.sleep(1 / IMAGE_GC_DELETES_PER_SECOND)
+            # 仅统计时清单不变，需要翻页；实际删除时已处理的键都已移出范围
+            if dry_run:
+                offset += len(keys)
+            if len(keys) < IMAGE_GC_BATCH_SIZE:
+                break
+
+        # 平铺目录中的旧文件和中断上传的临时文件，目录扫描放在线程池中执行
+        summary["legacy_deleted"], summary["temp_deleted"] = await asyncio.to_thread(
+            self._sweep_local_files, started, dry_run
+        )
+        summary["elapsed"] = round(time.time() - started, 3)
+
+        await redis_service.redis.hset(STATS_KEY, mapping={
+            "last_run_at": int(started),
+            "last_run": json.dumps(summary),
+        })
+        if not dry_run:
+            pipe = redis_service.redis.pipeline()
+            pipe.hincrby(STATS_KEY, "deleted", summary["deleted"])
+            pipe.hincrby(STATS_KEY, "deleted_bytes", summary["deleted_bytes"])
+            pipe.hincrby(STATS_KEY, "legacy_deleted", summary["legacy_deleted"])
+            pipe.hincrby(STATS_KEY, "temp_deleted", summary["temp_deleted"])
+            await pipe.execute()
+
+        logger.info(f"图片清理完成 | {summary}")
+        return summary
+
+    async def _claim(self, key: str, cutoff: float, dry_run: bool) -> bool:
+        """删除前再次确认引用已经过期并加删除标记，返回是否可以删除
+
+        检查和加标记在同一个 Lua 脚本中原子完成，标记存在期间新的上传会等待删除完成后重新保存。
+        """
+        sha256 = os.path.basename(key).split(".", 1)[0]
+        return bool(await redis_service.redis.eval(
+            CLAIM_SCRIPT, 3, f"image_blob_refs:{sha256}", INVENTORY_KEY, f"{DELETING_PREFIX}:{key}",
+            key, cutoff, self._owner, DELETING_TTL, int(dry_run), time.time()
+        ))
+
+    def _related_keys(self, key: str):
+        """原图及其所有格式的衍生图"""
+        yield key
+        for _, extension in OUTPUT_FORMATS.values():
+            yield derivative_key(key, extension)
+
+    async def _blob_bytes(self, key: str) -> int:
+        sizes = await redis_service.redis.hmget(SIZES_KEY, list(self._related_keys(key)))
+        return sum(int(size) for size in sizes if size is not None)
+
+    async def _delete_blob(self, key: str) -> int:
+        """删除原图和衍生图并释放删除标记，返回释放的字节数"""
+        freed = 0
+        try:
+            for related in self._related_keys(key):
+                await blob_storage.delete(related)
+                memory_cache.pop(related)
+                freed += await image_store.forget_blob(related)
+        finally:
+            await redis_service.redis.eval(RELEASE_SCRIPT, 1, f"{DELETING_PREFIX}:{key}", self._owner)
+        return freed
+
+    def _sweep_local_files(self, now: float, dry_run: bool):
+        """清理平铺目录中超过有效期的旧上传和过期的临时文件，返回 (旧文件数, 临时文件数)"""
+        legacy_cutoff = now - TASK_TTL - IMAGE_GC_GRACE
+        temp_cutoff = now - IMAGE_GC_TEMP_MAX_AGE
+        legacy = self._sweep_directory(UPLOAD_DIR, legacy_cutoff, dry_run)
+        temp = self._sweep_directory(TMP_DIR, temp_cutoff, dry_run)
+        return legacy, temp
+
+    def _sweep_directory(self, directory: str, cutoff: float, dry_run: bool) -> int:
+        """删除目录第一层中修改时间早于 cutoff 的文件（不进入子目录），数量受单轮上限约束"""
+        count = 0
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            return 0
+        with entries:
+            for entry in entries:
+                if count >= IMAGE_GC_MAX_DELETES or self._stopping.is_set():
+                    break
+                try:
+                    if not entry.is_file(follow_symlinks=False) or entry.stat().st_mtime >= cutoff:
+                        continue
+                    if not dry_run:
+                        os.remove(entry.path)
+                        time.sleep(1 / IMAGE_GC_DELETES_PER_SECOND)
+                    count += 1
+                except FileNotFoundError:
+                    continue
+        return count
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """获取存储用量、清理统计和内存缓存命中率"""
+        cutoff = time.time() - TASK_TTL - IMAGE_GC_GRACE
+        pipe = redis_service.redis.pipeline()
+        pipe.hgetall(USAGE_KEY)
+        pipe.zcard(INVENTORY_KEY)
+        pipe.zcount(INVENTORY_KEY, "-inf", cutoff)
+        pipe.hgetall(STATS_KEY)
+        usage, tracked, expired, stats = await pipe.execute()
+        return {
+            "stored_files": int(usage.get("files", 0)),
+            "stored_bytes": int(usage.get("bytes", 0)),
+            "tracked_blobs": tracked,
+            "expired_blobs": expired,
+            "deleted": int(stats.get("deleted", 0)),
+            "deleted_bytes": int(stats.get("deleted_bytes", 0)),
+            "legacy_deleted": int(stats.get("legacy_deleted", 0)),
+            "temp_deleted": int(stats.get("temp_deleted", 0)),
+            "last_run_at": int(stats["last_run_at"]) if "last_run_at" in stats else None,
+            "last_run": json.loads(stats["last_run"]) if "last_run" in stats else None,
+            "dry_run": IMAGE_GC_DRY_RUN,
+            # 当前进程的图片内存缓存
+            "memory_cache": memory_cache.get_stats(),
+        }
+
+
+# 创建全局图片生命周期管理实例
+image_lifecycle = ImageLifecycleManager()
@@ -0,0 +1,184 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
+import aiofiles
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service
+from services.image_store import image_store, derivative_key
+from services.blob_storage import blob_storage
+from utils.image_preprocess import preprocess_image, OUTPUT_FORMATS
+from utils.image_quality import check_image_quality
+from utils.image_format import ImageSource
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 预处理配置
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "true").lower() == "true"
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", "2"))  # 进程池大小
+IMAGE_PREPROCESS_TIMEOUT = float(os.getenv("IMAGE_PREPROCESS_TIMEOUT", "10"))  # 单张图片处理超时（秒）
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1600"))  # 最长边像素
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "true").lower() == "true"  # 是否转为灰度
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG").upper()  # JPEG 或 WEBP
+IMAGE_OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "80"))  # 编码质量
+IMAGE_AUTO_CROP = os.getenv("IMAGE_AUTO_CROP", "true").lower() == "true"  # 是否自动裁剪到题目区域
+
+# 上传质量检查阈值，不达标的图片直接拒绝，不预扣费也不占用上游
+IMAGE_QUALITY_GATE_ENABLED = os.getenv("IMAGE_QUALITY_GATE_ENABLED", "true").lower() == "true"
+IMAGE_MIN_EDGE = int(os.getenv("IMAGE_MIN_EDGE", "240"))  # 短边最少像素
+IMAGE_MIN_BRIGHTNESS = float(os.getenv("IMAGE_MIN_BRIGHTNESS", "25"))  # 最低平均亮度（0-255），反差足够时不限制
+IMAGE_MIN_CONTRAST = float(os.getenv("IMAGE_MIN_CONTRAST", "40"))  # 平均亮度过低时要求的最低反差（0-255）
+IMAGE_MIN_SHARPNESS = float(os.getenv("IMAGE_MIN_SHARPNESS", "30"))  # 拉普拉斯方差下限
+
+STATS_KEY = "image_pipeline:stats"
+
+
+class ImagePipeline:
+    """上传图片预处理管道
+
+    图片解码和重新编码是 CPU 密集操作，在独立的进程池中执行，不占用事件循环和 GIL。
+    生成的衍生图缓存在原图旁边，记录在图片元数据中，解题时优先发送衍生图；
+    相同内容的图片共用同一份衍生图，不重复处理。
+    """
+
+    def __init__(self):
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self) -> None:
+        """创建进程池，由 FastAPI lifespan 调用"""
+        if IMAGE_PREPROCESS_ENABLED and self._executor is None:
+            if IMAGE_OUTPUT_FORMAT not in OUTPUT_FORMATS:
+                raise ValueError(f"不支持的预处理输出格式：{IMAGE_OUTPUT_FORMAT}")
+            self._executor = ProcessPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS)
+            logger.info(
+                f"图片预处理进程池已创建 | 进程数：{IMAGE_PREPROCESS_WORKERS} | 最长边：{IMAGE_MAX_EDGE} | "
+                f"格式：{IMAGE_OUTPUT_FORMAT} | 质量：{IMAGE_OUTPUT_QUALITY} | 灰度：{IMAGE_GRAYSCALE} | "
+                f"自动裁剪：{IMAGE_AUTO_CROP}"
+            )
+
+    def close(self) -> None:
+        """关闭进程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def check_quality(self, filename: str, source: ImageSource) -> Optional[Dict[str, Any]]:
+        """上传质量检查，在缩小的灰度图上计算，耗时只有几毫秒，在线程池中执行
+
+        通过时返回 None，否则返回拒绝原因、提示和指标
+        """
+        if not IMAGE_QUALITY_GATE_ENABLED:
+            return None
+
+        rejection = await asyncio.to_thread(
+            check_image_quality, source, IMAGE_MIN_EDGE, IMAGE_MIN_BRIGHTNESS, IMAGE_MIN_SHARPNESS,
+            IMAGE_MIN_CONTRAST
+        )
+        if rejection is not None:
+            logger.info(f"图片质量不达标 | 文件：{filename} | 原因：{rejection['reason']} | 指标：{rejection['metrics']}")
+            await redis_service.redis.hincrby(STATS_KEY, f"rejected:{rejection['reason']}", 1)
+        return rejection
+
+    async def process_upload(self, filename: str, source: ImageSource, key: str) -> Optional[Dict[str, Any]]:
+        """为存储键 key 对应的原图生成衍生图并写入元数据，返回写入的元数据；未启用或失败时返回 None，继续使用原图
+
+        传入已保存的文件路径时由子进程读取文件，避免在进程间传递整张图片
+        """
+        if self._executor is None:
+            return None
+
+        # 相同内容之前已经处理过时直接复用衍生图
+        output_mime, output_extension = OUTPUT_FORMATS[IMAGE_OUTPUT_FORMAT]
+        derivative = derivative_key(key, output_extension)
+        if await blob_storage.exists(derivative):
+            meta = {"derivative": derivative, "derivative_mime": output_mime}
+            await redis_service.set_image_meta(filename, meta)
+            await redis_service.redis.hincrby(STATS_KEY, "reused", 1)
+            return meta
+
+        try:
+            loop = asyncio.get_running_loop()
+            output, info = await asyncio.wait_for(
+                loop.run_in_executor(
+                    self._executor, preprocess_image, source,
+                    IMAGE_MAX_EDGE, IMAGE_GRAYSCALE, IMAGE_OUTPUT_FORMAT, IMAGE_OUTPUT_QUALITY,
+                    IMAGE_AUTO_CROP
+                ),
+                timeout=IMAGE_PREPROCESS_TIMEOUT
+            )
+        except Exception as e:
+            logger.warning(f"图片预处理失败 | 文件：{filename} | 原因：{str(e)}")
+            await redis_service.redis.hincrby(STATS_KEY, "failed", 1)
+            return None
+
+        meta = {"original_bytes": info["original_bytes"]}
+        if output is None:
+            # 原图已经足够小，重新编码反而更大
+            await redis_service.redis.hincrby(STATS_KEY, "skipped", 1)
+            await redis_service.set_image_meta(filename, meta)
+            return meta
+
+        # 先写临时文件再保存到存储后端，并发处理相同内容时不会读到写了一半的衍生图
+        temp_path = image_store.new_temp_path()
+        async with aiofiles.open(temp_path, mode='wb') as f:
+            await f.write(output)
+        await blob_storage.put_file(derivative, temp_path)
+        await image_store.record_blob(derivative, info["output_bytes"])
+        # 紧接着的解题请求直接从内存读取衍生图
+        image_store.cache_bytes(derivative, output)
+
+        meta.update(
+            derivative=derivative,
+            derivative_mime=info["mime_type"],
+            derivative_bytes=info["output_bytes"],
+        )
+        await redis_service.set_image_meta(filename, meta)
+
+        pipe = redis_service.redis.pipeline()
+        pipe.hincrby(STATS_KEY, "processed", 1)
+        pipe.hincrby(STATS_KEY, "original_bytes", info["original_bytes"])
+        pipe.hincrby(STATS_KEY, "output_bytes", info["output_bytes"])
+        if info.get("crop_box"):
+            pipe.hincrby(STATS_KEY, "cropped", 1)
+        await pipe.execute()
+
+        logger.info(
+            f"图片预处理完成 | 文件：{filename} | 尺寸：{info['original_size']} -> {info['output_size']} | "
+            f"裁剪：{info.get('crop_box')} | "
+            f"字节数：{info['original_bytes']} -> {info['output_bytes']}"
+        )
+        return meta
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """获取预处理统计：处理数量、节省的字节数和质量检查拒绝数"""
+        stats = await redis_service.redis.hgetall(STATS_KEY)
+        original_bytes = int(stats.get("original_bytes", 0))
+        output_bytes = int(stats.get("output_bytes", 0))
+        saved = original_bytes - output_bytes
+        rejected = {
+            field.split(":", 1)[1]: int(value)
+            for field, value in stats.items() if field.startswith("rejected:")
+        }
+        return {
+            "enabled": self._executor is not None,
+            "processed": int(stats.get("processed", 0)),
+            "cropped": int(stats.get("cropped", 0)),
+            "reused": int(stats.get("reused", 0)),
+            "skipped": int(stats.get("skipped", 0)),
+            "failed": int(stats.get("failed", 0)),
+            "original_bytes": original_bytes,
+            "output_bytes": output_bytes,
+            "bytes_saved": saved,
+            "saved_ratio": saved / original_bytes if original_bytes else 0.0,
+            "rejected": rejected,
+        }
+
+
+# 创建全局图片预处理管道实例
+image_pipeline = ImagePipeline()
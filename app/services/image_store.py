@@ -0,0 +1,224 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import aiofiles
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service, TASK_TTL
+from services.blob_storage import blob_storage
+from utils.byte_lru_cache import ByteLRUCache
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploaded_images")
+# 上传过程中的临时文件，与本地存储和缓存目录在同一文件系统上，完成后原子重命名
+TMP_DIR = os.path.join(UPLOAD_DIR, "tmp")
+
+# 进程内最近使用的图片字节缓存：上传后几秒内就会提交并开始解题，命中时不需要再读磁盘或对象存储
+IMAGE_MEMORY_CACHE_BYTES = int(os.getenv("IMAGE_MEMORY_CACHE_BYTES", str(64 * 1024 * 1024)))  # 内存预算，0 表示关闭
+IMAGE_MEMORY_CACHE_MAX_ITEM = int(os.getenv("IMAGE_MEMORY_CACHE_MAX_ITEM", str(4 * 1024 * 1024)))  # 单张图片上限
+
+# 存储内容清单：存储键 -> 最近一次被引用的时间，供生命周期管理清理无人引用的文件
+INVENTORY_KEY = "image_blobs"
+# 存储键 -> 文件字节数（包括衍生图）
+SIZES_KEY = "image_blob_sizes"
+# 存储用量统计
+USAGE_KEY = "image_storage:usage"
+# 生命周期管理正在删除的存储键：image_gc:deleting:{存储键}，持有期间不能标记引用
+DELETING_PREFIX = "image_gc:deleting"
+
+# 删除标记不存在时才更新引用时间，与生命周期管理的检查和加锁互斥
+MARK_REFERENCED_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+return 1
+"""
+
+# 图片类型对应的扩展名，同一内容始终使用相同的文件名
+MIME_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/bmp": ".bmp",
+    "image/tiff": ".tiff",
+    "image/webp": ".webp",
+    "image/x-icon": ".ico",
+    "image/x-icns": ".icns",
+    "image/x-sgi": ".sgi",
+    "image/jp2": ".jp2",
+}
+
+
+def blob_key(sha256: str, extension: str) -> str:
+    """内容哈希对应的存储键，前两级目录取哈希的前4个字符，单个目录下的文件数保持在可控范围"""
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}"
+
+
+def derivative_key(key: str, extension: str) -> str:
+    """衍生图与原图放在同一分片目录，键为 {原图键去掉扩展名}.vlm{扩展名}"""
+    return f"{os.path.splitext(key)[0]}.vlm{extension}"
+
+
+class ImageStore:
+    """按内容寻址的图片存储
+
+    - 图片文件按 SHA-256 存放在两级分片目录（ab/cd/abcd....jpg）中，相同内容只保存一份；
+      实际存储由 blob_storage 后端负责（本地目录或 S3 兼容对象存储）
+    - 每次上传生成一个上传ID（即 /images/{上传ID} 中的文件名），
+      在 Redis 中记录一条轻量的引用（用户、内容哈希、类型等），与任务同样24小时过期
+    - 每个内容哈希维护一个引用集合，最后一个引用过期后集合随之过期，便于清理无人引用的文件
+    - 提交任务时延长引用的有效期，图片至少保留到任务过期
+    """
+
+    @staticmethod
+    async def local_path(key: str) -> Optional[str]:
+        """存储键对应的本地文件路径，对象存储时从本地缓存读取或先下载；不存在时返回 None"""
+        try:
+            return await blob_storage.local_path(key)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def new_temp_path() -> str:
+        """生成上传用的临时文件路径"""
+        os.makedirs(TMP_DIR, exist_ok=True)
+        return os.path.join(TMP_DIR, f"{uuid.uuid4().hex}.part")
+
+    @staticmethod
+    def new_upload_id(mime_type: str) -> str:
+        """生成上传ID，保留扩展名便于客户端识别类型"""
+        return f"{uuid.uuid4()}{MIME_EXTENSIONS.get(mime_type, '')}"
+
+    @staticmethod
+    async def commit(temp_path: str, sha256: str, mime_type: str) -> Tuple[str, bool]:
+        """把上传完成的临时文件保存到内容哈希对应的位置
+
+        返回 (存储键, 是否已存在)。内容已存在时直接删除临时文件，不重复保存。
+        """
+        key = blob_key(sha256, MIME_EXTENSIONS.get(mime_type, ""))
+        # 先更新引用时间再检查是否存在，避免生命周期管理在两步之间删除已存在的文件
+        await ImageStore.mark_referenced(key)
+        if await blob_storage.exists(key):
+            os.remove(temp_path)
+            return key, True
+
+        size = os.path.getsize(temp_path)
+        await blob_storage.put_file(key, temp_path)
+        await ImageStore.record_blob(key, size)
+        return key, False
+
+    @staticmethod
+    async def mark_referenced(key: str) -> None:
+        """更新存储内容最近一次被引用的时间
+
+        生命周期管理正在删除该内容时等待删除完成，之后由调用方重新保存，
+        不会出现刚确认文件存在、随即被删除的情况。
+        """
+        while not await redis_service.redis.eval(
+            MARK_REFERENCED_SCRIPT, 2, INVENTORY_KEY, f"{DELETING_PREFIX}:{key}", time.time(), key
+        ):
+            await asyncio.sleep(0.05)
+
+    @staticmethod
+    async def record_blob(key: str, size: int) -> None:
+        """记录新保存文件的大小，计入存储用量"""
+        if await redis_service.redis.hset(SIZES_KEY, key, size):
+            pipe = redis_service.redis.pipeline()
+            pipe.hincrby(USAGE_KEY, "files", 1)
+            pipe.hincrby(USAGE_KEY, "bytes", size)
+            await pipe.execute()
+
+    @staticmethod
+    async def forget_blob(key: str) -> int:
+        """文件删除后移出清单并扣减存储用量，返回文件大小"""
+        size = await redis_service.redis.hget(SIZES_KEY, key)
+        pipe = redis_service.redis.pipeline()
+        pipe.zrem(INVENTORY_KEY, key)
+        pipe.hdel(SIZES_KEY, key)
+        if size is not None:
+            pipe.hincrby(USAGE_KEY, "files", -1)
+            pipe.hincrby(USAGE_KEY, "bytes", -int(size))
+        await pipe.execute()
+        return int(size or 0)
+
+    @staticmethod
+    async def add_reference(upload_id: str, user_id: str, key: str, meta: Dict[str, Any]) -> None:
+        """记录一次上传对存储内容的引用"""
+        sha256 = meta["sha256"]
+        await redis_service.set_image_meta(upload_id, {
+            **meta,
+            "blob": key,
+            "user_id": user_id,
+            "created_at": int(time.time()),
+        })
+        refs_key = f"image_blob_refs:{sha256}"
+        pipe = redis_service.redis.pipeline()
+        pipe.sadd(refs_key, upload_id)
+        pipe.expire(refs_key, TASK_TTL)
+        pipe.zadd(INVENTORY_KEY, {key: time.time()})
+        await pipe.execute()
+
+    @staticmethod
+    async def touch_reference(upload_id: str) -> None:
+        """任务引用上传图片时调用，把引用的有效期延长到与任务相同"""
+        upload_id = os.path.basename(upload_id)
+        meta = await ImageStore.get_reference(upload_id)
+        if not meta.get("blob"):
+            return
+        pipe = redis_service.redis.pipeline()
+        pipe.expire(f"image_meta:{upload_id}", TASK_TTL)
+        pipe.sadd(f"image_blob_refs:{meta['sha256']}", upload_id)
+        pipe.expire(f"image_blob_refs:{meta['sha256']}", TASK_TTL)
+        pipe.zadd(INVENTORY_KEY, {meta["blob"]: time.time()})
+        await pipe.execute()
+
+    @staticmethod
+    def cache_bytes(key: str, content: bytes) -> None:
+        """把刚生成或读取的图片放入内存缓存"""
+        memory_cache.put(key, content)
+
+    @staticmethod
+    async def read_bytes(key: str) -> Optional[bytes]:
+        """读取存储键对应的图片内容，先查内存缓存；不存在时返回 None"""
+        content = memory_cache.get(key)
+        if content is not None:
+            return content
+        path = await ImageStore.local_path(key)
+        if path is None:
+            return None
+        async with aiofiles.open(path, "rb") as f:
+            content = await f.read()
+        memory_cache.put(key, content)
+        return content
+
+    @staticmethod
+    async def get_reference(upload_id: str) -> Dict[str, str]:
+        """获取上传引用，不存在时返回空字典"""
+        return await redis_service.get_image_meta(upload_id)
+
+    @staticmethod
+    async def resolve(upload_id: str) -> Optional[str]:
+        """把上传ID解析为本地文件路径
+
+        没有存储键的旧上传仍按原来的平铺目录查找。文件不存在时返回 None。
+        """
+        upload_id = os.path.basename(upload_id)
+        meta = await ImageStore.get_reference(upload_id)
+        key = meta.get("blob")
+        if key:
+            return await ImageStore.local_path(key)
+        path = os.path.join(UPLOAD_DIR, upload_id)
+        return path if os.path.isfile(path) else None
+
+
+# 创建全局图片内存缓存和图片存储实例，存储内容按哈希寻址、不会变化，缓存不需要失效
+memory_cache = ByteLRUCache(IMAGE_MEMORY_CACHE_BYTES, IMAGE_MEMORY_CACHE_MAX_ITEM)
+image_store = ImageStore()
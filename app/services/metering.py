@@ -0,0 +1,257 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy.exc import DataError, IntegrityError
+
+from models.usage_record import UsageRecord
+from services.task_metrics import normalize_language
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 按用量计费的费率表（JSON），价格单位为 元/千token，键为模型名（精确匹配优先，其次最长前缀），
+# default 用于未列出的模型，例如：
+# {"default": {"prompt": 0.003, "completion": 0.009, "image": 0.003, "minimum": 0.05}}
+# image 省略时与 prompt 相同；没有匹配的费率（默认为空表）时仍按固定费用收费，但照常记录用量
+VLM_RATE_TABLE = os.getenv("VLM_RATE_TABLE", "")
+# 用量记录批量写入数据库：攒够条数或到达时间间隔（秒）时写入一次
+VLM_USAGE_BATCH_SIZE = int(os.getenv("VLM_USAGE_BATCH_SIZE", "100"))
+VLM_USAGE_FLUSH_INTERVAL = float(os.getenv("VLM_USAGE_FLUSH_INTERVAL", "5"))
+# 数据库不可用时内存中最多保留的记录数，超过后丢弃最早的记录
+VLM_USAGE_BUFFER_MAX = int(os.getenv("VLM_USAGE_BUFFER_MAX", "10000"))
+
+# 用量来源
+SOURCE_UPSTREAM = "upstream"  # 调用了上游模型
+SOURCE_SINGLE_FLIGHT = "single_flight"  # 跟随相同任务的结果，token 为领导者的用量
+SOURCE_ANSWER_CACHE = "answer_cache"  # 答案缓存命中，没有 token 用量
+
+CENT = Decimal("0.01")
+# 上游返回的模型名按列宽截断
+MODEL_MAX_LENGTH = UsageRecord.__table__.c.model.type.length
+
+
+class Rate(NamedTuple):
+    """单个模型的费率（元/千token）"""
+    prompt: float
+    completion: float
+    image: float
+    minimum: float  # 单次最低收费
+
+
+def load_rate_table(raw: str) -> Dict[str, Rate]:
+    """解析费率表，格式错误时记录日志并返回空表（回退到固定收费）"""
+    if not raw.strip():
+        return {}
+    try:
+        table = {}
+        for model, config in json.loads(raw).items():
+            prompt = float(config.get("prompt", 0))
+            table[model] = Rate(
+                prompt=prompt,
+                completion=float(config.get("completion", 0)),
+                image=float(config.get("image", prompt)),
+                minimum=float(config.get("minimum", 0)),
+            )
+        return table
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.error(f"VLM_RATE_TABLE 格式错误，按固定费用收费：{str(e)}")
+        return {}
+
+
+class Metering:
+    """按 token 用量计价，并把每个任务的用量批量写入 usage_records 表
+
+    用量记录先放在内存缓冲区，由后台任务攒批后在线程池中一次写入，不在生成路径上访问数据库。
+    """
+
+    def __init__(
+        self,
+        rates: Optional[Dict[str, Rate]] = None,
+        batch_size: int = VLM_USAGE_BATCH_SIZE,
+        flush_interval: float = VLM_USAGE_FLUSH_INTERVAL
+    ):
+        self.rates = load_rate_table(VLM_RATE_TABLE) if rates is None else rates
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: List[Dict[str, Any]] = []
+        self._wakeup = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def rate_for(self, model: Optional[str]) -> Optional[Rate]:
+        """模型对应的费率，上游返回的模型名可能带版本后缀，因此支持前缀匹配"""
+        if model:
+            if model in self.rates:
+                return self.rates[model]
+            prefixes = [name for name in self.rates if name != "default" and model.startswith(name)]
+            if prefixes:
+                return self.rates[max(prefixes, key=len)]
+        return self.rates.get("default")
+
+    def price(
+        self,
+        usage: Optional[Dict[str, int]],
+        model: Optional[str],
+        fallback: float,
+        cap: Optional[float] = None
+    ) -> float:
+        """按用量计算费用（四舍五入到分）
+
+        没有用量或没有对应费率时返回 fallback；cap 为预扣金额，实际收费不超过预扣的部分。
+        """
+        rate = self.rate_for(model)
+        if rate is None or not usage:
+            return fallback
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        # 图片 token 包含在 prompt_tokens 中，单独按图片费率计价
+        image_tokens = min(usage.get("image_tokens", 0), prompt_tokens)
+        cost = (
+            (prompt_tokens - image_tokens) * rate.prompt
+            + image_tokens * rate.image
+            + usage.get("completion_tokens", 0) * rate.completion
+        ) / 1000
+        amount = Decimal(str(max(cost, rate.minimum))).quantize(CENT, rounding=ROUND_HALF_UP)
+        if cap is not None:
+            amount = min(amount, Decimal(str(cap)))
+        return float(amount)
+
+    def record(
+        self,
+        task_id: str,
+        user_id: str,
+        source: str,
+        status: str,
+        amount: float,
+        usage: Optional[Dict[str, int]] = None,
+        model: Optional[str] = None,
+        programming_language: Optional[str] = None,
+        image_bytes: Optional[int] = None
+    ) -> None:
+        """登记一个任务的用量和实际收费，由后台任务批量写入
+
+        编程语言由用户输入、模型名来自上游响应，写入前归一化和截断，不会因为超出列宽导致整批写入失败。
+        """
+        usage = usage or {}
+        self._buffer.append({
+            "task_id": task_id,
+            "user_id": int(user_id),
+            "model": model[:MODEL_MAX_LENGTH] if model else model,
+            "source": source,
+            "programming_language": normalize_language(programming_language),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+            "image_tokens": usage.get("image_tokens"),
+            "cached_tokens": usage.get("cached_tokens"),
+            "total_tokens": usage.get("total_tokens"),
+            "image_bytes": image_bytes,
+            "amount": Decimal(str(amount)).quantize(CENT, rounding=ROUND_HALF_UP),
+            "status": status,
+            "created_at": datetime.utcnow(),
+        })
+        self._trim()
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _trim(self) -> None:
+        overflow = len(self._buffer) - VLM_USAGE_BUFFER_MAX
+        if overflow > 0:
+            del self._buffer[:overflow]
+            logger.warning(f"用量记录积压过多，丢弃最早的 {overflow} 条")
+
+    def start(self) -> None:
+        """启动批量写入，由 FastAPI lifespan 和 worker 调用"""
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """停止后台任务，并写入剩余的记录"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> int:
+        """写入缓冲区中的全部记录，返回写入条数
+
+        数据库拒绝记录（数据或约束错误）时二分查找并丢弃无法写入的记录，其余照常写入；
+        其他错误（例如数据库不可用）时放回缓冲区等待下次写入。
+        """
+        if not self._buffer:
+            return 0
+        batch, self._buffer = self._buffer, []
+        written: List[Dict[str, Any]] = []
+        try:
+            try:
+                await asyncio.to_thread(self._write, batch)
+                return len(batch)
+            except (DataError, IntegrityError) as e:
+                rejected: List[Dict[str, Any]] = []
+                await asyncio.to_thread(self._isolate, batch, written, rejected)
+                logger.error(
+                    f"用量记录被数据库拒绝，已丢弃 | 任务：{[record['task_id'] for record in rejected]} | "
+                    f"原因：{str(e.orig)}"
+                )
+                return len(written)
+        except Exception as e:
+            logger.error(f"用量记录写入失败，稍后重试 | 条数：{len(batch) - len(written)} | 原因：{str(e)}")
+            written_ids = {id(record) for record in written}
+            self._buffer = [record for record in batch if id(record) not in written_ids] + self._buffer
+            self._trim()
+            return len(written)
+
+    def _isolate(
+        self,
+        batch: List[Dict[str, Any]],
+        written: List[Dict[str, Any]],
+        rejected: List[Dict[str, Any]]
+    ) -> None:
+        """把被拒绝的批次二分后分别写入，直到找出单条无法写入的记录"""
+        if len(batch) == 1:
+            rejected.extend(batch)
+            return
+        middle = len(batch) // 2
+        for part in (batch[:middle], batch[middle:]):
+            try:
+                self._write(part)
+                written.extend(part)
+            except (DataError, IntegrityError):
+                self._isolate(part, written, rejected)
+
+    @staticmethod
+    def _write(batch: List[Dict[str, Any]]) -> None:
+        # 只在写入时连接数据库，导入本模块不需要配置 DATABASE_URL
+        from utils.database import SessionLocal
+
+        db = SessionLocal()
+        try:
+            db.bulk_insert_mappings(UsageRecord, batch)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+# 创建全局计量实例
+metering = Metering()
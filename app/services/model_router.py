@@ -0,0 +1,259 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import AsyncExitStack
+from typing import Any, AsyncGenerator, Dict, List, NamedTuple, Optional
+
+import openai
+from dotenv import load_dotenv
+
+from services.vlm_client import vlm_client_manager, VLMBackend
+from services.distributed_semaphore import vlm_semaphore
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 对冲请求配置
+VLM_HEDGE_ENABLED = os.getenv("VLM_HEDGE_ENABLED", "true").lower() == "true"
+VLM_HEDGE_DELAY = float(os.getenv("VLM_HEDGE_DELAY", "3"))  # 首个token的延迟预算（秒），超过后向下一个后端发起对冲请求
+VLM_HEDGE_MAX_ATTEMPTS = int(os.getenv("VLM_HEDGE_MAX_ATTEMPTS", "2"))  # 同时进行的请求数上限
+# 延迟统计的指数移动平均系数，越大越偏向最近的请求
+VLM_LATENCY_EWMA_ALPHA = float(os.getenv("VLM_LATENCY_EWMA_ALPHA", "0.2"))
+# 错误率对排序的影响：得分 = 平均首token延迟 × (1 + 系数 × 错误率)
+VLM_ERROR_PENALTY = float(os.getenv("VLM_ERROR_PENALTY", "4"))
+
+
+def is_retryable(error: BaseException) -> bool:
+    """限流、上游 5xx 和连接错误可以换一个后端重试"""
+    if isinstance(error, openai.APIConnectionError):  # 包括超时
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class BackendStats:
+    """单个后端的延迟和错误统计（进程内）"""
+
+    def __init__(self):
+        self.ttft: Optional[float] = None  # 首个token延迟的移动平均（秒）
+        self.error_rate = 0.0  # 错误率的移动平均
+        self.requests = 0
+        self.failures = 0
+        self.hedges = 0  # 作为对冲请求发起的次数
+        self.wins = 0  # 最先产出首个token并被采用的次数
+        self.last_error: Optional[str] = None
+
+    def observe_latency(self, seconds: float) -> None:
+        if self.ttft is None:
+            self.ttft = seconds
+        else:
+            self.ttft += VLM_LATENCY_EWMA_ALPHA * (seconds - self.ttft)
+
+    def observe_result(self, failed: bool) -> None:
+        self.error_rate += VLM_LATENCY_EWMA_ALPHA * ((1.0 if failed else 0.0) - self.error_rate)
+
+    def score(self) -> float:
+        """排序得分，越小越优先
+
+        还没有延迟样本的后端按延迟预算 VLM_HEDGE_DELAY 估计，错误率仍然生效：
+        连接即失败的后端永远没有延迟样本，不能因此一直排在最前面。
+        """
+        ttft = VLM_HEDGE_DELAY if self.ttft is None else self.ttft
+        return ttft * (1 + VLM_ERROR_PENALTY * self.error_rate)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "ttft_ms": round(self.ttft * 1000, 1) if self.ttft is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "failures": self.failures,
+            "hedges": self.hedges,
+            "wins": self.wins,
+            "last_error": self.last_error,
+        }
+
+
+class _Attempt(NamedTuple):
+    """已经收到首个token的上游流式响应"""
+    backend: VLMBackend
+    stream: Any
+    iterator: Any
+    buffered: List[Any]  # 首个token之前和首个token所在的分片
+
+
+class ModelRouter:
+    """在多个上游后端之间路由流式请求
+
+    - 按首个token延迟和错误率的移动平均排序后端，优先使用最快、最稳定的后端
+    - 延迟预算内没有收到首个token时，向下一个后端发起对冲请求，采用先产出的一方并取消另一方；
+      对冲请求另外占用一个上游并发许可，没有空闲许可时不对冲
+    - 在输出任何内容之前遇到限流、5xx 或连接错误时，切换到下一个后端
+    统计只保存在进程内，每个进程根据自己观测到的延迟路由。
+    """
+
+    def __init__(self):
+        self._stats: Dict[str, BackendStats] = {}
+
+    def _stats_for(self, backend: VLMBackend) -> BackendStats:
+        return self._stats.setdefault(backend.name, BackendStats())
+
+    def ranked_backends(self) -> List[VLMBackend]:
+        """按得分排序的后端，得分相同时保持配置顺序"""
+        return sorted(vlm_client_manager.backends, key=lambda backend: self._stats_for(backend).score())
+
+    async def stream(
+        self,
+        messages: List[Dict[str, Any]],
+        user_id: str = "anonymous",
+        **kwargs
+    ) -> AsyncGenerator[Any, None]:
+        """发起流式 ChatCompletion 请求，产出上游分片；所有后端都失败时抛出最后一个错误
+
+        调用方需要已经持有 user_id 的一个上游并发许可，对冲请求的许可由路由自己获取。
+        """
+        attempt = await self._race(messages, kwargs, user_id)
+        try:
+            for chunk in attempt.buffered:
+                yield chunk
+            async for chunk in attempt.iterator:
+                yield chunk
+            self._stats_for(attempt.backend).observe_result(failed=False)
+        except Exception as e:
+            self._record_failure(attempt.backend, e)
+            raise
+        finally:
+            await attempt.stream.close()
+
+    async def _race(self, messages: List[Dict[str, Any]], kwargs: Dict[str, Any], user_id: str) -> _Attempt:
+        """依次启动后端，返回最先收到首个token的一个"""
+        candidates = self.ranked_backends()
+        pending: Dict[asyncio.Task, VLMBackend] = {}
+        started: Dict[asyncio.Task, float] = {}
+        last_error: Optional[BaseException] = None
+        # 对冲请求占用的许可，竞争结束时释放（胜出的请求改由调用方的许可覆盖）
+        hedge_permits = AsyncExitStack()
+
+        async def acquire_hedge_permit() -> bool:
+            """不排队地尝试获取一个额外的上游并发许可"""
+            lease_id = vlm_semaphore.new_lease_id()
+            try:
+                if await vlm_semaphore.try_acquire(user_id, lease_id) == 0:
+                    await hedge_permits.enter_async_context(vlm_semaphore.hold(user_id, lease_id))
+                    return True
+                # 没有空闲许可时 try_acquire 会加入排队，退出队列
+                await vlm_semaphore.release(user_id, lease_id)
+            except Exception as e:
+                logger.warning(f"获取对冲许可失败：{str(e)}")
+            return False
+
+        def launch(hedge: bool) -> None:
+            backend = candidates.pop(0)
+            stats = self._stats_for(backend)
+            stats.requests += 1
+            if hedge:
+                stats.hedges += 1
+                logger.info(f"首个token超过延迟预算，发起对冲请求 | 后端：{backend.name}")
+            task = asyncio.create_task(self._first_token(backend, messages, kwargs))
+            pending[task] = backend
+            started[task] = time.monotonic()
+
+        launch(hedge=False)
+        winner: Optional[_Attempt] = None
+        try:
+            while winner is None:
+                can_hedge = VLM_HEDGE_ENABLED and candidates and len(pending) < VLM_HEDGE_MAX_ATTEMPTS
+                done, _ = await asyncio.wait(
+                    pending, timeout=VLM_HEDGE_DELAY if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    if await acquire_hedge_permit():
+                        launch(hedge=True)
+                    else:
+                        logger.info("首个token超过延迟预算，但没有空闲的上游并发许可，暂不对冲")
+                    continue
+
+                for task in done:
+                    backend = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        attempt = task.result()
+                        if winner is None:
+                            winner = attempt
+                            stats = self._stats_for(backend)
+                            stats.observe_latency(time.monotonic() - started[task])
+                            stats.wins += 1
+                        else:
+                            # 同时收到首个token，只保留一个
+                            await attempt.stream.close()
+                        continue
+                    self._record_failure(backend, error)
+                    if not is_retryable(error):
+                        raise error
+                    last_error = error
+                    logger.warning(f"上游请求失败，切换后端 | 后端：{backend.name} | 原因：{str(error)}")
+
+                if winner is None and not pending:
+                    if not candidates:
+                        raise last_error
+                    launch(hedge=False)
+            return winner
+        finally:
+            # 取消落后的请求；它们至少已经等待了这么久，作为延迟样本使后续路由避开慢的后端
+            for task, backend in pending.items():
+                task.cancel()
+                self._stats_for(backend).observe_latency(time.monotonic() - started[task])
+            try:
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+            finally:
+                await hedge_permits.aclose()
+
+    async def _first_token(
+        self,
+        backend: VLMBackend,
+        messages: List[Dict[str, Any]],
+        kwargs: Dict[str, Any]
+    ) -> _Attempt:
+        """发起请求并读取到第一个带内容的分片（或结束分片）为止"""
+        client = vlm_client_manager.get_client(backend.name)
+        stream = await client.chat.completions.create(
+            model=backend.model, messages=messages, stream=True, **kwargs
+        )
+        try:
+            iterator = stream.__aiter__()
+            buffered = []
+            async for chunk in iterator:
+                buffered.append(chunk)
+                # 第一个分片通常只有角色信息，等到真正的内容再算首个token
+                if not chunk.choices or chunk.choices[0].delta.content:
+                    break
+            return _Attempt(backend, stream, iterator, buffered)
+        except BaseException:
+            await stream.close()
+            raise
+
+    def _record_failure(self, backend: VLMBackend, error: BaseException) -> None:
+        stats = self._stats_for(backend)
+        stats.failures += 1
+        stats.last_error = str(error)
+        stats.observe_result(failed=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各后端的延迟、错误率和对冲统计，按当前路由顺序排列"""
+        return {
+            "hedge_enabled": VLM_HEDGE_ENABLED,
+            "hedge_delay": VLM_HEDGE_DELAY,
+            "backends": [
+                {"name": backend.name, "model": backend.model, **self._stats_for(backend).to_dict()}
+                for backend in self.ranked_backends()
+            ],
+        }
+
+
+# 创建全局模型路由实例
+model_router = ModelRouter()
@@ -8,6 +8,9 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# 任务及其关联数据的过期时间（秒）
+TASK_TTL = 24 * 60 * 60
+
 class RedisService:
     def __init__(self):
         # 使用环境变量中配置的 Redis URL，包含密码
@@ -43,7 +46,7 @@ class RedisService:
         })
         await self.redis.set(f"task:{task_id}", json.dumps(task_data))
         # 设置24小时过期
-        await self.redis.expire(f"task:{task_id}", 24 * 60 * 60)
+        await self.redis.expire(f"task:{task_id}", TASK_TTL)
 
     async def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
         """获取任务信息"""
@@ -66,6 +69,16 @@ class RedisService:
         await self.redis.set(f"task:{task_id}", json.dumps(task_data))
         return True
 
+    async def update_task_fields(self, task_id: str, fields: Dict[str, Any]) -> bool:
+        """更新任务的其他字段（例如性能指标），保留过期时间"""
+        task_data = await self.get_task(task_id)
+        if not task_data:
+            return False
+
+        task_data.update(fields)
+        await self.redis.set(f"task:{task_id}", json.dumps(task_data), keepttl=True)
+        return True
+
     async def cancel_task(self, task_id: str) -> bool:
         """取消任务"""
         task_data = await self.get_task(task_id)
@@ -75,9 +88,25 @@ class RedisService:
         await self.update_task_status(task_id, "cancelled")
         return True
 
+    async def set_image_meta(self, filename: str, meta: Dict[str, Any]) -> None:
+        """保存上传图片的元数据（MIME类型等），与任务同样24小时过期"""
+        key = f"image_meta:{filename}"
+        await self.redis.hset(key, mapping={k: str(v) for k, v in meta.items()})
+        await self.redis.expire(key, TASK_TTL)
+
+    async def get_image_meta(self, filename: str) -> Dict[str, str]:
+        """获取上传图片的元数据"""
+        return await self.redis.hgetall(f"image_meta:{filename}")
+
+    async def claim_task(self, task_id: str) -> bool:
+        """抢占任务的执行权，保证同一任务只被执行一次"""
+        return bool(await self.redis.set(f"task_runner:{task_id}", "1", nx=True, ex=TASK_TTL))
+
     async def delete_task(self, task_id: str) -> bool:
         """删除任务"""
-        return await self.redis.delete(f"task:{task_id}") > 0
+        return await self.redis.delete(
+            f"task:{task_id}", f"task_runner:{task_id}", f"task_events:{task_id}"
+        ) > 0
 
 # 创建全局Redis服务实例
 redis_service = RedisService() 
\ No newline at end of file
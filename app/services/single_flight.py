@@ -0,0 +1,205 @@
+import time
+import asyncio
+import logging
+import os
+from typing import Any, AsyncGenerator, Optional, Tuple
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service
+from services.task_stream import encode_event_data
+from services.distributed_semaphore import VLM_SEMAPHORE_MAX_WAIT
+from services.vlm_client import VLM_CONNECT_TIMEOUT, VLM_READ_TIMEOUT
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 单飞合并配置
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+SINGLE_FLIGHT_LOCK_TTL = int(os.getenv("SINGLE_FLIGHT_LOCK_TTL", "30"))  # 领导者锁过期时间（秒），领导者在后台定期续期
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv("SINGLE_FLIGHT_RESULT_TTL", "60"))  # 生成结束后事件流保留时间（秒）
+# 跟随者等待新事件的最长时间（秒）：领导者可能先排队等待上游并发许可，再等待首个token，
+# 默认为两者的上限之和；领导者中断（锁被释放或易主）时跟随者会更早失败
+SINGLE_FLIGHT_IDLE_TIMEOUT = float(os.getenv(
+    "SINGLE_FLIGHT_IDLE_TIMEOUT",
+    str(VLM_SEMAPHORE_MAX_WAIT + VLM_CONNECT_TIMEOUT + VLM_READ_TIMEOUT)
+))
+
+# Redis 键
+LOCK_PREFIX = "single_flight:lock"
+STREAM_PREFIX = "single_flight:stream"
+
+# 成为领导者，或者返回当前领导者的任务ID
+ACQUIRE_SCRIPT = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return ARGV[1]
+end
+return redis.call('get', KEYS[1])
+"""
+
+# 仅当锁仍属于自己时才续期
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+else
+    return 0
+end
+"""
+
+# 仅当锁仍属于自己时才写入事件
+PUBLISH_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('xadd', KEYS[2], '*', 'event', ARGV[2], 'data', ARGV[3])
+redis.call('expire', KEYS[2], ARGV[4])
+return 1
+"""
+
+# 仅当锁仍属于自己时才删除
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+else
+    return 0
+end
+"""
+
+
+class SingleFlightError(Exception):
+    """领导者生成失败或中断"""
+    pass
+
+
+class SingleFlight:
+    """并发相同任务的单飞合并
+
+    同一 (图片哈希, 语言, 提示词版本) 的第一个任务成为领导者，真正调用上游模型，
+    并把每个事件写入 Redis Stream；其他进程或节点上的相同任务作为跟随者，
+    从头读取该事件流并实时收到相同的 SSE 事件，不再占用上游并发。
+    """
+
+    @staticmethod
+    def make_key(image_hash: str, language: str, prompt_version: str) -> str:
+        return f"{prompt_version}:{language.lower()}:{image_hash}"
+
+    @staticmethod
+    def stream_key(flight_key: str, leader_id: str) -> str:
+        """每个领导者使用自己的事件流，锁易主后新旧领导者的事件不会混在一起"""
+        return f"{STREAM_PREFIX}:{flight_key}:{leader_id}"
+
+    @staticmethod
+    async def acquire(flight_key: str, task_id: str) -> str:
+        """尝试成为领导者，返回领导者的任务ID（等于 task_id 时本任务即为领导者）"""
+        if not SINGLE_FLIGHT_ENABLED:
+            return task_id
+
+        leader_id = await redis_service.redis.eval(
+            ACQUIRE_SCRIPT, 1, f"{LOCK_PREFIX}:{flight_key}", task_id, SINGLE_FLIGHT_LOCK_TTL
+        )
+        # 领导者恰好在两次操作之间释放了锁时，本任务自己生成
+        return leader_id or task_id
+
+    @staticmethod
+    async def lead(
+        flight_key: str,
+        task_id: str,
+        events: AsyncGenerator[Tuple[str, Any], None]
+    ) -> AsyncGenerator[Tuple[str, Any], None]:
+        """以领导者身份转发事件，同时发布给跟随者
+
+        领导者在排队等待上游并发许可时可能很久没有事件，因此锁由后台任务定期续期；
+        每次写入都校验锁仍属于自己，失去锁（例如 Redis 长时间不可达）后不再写入，
+        由 SingleFlightError 结束本任务。
+        """
+        if not SINGLE_FLIGHT_ENABLED:
+            async for event, data in events:
+                yield event, data
+            return
+
+        lock_key = f"{LOCK_PREFIX}:{flight_key}"
+        stream_key = SingleFlight.stream_key(flight_key, task_id)
+        heartbeat = asyncio.create_task(SingleFlight._renew_loop(lock_key, task_id))
+        finished = False
+        try:
+            async for event, data in events:
+                if not await SingleFlight._publish(lock_key, stream_key, task_id, event, data):
+                    raise SingleFlightError("单飞领导者锁已失效")
+                if event == "done":
+                    finished = True
+                yield event, data
+        except SingleFlightError:
+            finished = True
+            raise
+        except Exception as e:
+            await SingleFlight._publish(lock_key, stream_key, task_id, "error", str(e))
+            finished = True
+            raise
+        finally:
+            heartbeat.cancel()
+            if not finished:
+                # 生成被中断（例如客户端断开），通知跟随者
+                try:
+                    await SingleFlight._publish(lock_key, stream_key, task_id, "error", "leader task interrupted")
+                except Exception as e:
+                    logger.warning(f"单飞中断通知失败：{str(e)}")
+            try:
+                await redis_service.redis.expire(stream_key, SINGLE_FLIGHT_RESULT_TTL)
+                await redis_service.redis.eval(RELEASE_SCRIPT, 1, lock_key, task_id)
+            except Exception as e:
+                logger.warning(f"单飞锁释放失败 | 任务：{task_id} | 原因：{str(e)}")
+
+    @staticmethod
+    async def _renew_loop(lock_key: str, task_id: str) -> None:
+        while True:
+            await asyncio.sleep(SINGLE_FLIGHT_LOCK_TTL / 3)
+            try:
+                if not await redis_service.redis.eval(RENEW_SCRIPT, 1, lock_key, task_id, SINGLE_FLIGHT_LOCK_TTL):
+                    logger.warning(f"单飞领导者锁已失效，停止续期 | 任务：{task_id}")
+                    return
+            except Exception as e:
+                logger.warning(f"单飞锁续期失败 | 任务：{task_id} | 原因：{str(e)}")
+
+    @staticmethod
+    async def _publish(lock_key: str, stream_key: str, task_id: str, event: str, data: Any) -> bool:
+        """写入一个事件，锁已不属于本任务时不写入并返回 False"""
+        return bool(await redis_service.redis.eval(
+            PUBLISH_SCRIPT, 2, lock_key, stream_key,
+            task_id, event, encode_event_data(data), SINGLE_FLIGHT_LOCK_TTL + SINGLE_FLIGHT_RESULT_TTL
+        ))
+
+    @staticmethod
+    async def follow(flight_key: str, leader_id: str) -> AsyncGenerator[Tuple[str, Optional[str]], None]:
+        """以跟随者身份从头读取领导者的事件流"""
+        lock_key = f"{LOCK_PREFIX}:{flight_key}"
+        stream_key = SingleFlight.stream_key(flight_key, leader_id)
+        last_id = "0"
+        last_event_at = time.monotonic()
+        leader_lost = False
+        while True:
+            response = await redis_service.redis.xread({stream_key: last_id}, count=100, block=1000)
+            if not response:
+                if leader_lost:
+                    # 锁已释放或易主后又读了一轮，仍然没有结束事件
+                    raise SingleFlightError("相同任务的生成已中断")
+                if time.monotonic() - last_event_at > SINGLE_FLIGHT_IDLE_TIMEOUT:
+                    raise SingleFlightError("等待相同任务的生成结果超时")
+                leader_lost = await redis_service.redis.get(lock_key) != leader_id
+                continue
+
+            last_event_at = time.monotonic()
+            leader_lost = False
+            for _, entries in response:
+                for entry_id, fields in entries:
+                    last_id = entry_id
+                    event, data = fields["event"], fields["data"]
+                    if event == "error":
+                        raise SingleFlightError(data)
+                    yield event, data or None
+                    if event == "done":
+                        return
+
+
+# 创建全局单飞实例
+single_flight = SingleFlight()
@@ -0,0 +1,174 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Dict, Optional, Set
+
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service, TASK_TTL
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 客户端断开后取消生成的配置
+VLM_CANCEL_ON_DISCONNECT = os.getenv("VLM_CANCEL_ON_DISCONNECT", "true").lower() == "true"
+# 最后一个连接断开后等待重连的时间（秒），0 表示立即取消；大于0时短暂断网可以续传，但上游并发释放得更晚
+VLM_DISCONNECT_GRACE = float(os.getenv("VLM_DISCONNECT_GRACE", "0"))
+# 提交时立即开始生成后，等待客户端打开事件流的最长时间（秒），超时未连接时取消并退款；0 表示不限制
+VLM_ATTACH_TIMEOUT = float(os.getenv("VLM_ATTACH_TIMEOUT", "30"))
+
+# 取消通知频道，执行任务的进程（API 或 worker）都订阅
+CANCEL_CHANNEL = "task_cancel"
+# 正在接收任务事件流的连接数
+VIEWERS_PREFIX = "task_viewers"
+
+# 取消原因
+REASON_USER = "user"  # 用户调用取消接口，由执行任务的一方全额退款
+REASON_DISCONNECT = "disconnect"  # 客户端断开，按 VLM_DISCONNECT_BILLING 结算
+REASON_UNATTACHED = "unattached"  # 提前开始生成后一直没有客户端连接，全额退款
+
+
+class TaskCancellation:
+    """跨进程取消正在生成的任务
+
+    生成在后台执行，不依赖于 SSE 连接，可能在另一个 API 节点或 worker 上。
+    每个转发连接在 Redis 中登记 ``task_viewers:{task_id}``，最后一个连接异常断开（超过宽限期没有重连）时，
+    把任务标记为已取消并通过 Pub/Sub 通知所有进程；正在执行该任务的进程取消对应的 asyncio 任务，
+    取消沿着事件流传到上游调用，关闭上游 HTTP 流并释放并发许可。
+    """
+
+    def __init__(self):
+        self._running: Dict[str, asyncio.Task] = {}
+        self._reasons: Dict[str, str] = {}
+        self._listener: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+        self._watchers: Set[asyncio.Task] = set()
+
+    def register(self, task_id: str, task: asyncio.Task) -> None:
+        """登记本进程内执行任务的 asyncio 任务，结束后自动移除"""
+        self._running[task_id] = task
+
+        def cleanup(_):
+            if self._running.get(task_id) is task:
+                self._running.pop(task_id, None)
+                self._reasons.pop(task_id, None)
+
+        task.add_done_callback(cleanup)
+
+    def is_running(self, task_id: str) -> bool:
+        """任务是否正在本进程内执行"""
+        task = self._running.get(task_id)
+        return task is not None and not task.done()
+
+    def reason(self, task_id: str) -> Optional[str]:
+        """任务被取消的原因，未被请求取消时返回 None"""
+        return self._reasons.get(task_id)
+
+    def start(self) -> None:
+        """订阅取消通知，由 FastAPI lifespan 和 worker 调用"""
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        """停止订阅，并等待断开处理完成"""
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        for watcher in list(self._watchers):
+            watcher.cancel()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = redis_service.redis.pubsub()
+            try:
+                await pubsub.subscribe(CANCEL_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    payload = json.loads(message["data"])
+                    self._cancel_local(payload["task_id"], payload["reason"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"取消通知订阅出错，稍后重试：{str(e)}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    def _cancel_local(self, task_id: str, reason: str) -> None:
+        task = self._running.get(task_id)
+        if task is None or task.done():
+            return
+        self._reasons[task_id] = reason
+        task.cancel()
+        logger.info(f"已取消正在执行的任务 | 任务：{task_id} | 原因：{reason}")
+
+    async def request(self, task_id: str, reason: str) -> bool:
+        """标记任务已取消并通知执行进程，任务已完成或不存在时返回 False"""
+        if not await redis_service.cancel_task(task_id):
+            return False
+        await redis_service.redis.publish(
+            CANCEL_CHANNEL, json.dumps({"task_id": task_id, "reason": reason})
+        )
+        return True
+
+    async def attach(self, task_id: str) -> None:
+        """登记一个转发连接"""
+        key = f"{VIEWERS_PREFIX}:{task_id}"
+        pipe = redis_service.redis.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, TASK_TTL)
+        await pipe.execute()
+
+    def watch_attach(self, task_id: str, timeout: float = VLM_ATTACH_TIMEOUT) -> None:
+        """提交时已开始生成的任务：超时仍没有任何连接打开过事件流时取消"""
+        if timeout <= 0:
+            return
+        watcher = asyncio.create_task(self._watch_attach(task_id, timeout))
+        self._watchers.add(watcher)
+        watcher.add_done_callback(self._watchers.discard)
+
+    async def _watch_attach(self, task_id: str, timeout: float) -> None:
+        await asyncio.sleep(timeout)
+        try:
+            # 连接计数键在第一次连接时创建，之后即使断开也保留，可以区分“从未连接”
+            if await redis_service.redis.exists(f"{VIEWERS_PREFIX}:{task_id}"):
+                return
+            if await self.request(task_id, REASON_UNATTACHED):
+                logger.info(f"超时没有客户端连接，取消任务 | 任务：{task_id} | 等待：{timeout}秒")
+        except Exception as e:
+            logger.error(f"连接超时处理失败 | 任务：{task_id} | 原因：{str(e)}", exc_info=True)
+
+    def detach(self, task_id: str, disconnected: bool) -> None:
+        """注销转发连接；在生成器的 finally 中调用，因此只创建后台任务，不等待"""
+        background = asyncio.create_task(self._detach(task_id, disconnected))
+        self._pending.add(background)
+        background.add_done_callback(self._pending.discard)
+
+    async def _detach(self, task_id: str, disconnected: bool) -> None:
+        key = f"{VIEWERS_PREFIX}:{task_id}"
+        try:
+            remaining = await redis_service.redis.decr(key)
+            if not disconnected or not VLM_CANCEL_ON_DISCONNECT or remaining > 0:
+                return
+            if VLM_DISCONNECT_GRACE > 0:
+                await asyncio.sleep(VLM_DISCONNECT_GRACE)
+                if int(await redis_service.redis.get(key) or 0) > 0:
+                    return
+            if await self.request(task_id, REASON_DISCONNECT):
+                logger.info(f"客户端已断开，取消任务 | 任务：{task_id}")
+        except Exception as e:
+            logger.error(f"断开处理失败 | 任务：{task_id} | 原因：{str(e)}", exc_info=True)
+
+
+# 创建全局任务取消实例
+task_cancellation = TaskCancellation()
@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import time
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 作为 language 标签的编程语言，其他语言统一记为 other，避免用户输入导致标签无限增长
+VLM_METRICS_LANGUAGES = {
+    language.strip().lower()
+    for language in os.getenv(
+        "VLM_METRICS_LANGUAGES",
+        "python,java,c++,cpp,c,c#,javascript,typescript,go,rust,kotlin,swift,php,ruby,scala,sql"
+    ).split(",")
+    if language.strip()
+}
+
+METRICS_PREFIX = "vlm_metrics"
+
+# 直方图：名称 -> (说明, 桶上界)
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120)
+HISTOGRAMS = {
+    "vlm_queue_wait_seconds": ("任务从提交到开始执行的等待时间", SECONDS_BUCKETS),
+    "vlm_semaphore_wait_seconds": ("等待上游并发许可的时间", SECONDS_BUCKETS),
+    "vlm_upstream_ttft_seconds": ("上游请求发出到收到首个token的时间", SECONDS_BUCKETS),
+    "vlm_ttfb_seconds": ("任务提交到首个回答内容写入事件流（可发送给客户端）的时间", SECONDS_BUCKETS),
+    "vlm_generation_seconds": ("任务开始执行到生成结束的总时间", SECONDS_BUCKETS),
+    "vlm_tokens_per_second": ("首个token之后的输出速度", (5, 10, 20, 30, 40, 60, 80, 100, 150, 200, 300)),
+    "vlm_upstream_request_bytes": (
+        "发送给上游的图片大小（Base64 后）",
+        (32 * 1024, 64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024, 2 * 1024 * 1024, 4 * 1024 * 1024),
+    ),
+}
+TOKENS_COUNTER = "vlm_tokens_total"
+TASKS_COUNTER = "vlm_tasks_total"
+
+
+def normalize_language(language: Optional[str]) -> str:
+    language = (language or "").strip().lower()
+    return language if language in VLM_METRICS_LANGUAGES else "other"
+
+
+def _field(source: Any, name: str) -> Any:
+    return source.get(name) if isinstance(source, dict) else getattr(source, name, None)
+
+
+def usage_to_dict(usage: Any) -> Optional[Dict[str, int]]:
+    """把上游 usage 对象（或跟随者收到的 JSON）转换为 token 数
+
+    图片和缓存命中的 token 来自 prompt_tokens_details（已包含在 prompt_tokens 中），上游不提供时省略。
+    """
+    if isinstance(usage, str):
+        try:
+            usage = json.loads(usage)
+        except ValueError:
+            return None
+    if usage is None:
+        return None
+    result = {}
+    for field in ("prompt_tokens", "completion_tokens", "total_tokens", "image_tokens", "cached_tokens"):
+        value = _field(usage, field)
+        if value is None and field in ("image_tokens", "cached_tokens"):
+            details = _field(usage, "prompt_tokens_details")
+            value = _field(details, field) if details is not None else None
+        if value is not None:
+            result[field] = int(value)
+    return result or None
+
+
+class TaskMetrics:
+    """单个任务的性能数据，由执行过程的各个阶段填充"""
+
+    def __init__(self, task: Dict[str, Any]):
+        self.started = time.monotonic()
+        self.queue_wait: Optional[float] = None
+        if task.get("created_at"):
+            # created_at 与 redis_service 一样使用本地时间
+            self.queue_wait = max(0.0, time.time() - datetime.fromisoformat(task["created_at"]).timestamp())
+        self.model: Optional[str] = None
+        self.semaphore_wait: Optional[float] = None
+        self.upstream_ttft: Optional[float] = None
+        self.upstream_request_bytes: Optional[int] = None
+        self.usage: Optional[Dict[str, int]] = None
+        self.cache_hit = False
+        self._first_byte: Optional[float] = None
+        self._finished: Optional[float] = None
+
+    def mark_first_byte(self) -> None:
+        """第一个回答内容写入事件流"""
+        if self._first_byte is None:
+            self._first_byte = time.monotonic()
+
+    def finish(self) -> None:
+        if self._finished is None:
+            self._finished = time.monotonic()
+
+    def observations(self) -> Dict[str, float]:
+        """各直方图本次的观测值，没有数据的指标不记录"""
+        values = {
+            "vlm_queue_wait_seconds": self.queue_wait,
+            "vlm_semaphore_wait_seconds": self.semaphore_wait,
+            "vlm_upstream_ttft_seconds": self.upstream_ttft,
+            "vlm_upstream_request_bytes": self.upstream_request_bytes,
+        }
+        if self._first_byte is not None:
+            values["vlm_ttfb_seconds"] = (self.queue_wait or 0.0) + self._first_byte - self.started
+        if self._finished is not None:
+            values["vlm_generation_seconds"] = self._finished - self.started
+            completion_tokens = (self.usage or {}).get("completion_tokens")
+            streaming = self._finished - (self._first_byte or self._finished)
+            if completion_tokens and streaming > 0:
+                values["vlm_tokens_per_second"] = completion_tokens / streaming
+        return {name: value for name, value in values.items() if value is not None}
+
+    def to_dict(self) -> Dict[str, Any]:
+        """保存到任务信息中的摘要"""
+        summary: Dict[str, Any] = {
+            name.replace("vlm_", "", 1): round(value, 3) for name, value in self.observations().items()
+        }
+        summary["model"] = self.model
+        summary["cache_hit"] = self.cache_hit
+        if self.usage:
+            summary["usage"] = self.usage
+        return summary
+
+
+class MetricsRegistry:
+    """集群级的任务性能指标
+
+    API 和 worker 进程都会执行任务，因此直方图不放在进程内存中，而是累加到 Redis 哈希
+    ``vlm_metrics:{指标}``（字段为 标签|桶上界、标签|sum、标签|count），
+    由 metrics 接口按 Prometheus 文本格式导出，标签为 model 和 language。
+    """
+
+    @staticmethod
+    async def record(
+        task_id: str,
+        task: Dict[str, Any],
+        metrics: TaskMetrics,
+        status: str
+    ) -> None:
+        """保存任务的性能摘要，并计入直方图；失败时只记录日志"""
+        try:
+            summary = metrics.to_dict()
+            await redis_service.update_task_fields(task_id, {"metrics": summary})
+
+            model = re.sub(r"[^\w.:/-]", "_", metrics.model or "unknown")
+            labels = f'model="{model}",language="{normalize_language(task.get("programming_language"))}"'
+            pipe = redis_service.redis.pipeline(transaction=False)
+            for name, value in metrics.observations().items():
+                _, buckets = HISTOGRAMS[name]
+                # 只计入第一个不小于观测值的桶，导出时再累加
+                bucket = next((str(bound) for bound in buckets if value <= bound), "+Inf")
+                key = f"{METRICS_PREFIX}:{name}"
+                pipe.hincrby(key, f"{labels}|{bucket}", 1)
+                pipe.hincrbyfloat(key, f"{labels}|sum", value)
+                pipe.hincrby(key, f"{labels}|count", 1)
+            for token_type in ("prompt", "completion"):
+                tokens = (metrics.usage or {}).get(f"{token_type}_tokens")
+                if tokens:
+                    pipe.hincrby(f"{METRICS_PREFIX}:{TOKENS_COUNTER}", f'{labels},type="{token_type}"', tokens)
+            pipe.hincrby(f"{METRICS_PREFIX}:{TASKS_COUNTER}", f'{labels},status="{status}"', 1)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"任务性能指标记录失败 | 任务：{task_id} | 原因：{str(e)}")
+
+    @staticmethod
+    async def export() -> str:
+        """按 Prometheus 文本格式导出全部指标"""
+        pipe = redis_service.redis.pipeline(transaction=False)
+        for name in HISTOGRAMS:
+            pipe.hgetall(f"{METRICS_PREFIX}:{name}")
+        pipe.hgetall(f"{METRICS_PREFIX}:{TOKENS_COUNTER}")
+        pipe.hgetall(f"{METRICS_PREFIX}:{TASKS_COUNTER}")
+        results = await pipe.execute()
+
+        lines: List[str] = []
+        for (name, (description, buckets)), fields in zip(HISTOGRAMS.items(), results):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} histogram")
+            series: Dict[str, Dict[str, str]] = {}
+            for field, value in fields.items():
+                labels, suffix = field.rsplit("|", 1)
+                series.setdefault(labels, {})[suffix] = value
+            for labels in sorted(series):
+                values = series[labels]
+                cumulative = 0
+                for bound in [str(bound) for bound in buckets] + ["+Inf"]:
+                    cumulative += int(values.get(bound, 0))
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {float(values.get('sum', 0))}")
+                lines.append(f"{name}_count{{{labels}}} {int(values.get('count', 0))}")
+
+        for name, description, fields in (
+            (TOKENS_COUNTER, "上游 usage 中的 token 数", results[-2]),
+            (TASKS_COUNTER, "结束的任务数", results[-1]),
+        ):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for labels in sorted(fields):
+                lines.append(f"{name}{{{labels}}} {int(fields[labels])}")
+        return "\n".join(lines) + "\n"
+
+
+# 创建全局任务性能指标实例
+task_metrics = MetricsRegistry()
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from redis.exceptions import ResponseError
+
+from services.redis_service import redis_service
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 执行模式：inline 在 SSE 请求内生成；queue 由独立 worker 进程从队列中消费
+VLM_EXECUTION_MODE = os.getenv("VLM_EXECUTION_MODE", "inline")
+
+VLM_QUEUE_MAXLEN = int(os.getenv("VLM_QUEUE_MAXLEN", "100000"))  # 每个优先级队列的最大长度
+VLM_QUEUE_USER_QUEUED_LIMIT = int(os.getenv("VLM_QUEUE_USER_QUEUED_LIMIT", "2"))  # 单用户排队超过该数量后进入低优先级队列
+VLM_QUEUE_CLAIM_IDLE = int(os.getenv("VLM_QUEUE_CLAIM_IDLE", "300"))  # 消息被读取后超过该时间未确认视为 worker 崩溃（秒）
+VLM_QUEUE_LEASE_TTL = int(os.getenv("VLM_QUEUE_LEASE_TTL", "30"))  # 执行租约时间（秒），执行期间自动续期
+
+# 优先级从高到低：high 为崩溃后重新入队的任务，normal 为新任务，low 为公平性降级的任务
+QUEUE_LANES = ("high", "normal", "low")
+QUEUE_PREFIX = "vlm_queue"
+QUEUE_GROUP = "vlm_workers"
+USER_QUEUED_PREFIX = f"{QUEUE_PREFIX}:user_queued"
+RUNNER_PREFIX = f"{QUEUE_PREFIX}:runner"
+
+
+def is_queue_mode() -> bool:
+    return VLM_EXECUTION_MODE == "queue"
+
+
+class TaskQueue:
+    """基于 Redis Streams 消费组的持久化任务队列
+
+    API 节点在提交任务时入队，worker 进程通过消费组读取并执行，执行完成后确认。
+    未确认的消息在 worker 崩溃后可以被其他 worker 认领。
+    """
+
+    @staticmethod
+    def stream_key(lane: str) -> str:
+        return f"{QUEUE_PREFIX}:{lane}"
+
+    @staticmethod
+    async def ensure_groups() -> None:
+        """创建消费组（已存在时忽略）"""
+        for lane in QUEUE_LANES:
+            try:
+                await redis_service.redis.xgroup_create(
+                    TaskQueue.stream_key(lane), QUEUE_GROUP, id="0", mkstream=True
+                )
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    @staticmethod
+    async def enqueue(task_id: str, user_id: str, lane: Optional[str] = None) -> str:
+        """任务入队，返回所在的优先级队列
+
+        未指定队列时，单用户已排队任务过多则进入 low 队列，保证其他用户的任务不被挤占。
+        """
+        user_key = f"{USER_QUEUED_PREFIX}:{user_id}"
+        queued = await redis_service.redis.incr(user_key)
+        await redis_service.redis.expire(user_key, 24 * 60 * 60)
+        if lane is None:
+            lane = "low" if queued > VLM_QUEUE_USER_QUEUED_LIMIT else "normal"
+
+        await redis_service.redis.xadd(
+            TaskQueue.stream_key(lane),
+            {"task_id": task_id, "user_id": str(user_id), "deferrals": "0"},
+            maxlen=VLM_QUEUE_MAXLEN,
+            approximate=True,
+        )
+        return lane
+
+    @staticmethod
+    async def read(consumer: str, block_ms: int = 5000) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        """按优先级读取一条新消息，返回 (队列, 消息ID, 字段)"""
+        # 先按优先级非阻塞地逐个检查，保证高优先级队列先被消费
+        for lane in QUEUE_LANES:
+            response = await redis_service.redis.xreadgroup(
+                QUEUE_GROUP, consumer, {TaskQueue.stream_key(lane): ">"}, count=1
+            )
+            if response:
+                return TaskQueue._first(response)
+
+        # 所有队列都为空时阻塞等待任意队列的新消息
+        response = await redis_service.redis.xreadgroup(
+            QUEUE_GROUP,
+            consumer,
+            {TaskQueue.stream_key(lane): ">" for lane in QUEUE_LANES},
+            count=1,
+            block=block_ms,
+        )
+        return TaskQueue._first(response) if response else None
+
+    @staticmethod
+    def _first(response) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        for stream, entries in response:
+            for message_id, fields in entries:
+                lane = stream.rsplit(":", 1)[-1]
+                return lane, message_id, fields
+        return None
+
+    @staticmethod
+    async def ack(lane: str, message_id: str, user_id: str) -> None:
+        """确认消息已处理完毕"""
+        await redis_service.redis.xack(TaskQueue.stream_key(lane), QUEUE_GROUP, message_id)
+        await redis_service.redis.xdel(TaskQueue.stream_key(lane), message_id)
+        user_key = f"{USER_QUEUED_PREFIX}:{user_id}"
+        if await redis_service.redis.decr(user_key) <= 0:
+            await redis_service.redis.delete(user_key)
+
+    @staticmethod
+    async def discard(lane: str, message_id: str) -> None:
+        """删除消息，不改变用户的排队计数（例如同一任务的重复消息）"""
+        await redis_service.redis.xack(TaskQueue.stream_key(lane), QUEUE_GROUP, message_id)
+        await redis_service.redis.xdel(TaskQueue.stream_key(lane), message_id)
+
+    @staticmethod
+    async def requeue(lane: str, message_id: str, fields: Dict[str, str], target_lane: str) -> None:
+        """把消息移动到另一个队列末尾"""
+        fields = dict(fields)
+        if target_lane == "low":
+            fields["deferrals"] = str(int(fields.get("deferrals", "0")) + 1)
+        await redis_service.redis.xadd(
+            TaskQueue.stream_key(target_lane), fields, maxlen=VLM_QUEUE_MAXLEN, approximate=True
+        )
+        await TaskQueue.discard(lane, message_id)
+
+    @staticmethod
+    @asynccontextmanager
+    async def lease(lane: str, message_id: str, task_id: str, consumer: str) -> AsyncIterator[None]:
+        """执行任务期间持有租约
+
+        任务可能先在信号量中排队再生成，执行时间可以超过 VLM_QUEUE_CLAIM_IDLE。
+        执行期间定期续期 ``vlm_queue:runner:{task_id}``，并用 XCLAIM JUSTID 重置消息的空闲时间，
+        使消息不会被其他 worker 认领；租约过期才说明执行者已经崩溃。
+        """
+        runner_key = f"{RUNNER_PREFIX}:{task_id}"
+        await redis_service.redis.set(runner_key, consumer, ex=VLM_QUEUE_LEASE_TTL)
+        heartbeat = asyncio.create_task(TaskQueue._renew_lease(lane, message_id, runner_key, consumer))
+        try:
+            yield
+        finally:
+            heartbeat.cancel()
+            await redis_service.redis.delete(runner_key)
+
+    @staticmethod
+    async def _renew_lease(lane: str, message_id: str, runner_key: str, consumer: str) -> None:
+        while True:
+            await asyncio.sleep(VLM_QUEUE_LEASE_TTL / 3)
+            try:
+                await redis_service.redis.set(runner_key, consumer, ex=VLM_QUEUE_LEASE_TTL)
+                await redis_service.redis.xclaim(
+                    TaskQueue.stream_key(lane), QUEUE_GROUP, consumer,
+                    min_idle_time=0, message_ids=[message_id], justid=True
+                )
+            except Exception as e:
+                logger.warning(f"任务租约续期失败 | 消息：{message_id} | 原因：{str(e)}")
+
+    @staticmethod
+    async def is_running(task_id: str) -> bool:
+        """任务是否正在某个 worker 上执行（租约未过期）"""
+        return bool(await redis_service.redis.exists(f"{RUNNER_PREFIX}:{task_id}"))
+
+    @staticmethod
+    async def claim_stale(consumer: str) -> List[Tuple[str, str, Dict[str, str]]]:
+        """认领其他 worker 读取后长时间未确认的消息"""
+        claimed = []
+        for lane in QUEUE_LANES:
+            _, entries, *_ = await redis_service.redis.xautoclaim(
+                TaskQueue.stream_key(lane),
+                QUEUE_GROUP,
+                consumer,
+                min_idle_time=VLM_QUEUE_CLAIM_IDLE * 1000,
+                count=100,
+            )
+            for message_id, fields in entries:
+                if fields:
+                    claimed.append((lane, message_id, fields))
+        return claimed
+
+    @staticmethod
+    async def get_depths() -> Dict[str, int]:
+        """各优先级队列当前长度"""
+        return {lane: await redis_service.redis.xlen(TaskQueue.stream_key(lane)) for lane in QUEUE_LANES}
+
+
+# 创建全局任务队列实例
+task_queue = TaskQueue()
@@ -0,0 +1,102 @@
+import json
+import re
+import time
+import logging
+import os
+from typing import Any, AsyncGenerator, Optional, Tuple
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service, TASK_TTL
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+TASK_STREAM_PREFIX = "task_events"
+TASK_STREAM_TTL = TASK_TTL  # 与任务的过期时间一致
+TASK_STREAM_MAXLEN = int(os.getenv("TASK_STREAM_MAXLEN", "20000"))  # 单个任务最多保留的事件数
+
+# 结束一次生成的事件
+END_EVENTS = ("done", "error")
+
+# Redis Stream 事件ID格式，例如 1700000000000-0
+EVENT_ID_PATTERN = re.compile(r"^\d+-\d+$")
+
+
+class TaskStreamTimeout(Exception):
+    """等待任务事件超时"""
+    pass
+
+
+def encode_event_data(data: Any) -> str:
+    """将事件数据编码为可写入 Redis 的字符串"""
+    if data is None:
+        return ""
+    if isinstance(data, dict):
+        return json.dumps(data, ensure_ascii=False)
+    return str(data)
+
+
+class TaskStream:
+    """每个任务的事件流
+
+    生成任务的进程（API 或 worker）把事件依次写入 Redis Stream ``task_events:{task_id}``，
+    任意 API 节点都可以读取并转发给客户端。Redis 生成的事件ID单调递增，直接作为 SSE 的 ``id:``，
+    客户端断线重连时带上 Last-Event-ID 即可从断点继续，不会重新调用模型。
+    """
+
+    @staticmethod
+    def normalize_last_id(last_event_id: Optional[str]) -> str:
+        """校验客户端传入的 Last-Event-ID，无效时从头读取"""
+        if last_event_id and EVENT_ID_PATTERN.match(last_event_id.strip()):
+            return last_event_id.strip()
+        return "0"
+
+    @staticmethod
+    def stream_key(task_id: str) -> str:
+        return f"{TASK_STREAM_PREFIX}:{task_id}"
+
+    @staticmethod
+    async def publish(task_id: str, event: str, data: Any = None) -> str:
+        """追加一个事件，返回事件ID"""
+        key = TaskStream.stream_key(task_id)
+        entry_id = await redis_service.redis.xadd(
+            key,
+            {"event": event, "data": encode_event_data(data)},
+            maxlen=TASK_STREAM_MAXLEN,
+            approximate=True,
+        )
+        await redis_service.redis.expire(key, TASK_STREAM_TTL)
+        return entry_id
+
+    @staticmethod
+    async def read(
+        task_id: str,
+        last_id: str = "0",
+        idle_timeout: float = 300
+    ) -> AsyncGenerator[Tuple[str, str, Optional[str]], None]:
+        """从 last_id 之后读取事件，产出 (事件ID, 事件类型, 数据)，读到结束事件后停止"""
+        key = TaskStream.stream_key(task_id)
+        last_event_at = time.monotonic()
+        while True:
+            response = await redis_service.redis.xread({key: last_id}, count=100, block=1000)
+            if not response:
+                if time.monotonic() - last_event_at > idle_timeout:
+                    raise TaskStreamTimeout("等待任务结果超时")
+                # 空闲时让调用方有机会检查任务状态
+                yield None, "idle", None
+                continue
+
+            last_event_at = time.monotonic()
+            for _, entries in response:
+                for entry_id, fields in entries:
+                    last_id = entry_id
+                    event = fields["event"]
+                    yield entry_id, event, fields["data"] or None
+                    if event in END_EVENTS:
+                        return
+
+
+# 创建全局任务事件流实例
+task_stream = TaskStream()
@@ -1,52 +1,81 @@
-import os
-from openai import AsyncOpenAI
 from fastapi import HTTPException
-import json
-import base64
 import asyncio
-from typing import AsyncGenerator
+import base64
+import time
+from typing import AsyncGenerator, Any, Optional, Tuple
 import logging
+from services.model_router import model_router, is_retryable
+from services.distributed_semaphore import vlm_semaphore, SemaphoreTimeout
+from services.circuit_breaker import vlm_circuit_breaker
+from services.task_metrics import TaskMetrics, usage_to_dict
+from utils.sse import encode_event
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
-# 创建信号量来限制并发请求数
-semaphore = asyncio.Semaphore(5)  # 最多允许5个并发请求
+CIRCUIT_OPEN_MESSAGE = "上游模型服务暂时不可用，请稍后重试"
 
-async def vlm(base64_image: str, user_question: str) -> AsyncGenerator[str, None]:
-    """异步VLM服务"""
-    async with semaphore:  # 使用信号量控制并发
-        try:
-            # 初始化OpenAI客户端
-            client = AsyncOpenAI(
-                api_key=os.getenv("DASHSCOPE_API_KEY"),
-                base_url=os.getenv("DASHSCOPE_BASE_URL"),
-            )
+def build_data_url(image_bytes: bytes, mime_type: str) -> str:
+    """构建内联图片的 data URL，CPU 密集，应在线程池中调用"""
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+
+async def vlm(
+    image_bytes: bytes,
+    mime_type: str,
+    user_question: str,
+    user_id: str = "anonymous"
+) -> AsyncGenerator[bytes, None]:
+    """异步VLM服务，直接产出 SSE 帧"""
+    async for event, data in vlm_events(image_bytes, mime_type, user_question, user_id):
+        yield encode_event(event, data)
+
+async def vlm_events(
+    image_bytes: bytes,
+    mime_type: str,
+    user_question: str,
+    user_id: str = "anonymous",
+    metrics: Optional[TaskMetrics] = None
+) -> AsyncGenerator[Tuple[str, Any], None]:
+    """异步VLM服务，产出 (事件类型, 数据) 元组
 
-            # 检测图片类型
-            image_bytes = base64.b64decode(base64_image)
-            if image_bytes.startswith(b'\xff\xd8'):
-                mime_type = "image/jpeg"
-            elif image_bytes.startswith(b'\x89PNG'):
-                mime_type = "image/png"
-            elif image_bytes.startswith(b'BM'):
-                mime_type = "image/bmp"
-            elif image_bytes.startswith(b'II') or image_bytes.startswith(b'MM'):
-                mime_type = "image/tiff"
-            elif image_bytes.startswith(b'RIFF') and b'WEBP' in image_bytes[:12]:
-                mime_type = "image/webp"
-            elif image_bytes.startswith(b'\x00\x00\x01\x00'):
-                mime_type = "image/x-icon"
-            elif image_bytes.startswith(b'\x00\x00\x02\x00'):
-                mime_type = "image/x-icon"
-            elif image_bytes.startswith(b'\x00\x00\x01\x00'):
-                mime_type = "image/x-icns"
-            elif image_bytes.startswith(b'\x00\x00\x01\x00'):
-                mime_type = "image/x-sgi"
-            elif image_bytes.startswith(b'\x00\x00\x00\x0c'):
-                mime_type = "image/jp2"
+    image_bytes 为原始图片字节，mime_type 在上传时根据文件头识别并随任务保存。
+    提供 metrics 时记录排队时间、上游首token延迟、实际使用的模型和请求大小。
+
+    - ("queue", {"position": 排队位置}) 等待集群并发许可时，位置变化才产出
+    - ("message", 文本增量)
+    - ("usage", {"prompt_tokens": ..., "completion_tokens": ..., "image_tokens": ..., "model": ...})
+      上游提供的 token 用量（见 usage_to_dict）和实际使用的模型，用于按用量计费
+    - ("done", None)
+    """
+    # 上游熔断期间直接失败（由调用方退款），不再排队等待并发许可
+    if not vlm_circuit_breaker.allow():
+        raise HTTPException(status_code=503, detail=CIRCUIT_OPEN_MESSAGE)
+
+    # 使用集群级信号量控制上游并发，窗口根据上游的响应自适应调整
+    lease_id = vlm_semaphore.new_lease_id()
+    wait_started = time.monotonic()
+    try:
+        async for position in vlm_semaphore.acquire(str(user_id), lease_id):
+            if position > 0:
+                yield "queue", {"position": position}
             else:
-                raise ValueError("Unsupported image format. Supported formats: BMP, DIB, ICNS, ICO, JPEG, JPEG2000, PNG, SGI, TIFF, WEBP")
+                # 该用户的其他任务占满了单用户并发
+                yield "queue", {"position": 0, "reason": "user_limit"}
+    except SemaphoreTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except BaseException:
+        # 排队期间被取消，退出队列
+        await vlm_semaphore.release(str(user_id), lease_id)
+        raise
+
+    if metrics is not None:
+        metrics.semaphore_wait = time.monotonic() - wait_started
+
+    async with vlm_semaphore.hold(str(user_id), lease_id):
+        healthy = False
+        try:
+            # 在线程池中完成唯一一次 Base64 编码，避免大图阻塞事件循环
+            image_url = await asyncio.to_thread(build_data_url, image_bytes, mime_type)
 
             # 构建消息列表
             messages = [
@@ -59,38 +88,52 @@ async def vlm(base64_image: str, user_question: str) -> AsyncGenerator[str, None
                     "content": [
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:{mime_type};base64,{base64_image}"},
+                            "image_url": {"url": image_url},
                         },
                         {"type": "text", "text": user_question},
                     ],
                 },
             ]
 
-            # 发起异步ChatCompletion请求
-            completion = await client.chat.completions.create(
-                model="qwen-omni-turbo",
-                messages=messages,
+            # 由模型路由选择后端，首个token超时时对冲、失败时切换；
+            # 任务被取消时路由会立即关闭上游 HTTP 流，不再继续接收
+            started = time.monotonic()
+            completion = model_router.stream(
+                messages,
+                user_id=str(user_id),
                 modalities=["text"],
-                stream=True,
                 stream_options={"include_usage": True},
             )
 
             # 处理流式响应
             async for chunk in completion:
+                if not healthy:
+                    # 收到第一个分片说明上游可用，首token延迟用于调整并发窗口
+                    healthy = True
+                    ttft = time.monotonic() - started
+                    vlm_circuit_breaker.record_success()
+                    await vlm_semaphore.record_success(ttft)
+                    if metrics is not None:
+                        metrics.upstream_ttft = ttft
+                        metrics.model = getattr(chunk, "model", None)
+                        metrics.upstream_request_bytes = len(image_url)
                 if chunk.choices:
                     content = chunk.choices[0].delta.content
                     if content:
-                        message = {
-                            "role": "assistant",
-                            "content": content,
-                        }
-                        json_message = json.dumps(message)
-                        yield f"event: message\ndata: {json_message}\n\n"
+                        yield "message", content
                 else:
-                    if hasattr(chunk, 'usage'):
-                        yield f"event: usage\ndata: {chunk.usage}\n\n"
-                    yield "event: done\ndata: \n\n"
+                    usage = usage_to_dict(getattr(chunk, "usage", None))
+                    if usage:
+                        yield "usage", {**usage, "model": getattr(chunk, "model", None)}
+                    yield "done", None
 
         except Exception as e:
+            if is_retryable(e):
+                # 所有后端都限流、5xx 或无法连接：减小并发窗口，并计入熔断
+                vlm_circuit_breaker.record_failure()
+                await vlm_semaphore.record_overload(str(e))
+            elif not healthy:
+                # 请求本身的错误（例如 4xx），上游是可用的
+                vlm_circuit_breaker.record_success()
             logger.error(f"Error in VLM processing: {str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail=f"Error querying chat completion: {str(e)}")
\ No newline at end of file
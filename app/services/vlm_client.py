@@ -0,0 +1,148 @@
+import os
+import json
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+import httpx
+from openai import AsyncOpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 上游连接池配置
+VLM_MAX_CONNECTIONS = int(os.getenv("VLM_MAX_CONNECTIONS", "100"))  # 连接池最大连接数
+VLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("VLM_MAX_KEEPALIVE_CONNECTIONS", "20"))  # 最大保活连接数
+VLM_KEEPALIVE_EXPIRY = float(os.getenv("VLM_KEEPALIVE_EXPIRY", "120"))  # 空闲连接保活时间（秒）
+VLM_CONNECT_TIMEOUT = float(os.getenv("VLM_CONNECT_TIMEOUT", "5"))  # 建立连接超时（秒）
+VLM_READ_TIMEOUT = float(os.getenv("VLM_READ_TIMEOUT", "60"))  # 读取超时（秒），流式响应为两个分片之间的间隔
+VLM_WRITE_TIMEOUT = float(os.getenv("VLM_WRITE_TIMEOUT", "30"))  # 写入超时（秒）
+VLM_POOL_TIMEOUT = float(os.getenv("VLM_POOL_TIMEOUT", "10"))  # 等待连接池空闲连接超时（秒）
+VLM_MAX_RETRIES = int(os.getenv("VLM_MAX_RETRIES", "2"))  # SDK 自动重试次数
+VLM_HTTP2 = os.getenv("VLM_HTTP2", "true").lower() == "true"  # 是否启用 HTTP/2（需要安装 h2）
+VLM_WARMUP = os.getenv("VLM_WARMUP", "true").lower() == "true"  # 启动时是否预热连接
+
+# 上游模型，只配置一个后端时使用
+VLM_MODEL = os.getenv("VLM_MODEL", "qwen-omni-turbo")
+# 多个上游后端，JSON 数组，按优先级排列，例如：
+# [{"name": "dashscope", "base_url": "https://...", "api_key_env": "DASHSCOPE_API_KEY", "model": "qwen-omni-turbo"},
+#  {"name": "backup", "base_url": "https://...", "api_key_env": "BACKUP_API_KEY", "model": "qwen-vl-max"}]
+# 未配置时使用 DASHSCOPE_BASE_URL、DASHSCOPE_API_KEY 和 VLM_MODEL
+VLM_BACKENDS = os.getenv("VLM_BACKENDS")
+
+
+class VLMBackend(NamedTuple):
+    """一个 OpenAI 兼容的上游后端"""
+    name: str
+    base_url: Optional[str]
+    api_key: Optional[str]
+    model: str
+
+
+def load_backends() -> List[VLMBackend]:
+    """读取上游后端配置"""
+    if not VLM_BACKENDS:
+        return [VLMBackend(
+            "default", os.getenv("DASHSCOPE_BASE_URL"), os.getenv("DASHSCOPE_API_KEY"), VLM_MODEL
+        )]
+    backends = []
+    for item in json.loads(VLM_BACKENDS):
+        # 密钥从另一个环境变量读取，不直接写在 JSON 中
+        api_key = os.getenv(item["api_key_env"]) if "api_key_env" in item else item.get("api_key")
+        backends.append(VLMBackend(item["name"], item.get("base_url"), api_key, item.get("model", VLM_MODEL)))
+    if not backends:
+        raise ValueError("VLM_BACKENDS 至少需要配置一个后端")
+    return backends
+
+
+def _http2_available() -> bool:
+    """检查是否安装了 HTTP/2 依赖"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class VLMClientManager:
+    """进程级上游客户端管理器
+
+    每个上游后端一个 AsyncOpenAI 客户端，所有客户端共享同一个 httpx 连接池，
+    避免每次请求都重新建立 TCP/TLS 连接。由 FastAPI lifespan 负责启动和关闭。
+    """
+
+    def __init__(self):
+        self.backends = load_backends()
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._clients: Dict[str, AsyncOpenAI] = {}
+
+    def _build(self) -> None:
+        http2 = VLM_HTTP2 and _http2_available()
+        if VLM_HTTP2 and not http2:
+            logger.warning("未安装 h2，上游连接回退到 HTTP/1.1")
+
+        self._http_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=VLM_MAX_CONNECTIONS,
+                max_keepalive_connections=VLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=VLM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                connect=VLM_CONNECT_TIMEOUT,
+                read=VLM_READ_TIMEOUT,
+                write=VLM_WRITE_TIMEOUT,
+                pool=VLM_POOL_TIMEOUT,
+            ),
+        )
+        # 多个后端时由模型路由负责故障转移，SDK 不再对同一后端重试，避免拖慢切换
+        max_retries = VLM_MAX_RETRIES if len(self.backends) == 1 else 0
+        self._clients = {
+            backend.name: AsyncOpenAI(
+                api_key=backend.api_key,
+                base_url=backend.base_url,
+                http_client=self._http_client,
+                max_retries=max_retries,
+            )
+            for backend in self.backends
+        }
+        logger.info(
+            f"上游客户端已创建 | 后端：{[backend.name for backend in self.backends]} | HTTP/2：{http2} | "
+            f"最大连接数：{VLM_MAX_CONNECTIONS} | 保活连接数：{VLM_MAX_KEEPALIVE_CONNECTIONS}"
+        )
+
+    async def start(self) -> None:
+        """创建共享客户端，并在配置开启时预热连接"""
+        if not self._clients:
+            self._build()
+        if VLM_WARMUP:
+            await self.warmup()
+
+    async def warmup(self) -> None:
+        """提前完成 DNS 解析和 TCP/TLS 握手，让第一个请求直接复用热连接"""
+        for base_url in {backend.base_url for backend in self.backends if backend.base_url}:
+            try:
+                await self._http_client.head(base_url)
+                logger.info(f"上游连接预热完成 | 地址：{base_url}")
+            except Exception as e:
+                # 预热失败不影响服务启动，首个请求会重新建立连接
+                logger.warning(f"上游连接预热失败 | 地址：{base_url} | 原因：{str(e)}")
+
+    def get_client(self, name: Optional[str] = None) -> AsyncOpenAI:
+        """获取后端的 AsyncOpenAI 客户端，默认第一个后端；未启动时按需创建"""
+        if not self._clients:
+            self._build()
+        return self._clients[name or self.backends[0].name]
+
+    async def close(self) -> None:
+        """关闭连接池"""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+        self._clients = {}
+        self._http_client = None
+
+
+# 创建全局上游客户端管理器实例
+vlm_client_manager = VLMClientManager()
@@ -0,0 +1,343 @@
+import hashlib
+import json
+import logging
+import os
+import asyncio
+import contextlib
+from typing import Any, AsyncGenerator, Dict, NamedTuple, Optional, Tuple
+
+import aiofiles
+from dotenv import load_dotenv
+
+from services.vlm import vlm_events
+from services.answer_cache import answer_cache
+from services.single_flight import single_flight
+from services.redis_service import redis_service
+from services.image_store import image_store
+from services.task_stream import task_stream
+from services.task_cancellation import task_cancellation, REASON_USER, REASON_DISCONNECT, REASON_UNATTACHED
+from services.task_metrics import task_metrics, TaskMetrics, usage_to_dict
+from services.metering import metering, SOURCE_UPSTREAM, SOURCE_SINGLE_FLIGHT, SOURCE_ANSWER_CACHE
+from utils.stream_coalescer import coalesce_events
+from utils.image_hash import ImageFingerprint
+from utils.image_format import sniff_image_mime, SNIFF_BYTES, SUPPORTED_FORMATS_MESSAGE
+from services.accounts import update_balance, pre_charge_balance, refund_balance
+
+# 加载环境变量
+load_dotenv()
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+# 从环境变量获取服务费用；配置了费率表（见 services/metering）时按 token 用量收费，
+# SERVICE_FEE 作为预扣金额和单次收费上限
+SERVICE_FEE = float(os.getenv("SERVICE_FEE", "1.00"))  # 默认1元
+# 答案缓存命中时的收费，默认与正常生成相同，设置为0表示命中免费
+ANSWER_CACHE_HIT_FEE = float(os.getenv("ANSWER_CACHE_HIT_FEE", str(SERVICE_FEE)))
+# 提示词版本，修改 build_user_question 时需要提升，使旧的缓存答案失效
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "v1")
+
+# 输出合并的默认参数，客户端可以在提交任务时覆盖
+SSE_FLUSH_INTERVAL_MS = int(os.getenv("SSE_FLUSH_INTERVAL_MS", "30"))  # 最长等待时间（毫秒）
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", "512"))  # 累积字节数阈值
+
+# 客户端断开导致取消时的结算方式：refund 全额退还；partial 已输出内容时按比例收费，未输出时退还
+VLM_DISCONNECT_BILLING = os.getenv("VLM_DISCONNECT_BILLING", "refund").lower()
+VLM_DISCONNECT_PARTIAL_RATIO = float(os.getenv("VLM_DISCONNECT_PARTIAL_RATIO", "0.5"))
+
+
+def build_user_question(programming_language: str) -> str:
+    """构建解题提示词，修改内容时需要同步提升 PROMPT_VERSION"""
+    return f"""
+        请仔细分析图片中的算法题目，并按照以下格式用 {programming_language} 语言提供解决方案：
+
+        ### 解题思路
+        - 分析问题的关键点
+        - 提供清晰的解题步骤
+        - 说明算法的时间和空间复杂度
+
+        ### 代码实现
+        ```{programming_language}
+        // 在这里实现具体代码
+        // 每行代码都添加清晰的注释
+        ```
+        """
+
+def charge_task(user_id: str, task_id: str, amount: float) -> None:
+    """确认扣费，服务已完成，失败时只记录日志"""
+    if amount <= 0:
+        return
+    try:
+        new_balance = update_balance(
+            user_id=int(user_id),
+            amount=-amount,  # 负数表示扣费
+            trans_type="扣费",
+            desc=f"VLM服务费用 - 任务ID: {task_id}"
+        )
+        logger.info(f"服务费用扣除成功 | 用户：{user_id} | 扣除金额：{amount} | 剩余余额：{new_balance}")
+    except Exception as e:
+        logger.error(f"服务费用扣除失败：{str(e)}", exc_info=True)
+        # 这里我们不抛出异常，因为服务已经完成
+
+def refund_task(user_id: str, task_id: str, amount: float) -> None:
+    """退还预扣费用，失败时只记录日志"""
+    if amount <= 0:
+        return
+    try:
+        refund_balance(
+            user_id=int(user_id),
+            amount=amount,
+            task_id=task_id
+        )
+        logger.info(f"预扣费用退还成功 | 用户：{user_id} | 退还金额：{amount}")
+    except Exception as refund_error:
+        logger.error(f"预扣费用退还失败：{str(refund_error)}", exc_info=True)
+
+def settle_cancelled_task(user_id: str, task_id: str, fee: float, reason: str, delivered: bool) -> float:
+    """被取消时结算预扣费用，返回实际收取的金额"""
+    if reason == REASON_DISCONNECT and VLM_DISCONNECT_BILLING == "partial" and delivered:
+        # 已确认收费的部分直接扣除，预扣记录与正常完成时一样保留
+        amount = round(fee * VLM_DISCONNECT_PARTIAL_RATIO, 2)
+        charge_task(user_id, task_id, amount)
+        return amount
+    refund_task(user_id, task_id, fee)
+    return 0.0
+
+def sha256_hexdigest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+class TaskImage(NamedTuple):
+    """发送给上游的图片：预处理后的衍生图或原图"""
+    content: bytes
+    mime_type: Optional[str]
+    sha256: Optional[str]  # 原图的内容哈希，作为答案缓存的键
+
+async def load_task_image(task: Dict[str, Any]) -> TaskImage:
+    """读取任务图片，优先使用预处理生成的衍生图，两者都先查内存缓存；原图不存在时抛出 FileNotFoundError"""
+    upload_id = os.path.basename(task["image_url"])
+    meta = await image_store.get_reference(upload_id)
+    sha256 = meta.get("sha256")
+
+    derivative = meta.get("derivative")
+    if derivative:
+        content = await image_store.read_bytes(derivative)
+        if content is not None:
+            return TaskImage(content, meta["derivative_mime"], sha256)
+
+    mime_type = task.get("mime_type") or meta.get("mime_type")
+    if meta.get("blob"):
+        content = await image_store.read_bytes(meta["blob"])
+        if content is None:
+            raise FileNotFoundError("Image not found")
+        return TaskImage(content, mime_type, sha256)
+
+    # 改为按内容存放之前的旧上传
+    file_path = await image_store.resolve(upload_id)
+    if file_path is None:
+        raise FileNotFoundError("Image not found")
+    async with aiofiles.open(file_path, "rb") as f:
+        content = await f.read()
+    return TaskImage(content, mime_type, sha256)
+
+async def process_vlm_stream(
+    image_content: bytes,
+    mime_type: str,
+    user_question: str,
+    task_id: str,
+    user_id: str,
+    image_hash: str,
+    programming_language: str,
+    fingerprint: Optional[ImageFingerprint] = None,
+    metrics: Optional[TaskMetrics] = None
+) -> AsyncGenerator[Tuple[str, Any], None]:
+    """处理VLM流式响应，产出 (事件类型, 数据) 元组
+
+    预扣 SERVICE_FEE，结束后按上游 usage 计价扣费（不超过预扣金额），并登记用量记录。
+    """
+    fee = SERVICE_FEE
+    pre_charged = False
+    delivered = False
+    source = SOURCE_UPSTREAM
+    usage: Optional[Dict[str, int]] = None
+    model: Optional[str] = None
+
+    def record_usage(status: str, amount: float) -> None:
+        metering.record(
+            task_id, user_id, source, status, amount, usage, model,
+            programming_language, len(image_content)
+        )
+
+    try:
+        # 优先查找答案缓存
+        transcript = await answer_cache.get(image_hash, programming_language, PROMPT_VERSION)
+        if transcript is None and fingerprint is not None:
+            # 精确匹配未命中时，查找重新拍摄或裁剪过的同一道题
+            transcript = await answer_cache.get_similar(fingerprint, programming_language, PROMPT_VERSION)
+        if transcript is not None:
+            if metrics is not None:
+                metrics.cache_hit = True
+                metrics.model = "answer_cache"
+            fee = ANSWER_CACHE_HIT_FEE
+            source = SOURCE_ANSWER_CACHE
+            if fee > 0:
+                pre_charge_balance(user_id=int(user_id), amount=fee, task_id=task_id)
+                pre_charged = True
+            logger.info(f"答案缓存命中 | 任务：{task_id} | 语言：{programming_language}")
+
+            async for event, data in answer_cache.replay(transcript):
+                delivered = delivered or event == "message"
+                yield event, data
+
+            charge_task(user_id, task_id, fee)
+            record_usage("completed", fee)
+            await redis_service.update_task_status(task_id, "completed")
+            return
+
+        # 预扣费用
+        pre_charge_balance(
+            user_id=int(user_id),
+            amount=fee,
+            task_id=task_id
+        )
+        pre_charged = True
+
+        # 相同题目同时只有一个任务调用上游，其余任务跟随其事件流
+        flight_key = single_flight.make_key(image_hash, programming_language, PROMPT_VERSION)
+        leader_id = await single_flight.acquire(flight_key, task_id)
+        is_leader = leader_id == task_id
+        if is_leader:
+            events = single_flight.lead(
+                flight_key, task_id, vlm_events(image_content, mime_type, user_question, user_id, metrics)
+            )
+        else:
+            logger.info(f"合并到进行中的相同任务 | 任务：{task_id} | 语言：{programming_language}")
+            source = SOURCE_SINGLE_FLIGHT
+            if metrics is not None:
+                metrics.model = "single_flight"
+            events = single_flight.follow(flight_key, leader_id)
+
+        transcript = []
+        completed = False
+        async with contextlib.aclosing(events):
+            async for event, data in events:
+                if event == "message":
+                    transcript.append(data)
+                    delivered = True
+                elif event == "usage":
+                    # 跟随者收到的是领导者写入事件流的 JSON
+                    data = json.loads(data) if isinstance(data, str) else data
+                    usage = usage_to_dict(data)
+                    model = data.get("model") or model
+                elif event == "done":
+                    completed = True
+                yield event, data
+
+        # 流式响应完成后，按用量确认扣费；上游没有返回 usage 或没有配置费率时按固定费用
+        amount = metering.price(usage, model, fallback=fee, cap=fee)
+        charge_task(user_id, task_id, amount)
+        record_usage("completed", amount)
+
+        # 只由领导者缓存完整结束的回答
+        if completed and is_leader:
+            await answer_cache.set(image_hash, programming_language, PROMPT_VERSION, transcript, fingerprint)
+
+        # 更新任务状态为已完成
+        await redis_service.update_task_status(task_id, "completed")
+
+    except (asyncio.CancelledError, GeneratorExit):
+        # 用户取消、客户端断开或从未连接时被取消，任务状态已由发起取消的一方标记，费用只在这里结算。
+        # 不合并输出时，取消发生在写入事件流期间会在 yield 处以 GeneratorExit 关闭本生成器，同样需要结算。
+        # 无论哪种原因都登记用量记录，上游已经消耗的 token 计入用量，金额为实际收取的部分
+        reason = task_cancellation.reason(task_id)
+        if pre_charged:
+            amount = 0.0
+            if reason in (REASON_USER, REASON_DISCONNECT, REASON_UNATTACHED):
+                amount = settle_cancelled_task(user_id, task_id, fee, reason, delivered)
+            record_usage("cancelled", amount)
+        raise
+
+    except Exception as e:
+        logger.error(f"Error in VLM processing: {str(e)}")
+        # 发生错误时，退还预扣的费用
+        refund_task(user_id, task_id, fee)
+        if pre_charged:
+            record_usage("failed", 0.0)
+
+        yield "error", {"error": str(e)}
+        # 发生错误时，更新任务状态为失败
+        await redis_service.update_task_status(task_id, "failed", str(e))
+
+async def run_vlm_task(
+    task_id: str,
+    task: Dict[str, Any],
+    image: TaskImage,
+    metrics: Optional[TaskMetrics] = None
+) -> AsyncGenerator[Tuple[str, Any], None]:
+    """执行一个解题任务：准备输入、查缓存、调用上游并结算费用"""
+    image_content = image.content
+    # 上传时已识别图片类型，旧任务没有时再从文件头识别
+    mime_type = image.mime_type or sniff_image_mime(image_content[:SNIFF_BYTES])
+    if not mime_type:
+        yield "error", {"error": SUPPORTED_FORMATS_MESSAGE}
+        await redis_service.update_task_status(task_id, "failed", SUPPORTED_FORMATS_MESSAGE)
+        return
+
+    # 原图内容哈希，作为答案缓存的键；上传时未记录的旧图片在线程池中计算
+    image_hash = image.sha256 or await asyncio.to_thread(sha256_hexdigest, image_content)
+    fingerprint = await answer_cache.get_image_fingerprint(os.path.basename(task["image_url"]))
+
+    programming_language = task["programming_language"]
+    user_question = build_user_question(programming_language)
+
+    # 按字节数或时间窗口合并文本增量，减少帧数和写入次数
+    flush_interval_ms = task.get("flush_interval_ms")
+    flush_bytes = task.get("flush_bytes")
+    stream = process_vlm_stream(
+        image_content, mime_type, user_question, task_id, task["user_id"],
+        image_hash, programming_language, fingerprint, metrics
+    )
+    events = coalesce_events(
+        stream,
+        flush_interval=(SSE_FLUSH_INTERVAL_MS if flush_interval_ms is None else flush_interval_ms) / 1000,
+        flush_bytes=SSE_FLUSH_BYTES if flush_bytes is None else flush_bytes,
+    )
+    # 提前退出时依次关闭合并器（取消搬运任务）和生成器，确保 process_vlm_stream 完成结算
+    async with contextlib.aclosing(stream), contextlib.aclosing(events):
+        async for event, data in events:
+            yield event, data
+
+async def execute_task(task_id: str, task: Dict[str, Any], image: TaskImage) -> None:
+    """执行任务，并把所有事件写入任务事件流，由 stream_chat 转发给客户端；结束后记录性能指标"""
+    metrics = TaskMetrics(task)
+    status = "failed"
+    try:
+        # 取消可能发生在写入事件流期间而不是生成器内部，此时退出前显式关闭生成器，
+        # 在任务结束、取消原因被移除之前完成结算，不留给垃圾回收
+        async with contextlib.aclosing(run_vlm_task(task_id, task, image, metrics)) as events:
+            async for event, data in events:
+                await task_stream.publish(task_id, event, data)
+                if event == "message":
+                    metrics.mark_first_byte()
+                elif event == "usage":
+                    metrics.usage = usage_to_dict(data) or metrics.usage
+                elif event == "done":
+                    status = "completed"
+    except asyncio.CancelledError:
+        if task_cancellation.reason(task_id) is None:
+            # 进程退出等其他原因导致的取消
+            raise
+        status = "cancelled"
+        # 通知仍在读取事件流的连接（例如其他设备）
+        await task_stream.publish(task_id, "error", {"error": "Task was cancelled"})
+    except Exception as e:
+        logger.error(f"任务执行失败 | 任务：{task_id} | 原因：{str(e)}", exc_info=True)
+        await task_stream.publish(task_id, "error", {"error": str(e)})
+        await redis_service.update_task_status(task_id, "failed", str(e))
+    metrics.finish()
+    await task_metrics.record(task_id, task, metrics, status)
+
+def start_task_in_background(task_id: str, task: Dict[str, Any], image: TaskImage) -> asyncio.Task:
+    """在当前进程后台执行任务，生成不依赖于 SSE 连接；登记后可以被其他进程通过 task_cancellation 取消"""
+    background = asyncio.create_task(execute_task(task_id, task, image))
+    task_cancellation.register(task_id, background)
+    return background
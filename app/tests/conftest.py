@@ -0,0 +1,4 @@
+import os
+
+# 部分服务在导入时通过 utils.database 创建数据库引擎，测试中不连接数据库，未配置时使用内存 SQLite
+os.environ.setdefault("DATABASE_URL", "sqlite://")
@@ -0,0 +1,141 @@
+import time
+import pytest
+import fakeredis.aioredis
+from unittest.mock import patch
+from services import answer_cache as answer_cache_module
+from services.answer_cache import AnswerCache, format_phash
+from utils.image_hash import ImageFingerprint
+
+# 模拟Redis服务
+class MockRedis:
+    def __init__(self):
+        self.data = {}
+        self.hashes = {}
+        self.zsets = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+        return True
+
+    async def expire(self, key, seconds):
+        return key in self.data
+
+    async def delete(self, *keys):
+        count = 0
+        for key in keys:
+            if key in self.data:
+                del self.data[key]
+                count += 1
+        return count
+
+    async def hincrby(self, key, field, amount=1):
+        h = self.hashes.setdefault(key, {})
+        h[field] = str(int(h.get(field, 0)) + amount)
+        return int(h[field])
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    async def hmget(self, key, fields):
+        h = self.hashes.get(key, {})
+        return [h.get(field) for field in fields]
+
+    async def hdel(self, key, *fields):
+        h = self.hashes.get(key, {})
+        return sum(h.pop(field, None) is not None for field in fields)
+
+    async def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+        return len(mapping)
+
+    async def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    async def zrange(self, key, start, end):
+        items = sorted(self.zsets.get(key, {}).items(), key=lambda x: x[1])
+        return [k for k, _ in items[start:end + 1]]
+
+    async def zrangebyscore(self, key, low, high):
+        low = float(low)
+        return [k for k, score in sorted(self.zsets.get(key, {}).items(), key=lambda x: x[1]) if low <= score <= high]
+
+    async def zrem(self, key, *members):
+        zset = self.zsets.get(key, {})
+        for member in members:
+            zset.pop(member, None)
+        return len(members)
+
+@pytest.fixture
+def mock_redis_service():
+    """模拟Redis服务"""
+    with patch('services.answer_cache.redis_service') as mock_service:
+        mock_service.redis = MockRedis()
+        yield mock_service
+
+@pytest.mark.asyncio
+async def test_cache_miss_then_hit(mock_redis_service):
+    """测试未命中后写入再命中"""
+    assert await AnswerCache.get("abc", "python", "v1") is None
+
+    await AnswerCache.set("abc", "python", "v1", ["你好", "世界"])
+    assert await AnswerCache.get("abc", "Python", "v1") == ["你好", "世界"]
+    # 提示词版本不同不命中
+    assert await AnswerCache.get("abc", "python", "v2") is None
+
+    stats = await AnswerCache.get_stats()
+    assert stats["hit"] == 1
+    assert stats["miss"] == 2
+    assert stats["entries"] == 1
+
+@pytest.mark.asyncio
+async def test_cache_lru_eviction(mock_redis_service):
+    """测试超过上限后淘汰最久未访问的条目"""
+    with patch.object(answer_cache_module, "ANSWER_CACHE_MAX_ENTRIES", 2):
+        await AnswerCache.set("a", "python", "v1", ["a"])
+        await AnswerCache.set("b", "python", "v1", ["b"])
+        # 访问a，使b成为最久未访问
+        await AnswerCache.get("a", "python", "v1")
+        await AnswerCache.set("c", "python", "v1", ["c"])
+
+    assert await AnswerCache.get("b", "python", "v1") is None
+    assert await AnswerCache.get("a", "python", "v1") == ["a"]
+    assert await AnswerCache.get("c", "python", "v1") == ["c"]
+
+@pytest.mark.asyncio
+async def test_eviction_and_expiry_prune_perceptual_index():
+    """测试淘汰和过期的条目同时从感知哈希索引、缩略图和LRU有序集合中清理"""
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    fingerprint = ImageFingerprint(0x0F0F, bytes(64))
+    index_key = answer_cache_module.perceptual_index.redis_key("python", "v1")
+    with patch('services.answer_cache.redis_service') as mock_service, \
+            patch.object(answer_cache_module, "PHASH_MATCH_ENABLED", True), \
+            patch.object(answer_cache_module, "ANSWER_CACHE_MAX_ENTRIES", 1):
+        mock_service.redis = redis
+        await AnswerCache.set("a", "python", "v1", ["a"], fingerprint)
+        await AnswerCache.set("b", "python", "v1", ["b"], ImageFingerprint(0xF0F0, bytes(64)))
+
+        key_a = AnswerCache.make_key("a", "python", "v1")
+        assert await redis.exists(key_a, AnswerCache.thumbnail_key(key_a)) == 0
+        assert await redis.hgetall(index_key) == {format_phash(0xF0F0): "b"}
+        assert await redis.hkeys(answer_cache_module.PHASH_REF_KEY) == [AnswerCache.make_key("b", "python", "v1")]
+
+        # b 的缓存已过期，只剩 LRU 和索引中的记录
+        key_b = AnswerCache.make_key("b", "python", "v1")
+        await redis.delete(key_b, AnswerCache.thumbnail_key(key_b))
+        await redis.zadd(answer_cache_module.LRU_KEY, {key_b: time.time() - answer_cache_module.ANSWER_CACHE_TTL - 1})
+        await AnswerCache._evict()
+
+    assert await redis.zcard(answer_cache_module.LRU_KEY) == 0
+    assert await redis.hgetall(index_key) == {}
+    assert await redis.hgetall(answer_cache_module.PHASH_REF_KEY) == {}
+    stats = await redis.hgetall(answer_cache_module.STATS_KEY)
+    assert stats["evict"] == "1"
+
+@pytest.mark.asyncio
+async def test_replay_preserves_message_events():
+    """测试回放保持原有的 message 事件序列"""
+    events = [event async for event in AnswerCache.replay(["a", "b"], delay=0)]
+    assert events == [("message", "a"), ("message", "b"), ("done", None)]
@@ -0,0 +1,70 @@
+import os
+import pytest
+from services import blob_storage as blob_storage_module
+from services.blob_storage import LocalBlobStorage, S3BlobStorage
+
+KEY = "ab/cd/abcd.png"
+
+async def chunks(*parts):
+    for part in parts:
+        yield part
+
+async def read_all(storage, key):
+    return b"".join([chunk async for chunk in storage.read(key)])
+
+@pytest.mark.asyncio
+async def test_local_storage(tmp_path):
+    """测试本地存储的流式读写、移动文件和删除"""
+    storage = LocalBlobStorage(str(tmp_path))
+    assert not await storage.exists(KEY)
+
+    await storage.write(KEY, chunks(b"ab", b"cd"))
+    assert await storage.exists(KEY)
+    assert await read_all(storage, KEY) == b"abcd"
+
+    source = tmp_path / "upload.part"
+    source.write_bytes(b"moved")
+    await storage.put_file("ef/gh/efgh.jpg", str(source))
+    assert not source.exists()
+    assert open(await storage.local_path("ef/gh/efgh.jpg"), "rb").read() == b"moved"
+
+    await storage.delete(KEY)
+    with pytest.raises(FileNotFoundError):
+        await storage.local_path(KEY)
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not os.getenv("S3_TEST_ENDPOINT_URL"), reason="需要 S3_TEST_ENDPOINT_URL 指向本地 MinIO")
+async def test_s3_storage_with_read_through_cache(tmp_path, monkeypatch):
+    """测试对象存储的读写，以及另一个节点首次读取时写入本地缓存"""
+    monkeypatch.setattr(blob_storage_module, "S3_ENDPOINT_URL", os.getenv("S3_TEST_ENDPOINT_URL"))
+    monkeypatch.setattr(blob_storage_module, "S3_ACCESS_KEY_ID", os.getenv("S3_TEST_ACCESS_KEY_ID", "minio"))
+    monkeypatch.setattr(blob_storage_module, "S3_SECRET_ACCESS_KEY", os.getenv("S3_TEST_SECRET_ACCESS_KEY", "minio123456"))
+    monkeypatch.setattr(blob_storage_module, "S3_BUCKET", "paijie-images-test")
+
+    monkeypatch.setattr(blob_storage_module, "IMAGE_CACHE_DIR", str(tmp_path / "node-a"))
+    writer = S3BlobStorage()
+    monkeypatch.setattr(blob_storage_module, "IMAGE_CACHE_DIR", str(tmp_path / "node-b"))
+    reader = S3BlobStorage()
+    await writer.start()
+    await reader.start()
+    try:
+        source = tmp_path / "upload.part"
+        source.write_bytes(b"x" * 200000)
+        await writer.put_file(KEY, str(source))
+
+        assert await reader.exists(KEY)
+        assert not await reader.cache.exists(KEY)
+        assert await read_all(reader, KEY) == b"x" * 200000
+        # 第一次读取后写入了本地缓存
+        assert await reader.cache.exists(KEY)
+
+        # 对象被其他节点删除后，即使本节点缓存还在也视为不存在，重新上传时不会跳过
+        await writer.delete(KEY)
+        assert await reader.cache.exists(KEY)
+        assert not await reader.exists(KEY)
+        await reader.cache.delete(KEY)
+        with pytest.raises(FileNotFoundError):
+            await reader.local_path(KEY)
+    finally:
+        await writer.close()
+        await reader.close()
@@ -0,0 +1,27 @@
+from utils.byte_lru_cache import ByteLRUCache
+
+def test_evicts_least_recently_used_by_size():
+    """测试按字节数淘汰最久未使用的条目"""
+    cache = ByteLRUCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"  # a 变为最近使用
+
+    cache.put("c", b"1234")
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert cache.get_stats()["bytes"] == 8
+    assert cache.evictions == 1
+
+def test_item_limit_and_hit_ratio():
+    """测试超过单条上限的内容不缓存，以及命中率统计"""
+    cache = ByteLRUCache(max_bytes=100, max_item_bytes=10)
+    assert not cache.put("big", b"x" * 11)
+    cache.put("small", b"x")
+    cache.put("small", b"xy")  # 覆盖时重新计算大小
+
+    assert cache.get("small") == b"xy"
+    assert cache.get("big") is None
+    stats = cache.get_stats()
+    assert stats["bytes"] == 2
+    assert stats["hit_ratio"] == 0.5
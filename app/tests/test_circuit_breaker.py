@@ -0,0 +1,30 @@
+from services import circuit_breaker as circuit_breaker_module
+from services.circuit_breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+
+def test_opens_after_consecutive_failures_and_recovers(monkeypatch):
+    """测试连续失败后熔断，熔断期结束后只放行一个试探请求，试探成功后恢复"""
+    now = [100.0]
+    monkeypatch.setattr(circuit_breaker_module.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", failure_threshold=3, open_seconds=10)
+
+    for _ in range(2):
+        breaker.record_failure()
+    breaker.record_success()  # 成功后重新计数
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    now[0] += 10
+    assert breaker.allow()  # 试探请求
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record_failure()  # 试探失败，重新熔断
+    assert breaker.state == OPEN
+    now[0] += 10
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+    assert breaker.get_stats()["rejected"] == 2
@@ -0,0 +1,49 @@
+import pytest
+import fakeredis.aioredis
+from services import distributed_semaphore as semaphore_module
+from services.redis_service import redis_service
+from services.distributed_semaphore import DistributedSemaphore
+
+pytest.importorskip("lupa")  # fakeredis 执行 Lua 脚本需要 lupa
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """使用 fakeredis 代替真实的 Redis"""
+    monkeypatch.setattr(redis_service, "redis", fakeredis.aioredis.FakeRedis(decode_responses=True))
+    monkeypatch.setattr(semaphore_module, "VLM_AIMD_COOLDOWN_MS", 0)
+
+async def acquire_all(semaphore, count):
+    return [await semaphore.try_acquire(f"user{i}", f"lease{i}") for i in range(count)]
+
+@pytest.mark.asyncio
+async def test_adaptive_window(fake_redis):
+    """测试窗口在上游健康且占满时加性增长，拥塞时乘性减小，并限制在上下限之间"""
+    semaphore = DistributedSemaphore("test", 4, 10, adaptive=True, min_limit=2, max_limit=5)
+    assert await acquire_all(semaphore, 5) == [0, 0, 0, 0, 1]
+
+    # 每个许可增加 1/窗口，大约一个窗口的请求都健康后增加一个许可
+    for _ in range(5):
+        await semaphore.record_success(ttft=0.5)
+    assert int(await semaphore.current_limit()) == 5
+    assert await semaphore.try_acquire("user4", "lease4") == 0
+
+    await semaphore.record_overload("429")
+    assert int(await semaphore.current_limit()) == 3
+    await semaphore.record_success(ttft=60)  # 首token延迟突增
+    await semaphore.record_overload("503")
+    assert await semaphore.current_limit() == 2
+    assert (await semaphore.get_usage())["limit"] == 2
+
+@pytest.mark.asyncio
+async def test_idle_window_does_not_grow(fake_redis):
+    """测试占用不到窗口一半时不增长，不自适应时窗口固定"""
+    semaphore = DistributedSemaphore("idle", 4, 10, adaptive=True, min_limit=2, max_limit=8)
+    await acquire_all(semaphore, 1)
+    for _ in range(10):
+        await semaphore.record_success(ttft=0.5)
+    assert await semaphore.current_limit() == 4
+
+    fixed = DistributedSemaphore("fixed", 2, 10)
+    await fixed.record_overload("429")
+    assert await fixed.current_limit() == 2
+    assert await acquire_all(fixed, 3) == [0, 0, 1]
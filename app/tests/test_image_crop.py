@@ -0,0 +1,52 @@
+from PIL import Image, ImageDraw
+from utils.image_crop import find_content_box
+
+def make_screenshot() -> Image.Image:
+    """生成带工具栏、侧边栏和正文的截图，正文位于 (400, 150) - (1100, 950)"""
+    img = Image.new("L", (1920, 1080), 255)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 1920, 80), fill=210)
+    draw.rectangle((0, 80, 250, 1080), fill=240)
+    for y in range(150, 950, 24):
+        for x in range(400, 1100, 60):
+            draw.rectangle((x, y, x + 45, y + 12), fill=30)
+    return img
+
+def test_crop_to_text_region():
+    """测试裁剪框覆盖正文且去掉工具栏和侧边栏"""
+    left, top, right, bottom = find_content_box(make_screenshot())
+
+    assert 250 <= left <= 400 and 80 <= top <= 150
+    assert 1100 <= right <= 1250 and 950 <= bottom <= 1080
+
+def test_two_pane_screenshot_keeps_both_panes():
+    """测试左边题目描述、右边代码编辑器的分栏截图裁剪后两栏都保留"""
+    img = Image.new("L", (1920, 1080), 255)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 1920, 80), fill=210)
+    draw.line((940, 80, 940, 1080), fill=180, width=2)
+    # 题目描述：行数比代码少
+    for y in range(150, 600, 24):
+        for x in range(120, 700, 60):
+            draw.rectangle((x, y, x + 45, y + 12), fill=30)
+    # 代码模板：缩进不同的代码行，右侧留白
+    for i, y in enumerate(range(150, 950, 24)):
+        for x in range(1060 + (i % 4) * 40, 1600, 60):
+            draw.rectangle((x, y, x + 45, y + 12), fill=30)
+
+    box = find_content_box(img)
+    if box is not None:
+        left, top, right, bottom = box
+        assert left <= 120 and right >= 1600
+        assert top <= 150 and bottom >= 950
+
+def test_fallback_to_full_image():
+    """测试空白图片和铺满内容的图片不裁剪"""
+    assert find_content_box(Image.new("L", (800, 600), 255)) is None
+
+    full = Image.new("L", (800, 600), 255)
+    draw = ImageDraw.Draw(full)
+    for y in range(0, 600, 20):
+        for x in range(0, 800, 50):
+            draw.rectangle((x, y, x + 35, y + 10), fill=0)
+    assert find_content_box(full) is None
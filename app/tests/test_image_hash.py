@@ -0,0 +1,86 @@
+import io
+import random
+import numpy as np
+from PIL import Image, ImageDraw
+from utils.image_hash import dhash, hamming_distance, BKTree, image_fingerprint, thumbnail_distance
+from services.answer_cache import PHASH_MAX_BLOCK_DIFF
+
+def make_image(seed: int, size=(320, 240), fmt="PNG") -> bytes:
+    """生成带随机色块的测试图片"""
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 255, (6, 8), dtype=np.uint8)
+    img = Image.fromarray(blocks).resize(size, Image.NEAREST)
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+def test_hamming_distance():
+    """测试汉明距离"""
+    assert hamming_distance(0b1011, 0b1011) == 0
+    assert hamming_distance(0b1011, 0b0001) == 2
+    assert hamming_distance(0, (1 << 64) - 1) == 64
+
+def test_dhash_stable_under_resize_and_recompress():
+    """测试缩放和重新压缩后哈希基本不变"""
+    original = make_image(1)
+    resized = make_image(1, size=(640, 480), fmt="JPEG")
+    other = make_image(2)
+
+    assert hamming_distance(dhash(original), dhash(resized)) <= 6
+    assert hamming_distance(dhash(original), dhash(other)) > 6
+
+def make_screenshot(lines, dark=True, scale=1.0, fmt="PNG") -> bytes:
+    """生成布局相同、题目文字不同的深色/浅色主题截图"""
+    background, text, panel = ((30, 30, 30), (220, 220, 220), (45, 45, 48)) if dark else \
+        ((255, 255, 255), (30, 30, 30), (240, 240, 240))
+    img = Image.new("RGB", (1280, 800), background)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 1280, 40), fill=panel)
+    draw.rectangle((0, 40, 200, 800), fill=panel)
+    for i, line in enumerate(lines):
+        draw.text((240, 80 + i * 28), line, fill=text)
+    for i in range(12):
+        draw.text((720, 80 + i * 22), "    def solve(self): pass", fill=text)
+    if scale != 1.0:
+        img = img.resize((int(1280 * scale), int(800 * scale)))
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, quality=80)
+    return buffer.getvalue()
+
+def test_fingerprint_rejects_different_problems_with_same_layout():
+    """测试同一布局下不同题目的截图不会被确认为近似重复，重新压缩缩放的同一截图可以确认"""
+    two_sum = ["1. Two Sum", "Given an array of integers nums and an integer target,",
+               "return indices of the two numbers such that they add up to target.", "Output: [0,1]"]
+    rain = ["42. Trapping Rain Water", "Given n non-negative integers representing an elevation map",
+            "compute how much water it can trap after raining.", "Output: 6"]
+    for dark in (True, False):
+        original = image_fingerprint(make_screenshot(two_sum, dark))
+        other = image_fingerprint(make_screenshot(rain, dark))
+        resized = image_fingerprint(make_screenshot(two_sum, dark, scale=0.75, fmt="JPEG"))
+
+        assert thumbnail_distance(original.thumbnail, other.thumbnail) > PHASH_MAX_BLOCK_DIFF
+        assert thumbnail_distance(original.thumbnail, resized.thumbnail) <= PHASH_MAX_BLOCK_DIFF
+
+def test_bktree_search_matches_linear_scan():
+    """测试BK树查询结果与线性扫描一致"""
+    rng = random.Random(42)
+    items = [rng.getrandbits(64) for _ in range(2000)]
+    tree = BKTree(items)
+    assert len(tree) == len(set(items))
+
+    query = items[100] ^ 0b101  # 距离为2的近似值
+    expected = sorted(
+        (hamming_distance(query, item), item)
+        for item in set(items)
+        if hamming_distance(query, item) <= 10
+    )
+    assert tree.search(query, 10) == expected
+    assert tree.search(query, 10)[0] == (2, items[100])
+
+def test_bktree_ignores_duplicates():
+    """测试重复插入"""
+    tree = BKTree()
+    assert tree.add(5) is True
+    assert tree.add(5) is False
+    assert len(tree) == 1
+    assert BKTree().search(1, 3) == []
@@ -0,0 +1,81 @@
+import asyncio
+import time
+import pytest
+import fakeredis.aioredis
+from services import image_store as image_store_module
+from services import image_lifecycle as image_lifecycle_module
+from services.redis_service import redis_service, TASK_TTL
+from services.blob_storage import LocalBlobStorage
+from services.image_store import ImageStore, INVENTORY_KEY
+from services.image_lifecycle import ImageLifecycleManager
+
+pytest.importorskip("lupa")
+
+SHA = "ab" + "cd" + "0" * 60
+KEY = f"ab/cd/{SHA}.png"
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """使用 fakeredis 和临时目录，删除不限速"""
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    storage = LocalBlobStorage(str(tmp_path / "blobs"))
+    monkeypatch.setattr(redis_service, "redis", redis)
+    monkeypatch.setattr(image_store_module, "blob_storage", storage)
+    monkeypatch.setattr(image_lifecycle_module, "blob_storage", storage)
+    monkeypatch.setattr(image_store_module, "TMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(image_lifecycle_module, "UPLOAD_DIR", str(tmp_path / "legacy"))
+    monkeypatch.setattr(image_lifecycle_module, "TMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(image_lifecycle_module, "IMAGE_GC_DELETES_PER_SECOND", 1000)
+    return redis, storage
+
+async def commit(content: bytes):
+    path = ImageStore.new_temp_path()
+    with open(path, "wb") as f:
+        f.write(content)
+    return await ImageStore.commit(path, SHA, "image/png")
+
+@pytest.mark.asyncio
+async def test_referenced_blob_is_kept(store):
+    """测试清单时间已过期但仍被引用的文件不删除，并刷新清单时间"""
+    redis, storage = store
+    await commit(b"image")
+    expired = time.time() - TASK_TTL * 2
+    await redis.zadd(INVENTORY_KEY, {KEY: expired})
+    await redis.sadd(f"image_blob_refs:{SHA}", "upload.png")
+
+    summary = await ImageLifecycleManager().run_once(dry_run=False)
+    assert (summary["kept"], summary["deleted"]) == (1, 0)
+    assert await storage.exists(KEY)
+    assert await redis.zscore(INVENTORY_KEY, KEY) > expired
+
+    await redis.delete(f"image_blob_refs:{SHA}")
+    await redis.zadd(INVENTORY_KEY, {KEY: expired})
+    summary = await ImageLifecycleManager().run_once(dry_run=False)
+    assert summary["deleted"] == 1
+    assert not await storage.exists(KEY)
+
+@pytest.mark.asyncio
+async def test_commit_waits_for_running_delete(store, monkeypatch):
+    """测试检查通过后、删除完成前重新上传相同内容时，上传等待删除完成后重新保存"""
+    redis, storage = store
+    await commit(b"image")
+    await redis.zadd(INVENTORY_KEY, {KEY: time.time() - TASK_TTL * 2})
+
+    manager = ImageLifecycleManager()
+    delete_blob = manager._delete_blob
+    uploading = None
+
+    async def slow_delete(key):
+        # 已加删除标记，此时开始上传相同内容
+        nonlocal uploading
+        uploading = asyncio.create_task(commit(b"image"))
+        await asyncio.sleep(0.2)
+        assert not uploading.done()
+        return await delete_blob(key)
+
+    monkeypatch.setattr(manager, "_delete_blob", slow_delete)
+    assert (await manager.run_once(dry_run=False))["deleted"] == 1
+
+    assert await uploading == (KEY, False)
+    assert await storage.exists(KEY)
+    assert await redis.zscore(INVENTORY_KEY, KEY) is not None
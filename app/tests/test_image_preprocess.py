@@ -0,0 +1,45 @@
+import io
+import numpy as np
+from PIL import Image
+from utils.image_preprocess import preprocess_image
+
+def make_photo(size=(4000, 3000), orientation=None) -> bytes:
+    """生成带噪点的大尺寸 JPEG，可选写入 EXIF 方向"""
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 255, (size[1] // 10, size[0] // 10, 3), dtype=np.uint8)
+    img = Image.fromarray(pixels).resize(size, Image.BILINEAR)
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    img.save(buffer, format="JPEG", quality=95, exif=exif)
+    return buffer.getvalue()
+
+def test_downsize_and_grayscale():
+    """测试大图缩小到最长边并转为灰度 JPEG"""
+    content = make_photo()
+    output, info = preprocess_image(content, max_edge=1600)
+
+    assert output is not None
+    assert info["output_bytes"] < info["original_bytes"]
+    with Image.open(io.BytesIO(output)) as img:
+        assert img.format == "JPEG"
+        assert img.mode == "L"
+        assert img.size == (1600, 1200)
+
+def test_exif_orientation_is_applied():
+    """测试按 EXIF 方向旋转（6 表示顺时针旋转90度）"""
+    output, info = preprocess_image(make_photo(orientation=6), max_edge=1600, output_format="WEBP")
+
+    assert info["mime_type"] == "image/webp"
+    with Image.open(io.BytesIO(output)) as img:
+        assert img.size == (1200, 1600)
+
+def test_small_image_keeps_original():
+    """测试重新编码后不更小时返回 None"""
+    buffer = io.BytesIO()
+    Image.new("L", (64, 64), 255).save(buffer, format="PNG")
+    output, info = preprocess_image(buffer.getvalue())
+
+    assert output is None
+    assert info["output_bytes"] >= info["original_bytes"]
@@ -0,0 +1,43 @@
+import io
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+from utils.image_quality import check_image_quality
+
+def encode(img: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+def make_text_photo(size=(1600, 1200), brightness=1.0) -> Image.Image:
+    """生成类似文字截图的黑白条纹图片"""
+    rng = np.random.default_rng(0)
+    pixels = np.where(rng.random((size[1] // 8, size[0] // 8)) > 0.7, 20, 235).astype(np.uint8)
+    img = Image.fromarray(pixels).resize(size, Image.NEAREST)
+    return img.point(lambda v: int(v * brightness))
+
+def test_clear_image_passes():
+    """测试清晰图片通过检查"""
+    assert check_image_quality(encode(make_text_photo())) is None
+
+def test_dark_theme_screenshot_passes():
+    """测试黑色背景的代码截图平均亮度很低，但不会被判定为过暗"""
+    img = Image.new("RGB", (1600, 1000), (8, 8, 8))
+    draw = ImageDraw.Draw(img)
+    for i in range(30):
+        draw.text((40, 30 + i * 30), "for (int i = 0; i < n; ++i) { sum += nums[i] * weight; }", fill=(200, 200, 200))
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+
+    assert check_image_quality(buffer.getvalue()) is None
+
+def test_rejections():
+    """测试模糊、过暗、分辨率过低和无法解析的图片被拒绝并给出原因"""
+    blurry = make_text_photo().filter(ImageFilter.GaussianBlur(12))
+    assert check_image_quality(encode(blurry))["reason"] == "blurry"
+
+    dark = check_image_quality(encode(make_text_photo(brightness=0.08)))
+    assert dark["reason"] == "too_dark"
+    assert dark["metrics"]["brightness"] < 25
+
+    assert check_image_quality(encode(make_text_photo(size=(320, 160))))["reason"] == "low_resolution"
+    assert check_image_quality(b"\xff\xd8not a jpeg")["reason"] == "unreadable"
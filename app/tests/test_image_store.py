@@ -0,0 +1,97 @@
+import os
+import pytest
+from unittest.mock import patch, AsyncMock
+from services import image_store as image_store_module
+from services.image_store import ImageStore, blob_key, derivative_key
+from services.blob_storage import LocalBlobStorage
+
+SHA = "ab" + "cd" + "0" * 60
+
+# 模拟Redis，只实现存储清单用到的命令
+class MockRedis:
+    def __init__(self):
+        self.zsets = {}
+        self.hashes = {}
+
+    async def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    async def eval(self, script, numkeys, inventory_key, deleting_key, score, key):
+        """只模拟更新引用时间的脚本，没有删除标记"""
+        await self.zadd(inventory_key, {key: score})
+        return 1
+
+    async def hset(self, key, field, value):
+        h = self.hashes.setdefault(key, {})
+        is_new = field not in h
+        h[field] = str(value)
+        return int(is_new)
+
+    async def hincrby(self, key, field, amount=1):
+        h = self.hashes.setdefault(key, {})
+        h[field] = str(int(h.get(field, 0)) + amount)
+
+    def pipeline(self):
+        return MockPipeline(self)
+
+class MockPipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append(getattr(self.redis, name)(*args, **kwargs))
+
+    async def execute(self):
+        return [await call for call in self.calls]
+
+@pytest.fixture
+def store_dirs(tmp_path, monkeypatch):
+    """把存储目录指向临时目录"""
+    monkeypatch.setattr(image_store_module, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(image_store_module, "blob_storage", LocalBlobStorage(str(tmp_path / "blobs")))
+    monkeypatch.setattr(image_store_module, "TMP_DIR", str(tmp_path / "tmp"))
+    monkeypatch.setattr(image_store_module.redis_service, "redis", MockRedis())
+    return tmp_path
+
+def write_temp(content: bytes) -> str:
+    path = ImageStore.new_temp_path()
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+def test_keys_are_sharded():
+    """测试存储键按哈希前缀分为两级目录"""
+    assert blob_key(SHA, ".jpg") == f"ab/cd/{SHA}.jpg"
+    assert derivative_key(f"ab/cd/{SHA}.png", ".jpg") == f"ab/cd/{SHA}.vlm.jpg"
+
+@pytest.mark.asyncio
+async def test_commit_deduplicates(store_dirs):
+    """测试相同内容只保存一份，重复上传删除临时文件"""
+    key, existed = await ImageStore.commit(write_temp(b"image"), SHA, "image/png")
+    assert (key, existed) == (f"ab/cd/{SHA}.png", False)
+    assert open(store_dirs / "blobs" / "ab" / "cd" / f"{SHA}.png", "rb").read() == b"image"
+
+    second = write_temp(b"image")
+    assert await ImageStore.commit(second, SHA, "image/png") == (key, True)
+    assert not os.path.exists(second)
+    assert os.listdir(store_dirs / "tmp") == []
+
+    # 只有第一次保存计入存储用量，两次都更新引用时间
+    redis = image_store_module.redis_service.redis
+    assert redis.hashes[image_store_module.USAGE_KEY] == {"files": "1", "bytes": "5"}
+    assert key in redis.zsets[image_store_module.INVENTORY_KEY]
+
+@pytest.mark.asyncio
+async def test_resolve_through_reference(store_dirs):
+    """测试上传ID通过引用解析到内容文件，没有引用的旧上传按平铺目录查找"""
+    key, _ = await ImageStore.commit(write_temp(b"image"), SHA, "image/png")
+    (store_dirs / "legacy.png").write_bytes(b"old")
+
+    references = {"new.png": {"blob": key}}
+    with patch("services.image_store.redis_service") as mock_service:
+        mock_service.get_image_meta = AsyncMock(side_effect=lambda upload_id: references.get(upload_id, {}))
+        assert await ImageStore.resolve("new.png") == await ImageStore.local_path(key)
+        assert await ImageStore.resolve("legacy.png") == str(store_dirs / "legacy.png")
+        assert await ImageStore.resolve("missing.png") is None
+        assert await ImageStore.resolve("../blobs") is None
@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+from sqlalchemy.exc import DataError
+from services.metering import Metering, Rate, load_rate_table, SOURCE_UPSTREAM
+
+def test_price_from_rate_table():
+    """测试按模型费率计价：图片 token 单独计价、前缀匹配、最低收费和上限"""
+    rates = load_rate_table(
+        '{"default": {"prompt": 1, "completion": 2}, '
+        '"qwen-vl-max": {"prompt": 3, "completion": 9, "image": 2, "minimum": 0.05}}'
+    )
+    metering = Metering(rates=rates)
+    usage = {"prompt_tokens": 1000, "completion_tokens": 500, "image_tokens": 800}
+
+    # (200 × 3 + 800 × 2 + 500 × 9) / 1000
+    assert metering.price(usage, "qwen-vl-max-2025-01-25", fallback=1.0) == 6.7
+    assert metering.price(usage, "other-model", fallback=1.0) == 2.0
+    assert metering.price(usage, "qwen-vl-max", fallback=1.0, cap=1.0) == 1.0
+    assert metering.price({"prompt_tokens": 1}, "qwen-vl-max", fallback=1.0) == 0.05
+
+def test_price_falls_back_to_flat_fee():
+    """测试没有用量、没有费率或费率表格式错误时按固定费用收费"""
+    assert load_rate_table("not json") == {}
+    metering = Metering(rates={"qwen-vl-max": Rate(1, 1, 1, 0)})
+    assert metering.price(None, "qwen-vl-max", fallback=1.0) == 1.0
+    assert metering.price({"prompt_tokens": 100}, "gpt-4o", fallback=1.0) == 1.0
+
+@pytest.mark.asyncio
+async def test_records_are_written_in_batches():
+    """测试用量记录攒够批量后写入，写入失败时保留到下次"""
+    metering = Metering(rates={}, batch_size=2, flush_interval=60)
+    batches = []
+    metering._write = batches.append
+    metering.start()
+
+    metering.record("t1", "1", SOURCE_UPSTREAM, "completed", 0.5, {"prompt_tokens": 10}, "m", "python", 1024)
+    await asyncio.sleep(0.05)
+    assert batches == []
+
+    metering.record("t2", "1", SOURCE_UPSTREAM, "completed", 0.5)
+    await asyncio.sleep(0.05)
+    assert [record["task_id"] for record in batches[0]] == ["t1", "t2"]
+    assert batches[0][0]["prompt_tokens"] == 10
+
+    def fail(batch):
+        raise RuntimeError("database unavailable")
+
+    metering._write = fail
+    metering.record("t3", "1", SOURCE_UPSTREAM, "failed", 0)
+    assert await metering.flush() == 0
+    metering._write = batches.append
+    await metering.close()
+    assert [record["task_id"] for record in batches[1]] == ["t3"]
+
+@pytest.mark.asyncio
+async def test_rejected_record_is_isolated():
+    """测试数据库拒绝某条记录时只丢弃该条，其余照常写入；超长的模型名和编程语言在登记时处理"""
+    metering = Metering(rates={})
+    written = []
+
+    def write(batch):
+        if any(record["task_id"] == "bad" for record in batch):
+            raise DataError("INSERT INTO usage_records", {}, Exception("value too long"))
+        written.extend(batch)
+
+    metering._write = write
+    for task_id in ("t1", "bad", "t2", "t3"):
+        metering.record(task_id, "1", SOURCE_UPSTREAM, "completed", 0.5, model="m" * 300, programming_language="x" * 300)
+
+    assert await metering.flush() == 3
+    assert sorted(record["task_id"] for record in written) == ["t1", "t2", "t3"]
+    assert metering._buffer == []
+    assert len(written[0]["model"]) == 100
+    assert written[0]["programming_language"] == "other"
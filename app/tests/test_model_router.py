@@ -0,0 +1,131 @@
+import asyncio
+import httpx
+import openai
+import pytest
+import fakeredis.aioredis
+from types import SimpleNamespace
+from services import model_router as model_router_module
+from services.distributed_semaphore import DistributedSemaphore
+from services.redis_service import redis_service
+from services.model_router import ModelRouter
+from services.vlm_client import VLMBackend
+
+def make_chunk(content):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+class FakeStream:
+    """模拟上游流式响应，delay 秒后开始产出分片"""
+    def __init__(self, contents, delay=0.0):
+        self.contents = contents
+        self.delay = delay
+        self.closed = False
+
+    async def _iterate(self):
+        await asyncio.sleep(self.delay)
+        for content in self.contents:
+            yield make_chunk(content)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def close(self):
+        self.closed = True
+
+class FakeClient:
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.streams = []
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        if isinstance(self.behaviour, Exception):
+            raise self.behaviour
+        stream = FakeStream(*self.behaviour)
+        self.streams.append(stream)
+        return stream
+
+@pytest.fixture
+def backends(monkeypatch):
+    """配置两个模拟后端"""
+    clients = {}
+    manager = SimpleNamespace(
+        backends=[VLMBackend("primary", None, None, "m1"), VLMBackend("backup", None, None, "m2")],
+        get_client=lambda name: clients[name],
+    )
+    monkeypatch.setattr(model_router_module, "vlm_client_manager", manager)
+    monkeypatch.setattr(model_router_module, "VLM_HEDGE_DELAY", 0.05)
+    monkeypatch.setattr(redis_service, "redis", fakeredis.aioredis.FakeRedis(decode_responses=True))
+    return clients
+
+async def collect(router):
+    return [chunk.choices[0].delta.content async for chunk in router.stream([])]
+
+@pytest.mark.asyncio
+async def test_hedge_uses_faster_backend(backends):
+    """测试主后端超过延迟预算时发起对冲请求，采用先产出的一方并关闭另一方"""
+    backends["primary"] = FakeClient((["slow"], 1.0))
+    backends["backup"] = FakeClient((["fast", "!"], 0.0))
+    router = ModelRouter()
+
+    assert await collect(router) == ["fast", "!"]
+    assert backends["primary"].streams[0].closed
+    stats = {item["name"]: item for item in router.get_stats()["backends"]}
+    assert stats["backup"]["hedges"] == 1 and stats["backup"]["wins"] == 1
+    # 被取消的慢请求计入延迟，下一次优先使用更快的后端
+    assert [backend.name for backend in router.ranked_backends()] == ["backup", "primary"]
+
+@pytest.mark.asyncio
+async def test_hedge_requires_free_permit(backends, monkeypatch):
+    """测试对冲请求需要额外的上游并发许可：许可用完时不对冲，对冲结束后释放许可"""
+    semaphore = DistributedSemaphore("test", limit=2, per_user_limit=2)
+    monkeypatch.setattr(model_router_module, "vlm_semaphore", semaphore)
+    backends["primary"] = FakeClient((["slow"], 0.3))
+    backends["backup"] = FakeClient((["fast"], 0.0))
+    router = ModelRouter()
+
+    # 调用方持有一个许可，另一个许可被其他用户占用
+    assert await semaphore.try_acquire("1", "caller") == 0
+    assert await semaphore.try_acquire("2", "other") == 0
+    assert [chunk.choices[0].delta.content async for chunk in router.stream([], user_id="1")] == ["slow"]
+    assert backends["backup"].calls == 0
+    assert (await semaphore.get_usage())["waiting"] == 0
+
+    # 有空闲许可时对冲，竞争结束后只剩调用方的许可
+    await semaphore.release("2", "other")
+    router = ModelRouter()
+    assert [chunk.choices[0].delta.content async for chunk in router.stream([], user_id="1")] == ["fast"]
+    assert backends["backup"].calls == 1
+    assert router.get_stats()["backends"][0]["hedges"] == 1
+    assert (await semaphore.get_usage())["in_use"] == 1
+
+@pytest.mark.asyncio
+async def test_failover_on_server_error(backends):
+    """测试主后端返回 5xx 时切换到下一个后端"""
+    response = httpx.Response(503, request=httpx.Request("POST", "http://upstream"))
+    backends["primary"] = FakeClient(openai.InternalServerError("unavailable", response=response, body=None))
+    backends["backup"] = FakeClient((["ok"], 0.0))
+    router = ModelRouter()
+
+    assert await collect(router) == ["ok"]
+    stats = {item["name"]: item for item in router.get_stats()["backends"]}
+    assert stats["primary"]["failures"] == 1
+    assert stats["backup"]["wins"] == 1
+
+@pytest.mark.asyncio
+async def test_always_failing_backend_is_ranked_last(backends):
+    """测试主后端每次都在首个token之前失败（没有延迟样本）时，按错误率排到最后，后续请求不再先打到主后端"""
+    response = httpx.Response(503, request=httpx.Request("POST", "http://upstream"))
+    backends["primary"] = FakeClient(openai.InternalServerError("unavailable", response=response, body=None))
+    backends["backup"] = FakeClient((["ok"], 0.0))
+    router = ModelRouter()
+
+    assert await collect(router) == ["ok"]
+    assert [backend.name for backend in router.ranked_backends()] == ["backup", "primary"]
+
+    # 备用后端的延迟样本为0时主后端仍然排在后面
+    for _ in range(3):
+        assert await collect(router) == ["ok"]
+    assert backends["primary"].calls == 1
+    assert backends["backup"].calls == 4
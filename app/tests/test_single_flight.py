@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+import fakeredis.aioredis
+from services import single_flight as single_flight_module
+from services.redis_service import redis_service
+from services.single_flight import SingleFlight, SingleFlightError, LOCK_PREFIX
+
+pytest.importorskip("lupa")
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """使用 fakeredis 代替真实的 Redis，锁的过期时间缩短为1秒"""
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_service, "redis", redis)
+    monkeypatch.setattr(single_flight_module, "SINGLE_FLIGHT_LOCK_TTL", 1)
+    return redis
+
+async def slow_events(delay):
+    """模拟排队等待并发许可期间没有任何事件"""
+    await asyncio.sleep(delay)
+    yield "message", "answer"
+    yield "done", None
+
+@pytest.mark.asyncio
+async def test_lock_is_renewed_while_leader_is_quiet(fake_redis):
+    """测试领导者长时间没有事件时锁不会过期，相同任务仍然跟随同一个领导者"""
+    assert await SingleFlight.acquire("k", "leader") == "leader"
+
+    async def lead():
+        return [event async for event in SingleFlight.lead("k", "leader", slow_events(2.5))]
+
+    leader = asyncio.create_task(lead())
+    await asyncio.sleep(2)
+    assert await SingleFlight.acquire("k", "second") == "leader"
+
+    followed = [event async for event in SingleFlight.follow("k", "leader")]
+    assert followed == [("message", "answer"), ("done", None)]
+    assert await leader == [("message", "answer"), ("done", None)]
+
+@pytest.mark.asyncio
+async def test_leader_without_lock_cannot_publish(fake_redis):
+    """测试锁易主后旧领导者不能再写入，它的跟随者也会尽快失败"""
+    assert await SingleFlight.acquire("k", "old") == "old"
+    await fake_redis.set(f"{LOCK_PREFIX}:k", "new")
+
+    with pytest.raises(SingleFlightError):
+        async for _ in SingleFlight.lead("k", "old", slow_events(0)):
+            pass
+    with pytest.raises(SingleFlightError):
+        async for _ in SingleFlight.follow("k", "old"):
+            pass
@@ -0,0 +1,30 @@
+import json
+from utils.sse import encode_event
+
+def parse_data(frame: bytes):
+    """取出帧中的 data 字段"""
+    for line in frame.decode("utf-8").split("\n"):
+        if line.startswith("data: "):
+            return line[len("data: "):]
+    return None
+
+def test_message_keeps_legacy_schema_with_raw_utf8():
+    """测试默认格式保持 role/content 字段且中文不转义"""
+    frame = encode_event("message", "你好")
+    assert frame.startswith(b"event: message\ndata: ")
+    assert frame.endswith(b"\n\n")
+    assert "你好".encode("utf-8") in frame
+    assert json.loads(parse_data(frame)) == {"role": "assistant", "content": "你好"}
+
+def test_compact_message():
+    """测试精简格式省略 event 行和 role 字段"""
+    frame = encode_event("message", "a\nb", event_id="1-0", compact=True)
+    assert frame.startswith(b"id: 1-0\ndata: ")
+    assert json.loads(parse_data(frame)) == {"c": "a\nb"}
+
+def test_other_events():
+    """测试非 message 事件的编码"""
+    assert encode_event("done") == b"event: done\ndata: \n\n"
+    assert json.loads(parse_data(encode_event("queue", {"position": 3}))) == {"position": 3}
+    # 字符串数据视为已序列化内容原样输出
+    assert encode_event("error", '{"error": "x"}', "5-1") == b'id: 5-1\nevent: error\ndata: {"error": "x"}\n\n'
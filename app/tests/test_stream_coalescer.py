@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+from utils.stream_coalescer import coalesce_events
+
+async def make_source(delays, tail=(("usage", "u"), ("done", None))):
+    """按给定间隔产出文本增量的模拟上游"""
+    for i, delay in enumerate(delays):
+        await asyncio.sleep(delay)
+        yield "message", f"t{i}"
+    for item in tail:
+        yield item
+
+@pytest.mark.asyncio
+async def test_first_token_not_delayed_and_rest_merged():
+    """测试首个增量立即输出，后续增量按时间窗口合并"""
+    events = [e async for e in coalesce_events(make_source([0, 0, 0, 0]), 0.05, 512)]
+    assert events[0] == ("message", "t0")
+    assert events[1] == ("message", "t1t2t3")
+    assert events[2:] == [("usage", "u"), ("done", None)]
+
+@pytest.mark.asyncio
+async def test_flush_by_bytes():
+    """测试累积到字节阈值后立即输出"""
+    events = [e async for e in coalesce_events(make_source([0] * 5), 10, 4)]
+    assert [d for e, d in events if e == "message"] == ["t0", "t1t2", "t3t4"]
+
+@pytest.mark.asyncio
+async def test_flush_by_interval():
+    """测试上游停顿超过时间窗口时输出已累积内容"""
+    events = [e async for e in coalesce_events(make_source([0, 0, 0.1, 0]), 0.02, 512)]
+    assert [d for e, d in events if e == "message"] == ["t0", "t1", "t2t3"]
+
+@pytest.mark.asyncio
+async def test_disabled_passthrough():
+    """测试参数为0时逐条透传"""
+    events = [e async for e in coalesce_events(make_source([0] * 3), 0, 512)]
+    assert [d for e, d in events if e == "message"] == ["t0", "t1", "t2"]
+
+@pytest.mark.asyncio
+async def test_error_flushes_buffer_then_raises():
+    """测试上游出错时先输出已累积内容再抛出异常"""
+    async def failing():
+        yield "message", "a"
+        yield "message", "b"
+        raise ValueError("upstream error")
+
+    received = []
+    with pytest.raises(ValueError):
+        async for event in coalesce_events(failing(), 10, 512):
+            received.append(event)
+    assert received == [("message", "a"), ("message", "b")]
@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+import fakeredis.aioredis
+from services.redis_service import redis_service
+from services.task_cancellation import TaskCancellation, REASON_DISCONNECT
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """使用 fakeredis 代替真实的 Redis"""
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_service, "redis", redis)
+    return redis
+
+async def wait_until(predicate, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+@pytest.mark.asyncio
+async def test_last_disconnect_cancels_running_task(fake_redis):
+    """测试最后一个连接断开时取消生成并标记任务已取消，仍有其他连接时不取消"""
+    cancellation = TaskCancellation()
+    cancellation.start()
+    await redis_service.create_task("t1", {"user_id": "1"})
+    generation = asyncio.create_task(asyncio.sleep(60))
+    cancellation.register("t1", generation)
+    await asyncio.sleep(0.05)  # 等待订阅完成
+
+    await cancellation.attach("t1")
+    await cancellation.attach("t1")
+    cancellation.detach("t1", disconnected=True)
+    await asyncio.sleep(0.1)
+    assert not generation.done()
+
+    cancellation.detach("t1", disconnected=True)
+    await wait_until(generation.done)
+    assert generation.cancelled()
+    assert (await redis_service.get_task("t1"))["status"] == "cancelled"
+    await cancellation.close()
+
+@pytest.mark.asyncio
+async def test_completed_stream_does_not_cancel(fake_redis):
+    """测试正常读完事件流不会取消任务，已完成的任务也不会被标记为取消"""
+    cancellation = TaskCancellation()
+    await redis_service.create_task("t2", {"user_id": "1"})
+    await cancellation.attach("t2")
+    cancellation.detach("t2", disconnected=False)
+    await cancellation.close()
+    assert (await redis_service.get_task("t2"))["status"] == "pending"
+
+    await redis_service.update_task_status("t2", "completed")
+    assert not await cancellation.request("t2", REASON_DISCONNECT)
+
+@pytest.mark.asyncio
+async def test_attach_timeout_cancels_unattached_task(fake_redis):
+    """测试提前开始生成的任务超时没有连接时被取消，打开过事件流的任务不受影响"""
+    cancellation = TaskCancellation()
+    await redis_service.create_task("t3", {"user_id": "1"})
+    await redis_service.create_task("t4", {"user_id": "1"})
+    await cancellation.attach("t4")
+    cancellation.detach("t4", disconnected=False)
+
+    cancellation.watch_attach("t3", timeout=0.05)
+    cancellation.watch_attach("t4", timeout=0.05)
+    await asyncio.sleep(0.2)
+    assert (await redis_service.get_task("t3"))["status"] == "cancelled"
+    assert (await redis_service.get_task("t4"))["status"] == "pending"
+    await cancellation.close()
@@ -0,0 +1,56 @@
+import pytest
+import fakeredis.aioredis
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from services.redis_service import redis_service
+from services.task_metrics import TaskMetrics, MetricsRegistry, usage_to_dict
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """使用 fakeredis 代替真实的 Redis"""
+    monkeypatch.setattr(redis_service, "redis", fakeredis.aioredis.FakeRedis(decode_responses=True))
+
+def test_usage_to_dict():
+    """测试上游 usage 对象和字典都能转换为 token 数"""
+    usage = SimpleNamespace(prompt_tokens=800, completion_tokens=300, total_tokens=1100)
+    assert usage_to_dict(usage) == {"prompt_tokens": 800, "completion_tokens": 300, "total_tokens": 1100}
+    assert usage_to_dict({"completion_tokens": 5}) == {"completion_tokens": 5}
+    assert usage_to_dict("not usage") is None
+
+    # 图片 token 在 prompt_tokens_details 中，跟随者收到的是 JSON 字符串
+    usage = SimpleNamespace(
+        prompt_tokens=800, completion_tokens=300, total_tokens=1100,
+        prompt_tokens_details=SimpleNamespace(image_tokens=600, cached_tokens=None)
+    )
+    assert usage_to_dict(usage)["image_tokens"] == 600
+    assert usage_to_dict('{"prompt_tokens": 8, "model": "m"}') == {"prompt_tokens": 8}
+
+@pytest.mark.asyncio
+async def test_record_and_export(fake_redis):
+    """测试任务性能摘要保存到任务信息，并按 model 和 language 导出累积直方图"""
+    await redis_service.create_task("t1", {"programming_language": "Python"})
+    task = await redis_service.get_task("t1")
+    task["created_at"] = (datetime.now() - timedelta(seconds=2)).isoformat()
+
+    metrics = TaskMetrics(task)
+    metrics.model = "qwen-omni-turbo"
+    metrics.semaphore_wait = 0.3
+    metrics.upstream_ttft = 1.2
+    metrics.usage = {"prompt_tokens": 800, "completion_tokens": 300}
+    metrics.mark_first_byte()
+    metrics.finish()
+    await MetricsRegistry.record("t1", task, metrics, "completed")
+
+    summary = (await redis_service.get_task("t1"))["metrics"]
+    assert summary["model"] == "qwen-omni-turbo"
+    assert 2 <= summary["queue_wait_seconds"] < 3
+    assert summary["upstream_ttft_seconds"] == 1.2
+
+    text = await MetricsRegistry.export()
+    labels = 'model="qwen-omni-turbo",language="python"'
+    assert f'vlm_upstream_ttft_seconds_bucket{{{labels},le="1"}} 0' in text
+    assert f'vlm_upstream_ttft_seconds_bucket{{{labels},le="2"}} 1' in text
+    assert f'vlm_upstream_ttft_seconds_bucket{{{labels},le="+Inf"}} 1' in text
+    assert f'vlm_semaphore_wait_seconds_count{{{labels}}} 1' in text
+    assert f'vlm_tokens_total{{{labels},type="completion"}} 300' in text
+    assert f'vlm_tasks_total{{{labels},status="completed"}} 1' in text
@@ -0,0 +1,31 @@
+import asyncio
+import pytest
+import fakeredis.aioredis
+from services import task_queue as task_queue_module
+from services.redis_service import redis_service
+from services.task_queue import TaskQueue, QUEUE_GROUP
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """使用 fakeredis 代替真实的 Redis，租约时间缩短为1秒"""
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_service, "redis", redis)
+    monkeypatch.setattr(task_queue_module, "VLM_QUEUE_LEASE_TTL", 1)
+    return redis
+
+@pytest.mark.asyncio
+async def test_lease_keeps_long_running_task_from_being_reclaimed(fake_redis):
+    """测试执行时间超过租约时间的任务仍被视为在执行，消息也不会变成空闲"""
+    await TaskQueue.ensure_groups()
+    await TaskQueue.enqueue("t1", "1")
+    lane, message_id, _ = await TaskQueue.read("worker-a", block_ms=10)
+
+    async with TaskQueue.lease(lane, message_id, "t1", "worker-a"):
+        await asyncio.sleep(1.5)
+        assert await TaskQueue.is_running("t1")
+        pending = await fake_redis.xpending_range(
+            TaskQueue.stream_key(lane), QUEUE_GROUP, min="-", max="+", count=1
+        )
+        assert pending[0]["time_since_delivered"] < 1000
+
+    assert not await TaskQueue.is_running("t1")
@@ -0,0 +1,132 @@
+import asyncio
+import pytest
+import fakeredis.aioredis
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+from services import vlm_task as vlm_task_module
+from services import single_flight as single_flight_module
+from services.redis_service import redis_service
+from services.metering import Metering
+from services.task_cancellation import task_cancellation, REASON_USER, REASON_DISCONNECT
+from services.vlm_task import TaskImage, execute_task, start_task_in_background, SERVICE_FEE
+
+IMAGE = TaskImage(b"image", "image/png", "0" * 64)
+
+def make_task(flush_interval_ms=None):
+    return {
+        "user_id": "1",
+        "image_url": "/images/upload.png",
+        "programming_language": "python",
+        "flush_interval_ms": flush_interval_ms,
+    }
+
+def upstream(*events, hang=False):
+    """模拟上游事件流，hang 时产出全部事件后一直等待"""
+    async def vlm_events(image_bytes, mime_type, user_question, user_id="anonymous", metrics=None):
+        for event in events:
+            yield event
+        if hang:
+            await asyncio.sleep(60)
+    return vlm_events
+
+@pytest.fixture
+def billing(monkeypatch):
+    """模拟账户、答案缓存和上游，用量记录保留在内存缓冲区中"""
+    monkeypatch.setattr(redis_service, "redis", fakeredis.aioredis.FakeRedis(decode_responses=True))
+    monkeypatch.setattr(single_flight_module, "SINGLE_FLIGHT_ENABLED", False)
+    cache = vlm_task_module.answer_cache
+    monkeypatch.setattr(cache, "get", AsyncMock(return_value=None))
+    monkeypatch.setattr(cache, "set", AsyncMock())
+    monkeypatch.setattr(cache, "get_image_fingerprint", AsyncMock(return_value=None))
+    monkeypatch.setattr(vlm_task_module.task_metrics, "record", AsyncMock())
+
+    accounts = SimpleNamespace(
+        pre_charge=MagicMock(), update=MagicMock(return_value=0), refund=MagicMock(), metering=Metering(rates={})
+    )
+    monkeypatch.setattr(vlm_task_module, "pre_charge_balance", accounts.pre_charge)
+    monkeypatch.setattr(vlm_task_module, "update_balance", accounts.update)
+    monkeypatch.setattr(vlm_task_module, "refund_balance", accounts.refund)
+    monkeypatch.setattr(vlm_task_module, "metering", accounts.metering)
+    return accounts
+
+def recorded(billing):
+    return [(record["status"], float(record["amount"])) for record in billing.metering._buffer]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("flush_interval_ms", [None, 0])
+async def test_cancel_during_publish_settles_before_task_ends(billing, monkeypatch, flush_interval_ms):
+    """测试取消发生在写入事件流期间时，任务结束前完成退款和用量登记（合并输出和不合并两种路径）"""
+    monkeypatch.setattr(vlm_task_module, "vlm_events", upstream(("message", "partial"), hang=True))
+    publishing = asyncio.Event()
+
+    async def slow_publish(task_id, event, data=None):
+        if event == "message":
+            publishing.set()
+            await asyncio.sleep(60)
+
+    monkeypatch.setattr(vlm_task_module.task_stream, "publish", slow_publish)
+    background = start_task_in_background("t1", make_task(flush_interval_ms), IMAGE)
+    await asyncio.wait_for(publishing.wait(), timeout=2)
+
+    task_cancellation._cancel_local("t1", REASON_DISCONNECT)
+    await background
+
+    billing.refund.assert_called_once_with(user_id=1, amount=SERVICE_FEE, task_id="t1")
+    assert [record["status"] for record in billing.metering._buffer] == ["cancelled"]
+
+@pytest.mark.asyncio
+async def test_completed_task_is_charged(billing, monkeypatch):
+    """测试正常完成时确认扣费并登记用量"""
+    usage = {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120, "model": "m"}
+    monkeypatch.setattr(vlm_task_module, "vlm_events", upstream(("message", "answer"), ("usage", usage), ("done", None)))
+
+    await execute_task("t2", make_task(), IMAGE)
+
+    billing.pre_charge.assert_called_once_with(user_id=1, amount=SERVICE_FEE, task_id="t2")
+    assert billing.update.call_args.kwargs["amount"] == -SERVICE_FEE
+    billing.refund.assert_not_called()
+    assert recorded(billing) == [("completed", SERVICE_FEE)]
+    assert billing.metering._buffer[0]["prompt_tokens"] == 100
+
+@pytest.mark.asyncio
+async def test_failed_task_is_refunded(billing, monkeypatch):
+    """测试上游出错时退还预扣费用，登记金额为0的失败记录"""
+    async def broken(*args, **kwargs):
+        yield "message", "partial"
+        raise RuntimeError("upstream error")
+
+    monkeypatch.setattr(vlm_task_module, "vlm_events", broken)
+
+    await execute_task("t3", make_task(), IMAGE)
+
+    billing.refund.assert_called_once_with(user_id=1, amount=SERVICE_FEE, task_id="t3")
+    billing.update.assert_not_called()
+    assert recorded(billing) == [("failed", 0.0)]
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("reason", [REASON_USER, REASON_DISCONNECT, None])
+async def test_cancelled_task_billing(billing, monkeypatch, reason):
+    """测试取消时的结算：用户取消或客户端断开时由任务自己退款；没有原因（例如进程退出）时不退款，均登记金额为0的取消记录"""
+    monkeypatch.setattr(vlm_task_module, "vlm_events", upstream(("message", "partial"), hang=True))
+    published = asyncio.Event()
+    publish = vlm_task_module.task_stream.publish
+
+    async def notify_publish(task_id, event, data=None):
+        await publish(task_id, event, data)
+        published.set()
+
+    monkeypatch.setattr(vlm_task_module.task_stream, "publish", notify_publish)
+    background = start_task_in_background("t4", make_task(), IMAGE)
+    await asyncio.wait_for(published.wait(), timeout=2)
+
+    if reason is None:
+        background.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await background
+        billing.refund.assert_not_called()
+    else:
+        task_cancellation._cancel_local("t4", reason)
+        await background
+        billing.refund.assert_called_once_with(user_id=1, amount=SERVICE_FEE, task_id="t4")
+    billing.update.assert_not_called()
+    assert recorded(billing) == [("cancelled", 0.0)]
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class ByteLRUCache:
+    """按字节数计算容量的 LRU 缓存
+
+    总大小超过 max_bytes 时淘汰最久未使用的条目；单个条目超过 max_item_bytes 时不缓存，
+    避免一张大图挤掉大量小图。只在事件循环线程中使用，不需要加锁。
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes if max_item_bytes is not None else max_bytes
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self._items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes) -> bool:
+        """放入缓存，返回是否缓存成功"""
+        if len(value) > self.max_item_bytes or len(value) > self.max_bytes:
+            return False
+        self.pop(key)
+        self._items[key] = value
+        self._size += len(value)
+        while self._size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+        return True
+
+    def pop(self, key: str) -> None:
+        value = self._items.pop(key, None)
+        if value is not None:
+            self._size -= len(value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._items
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._items),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,106 @@
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# 在缩略图上分析，最长边像素数
+CROP_THUMBNAIL_EDGE = 256
+# 相邻像素灰度差超过该值视为文字笔画边缘
+EDGE_THRESHOLD = 32
+# 行/列中边缘像素占比达到该值视为有内容
+MIN_DENSITY = 0.02
+# 内容之间允许的空白间隔，占缩略图边长的比例（段落间距、行间距）
+MAX_GAP_RATIO = 0.06
+# 内容量达到最大区间该比例的区间都保留，左右分栏的题目描述和代码编辑器不会只剩一栏
+MIN_SPAN_SHARE = 0.2
+# 边缘像素占比超过该值的行/列视为工具栏、分隔线等界面结构，不参与另一方向的投影
+LINE_DENSITY = 0.6
+# 裁剪框四周保留的边距，占边长的比例
+MARGIN_RATIO = 0.02
+# 裁剪后面积占比不低于该值时不裁剪，收益太小
+MAX_KEEP_RATIO = 0.9
+# 裁剪框宽高占比低于该值时认为检测失败，回退到整图
+MIN_SIDE_RATIO = 0.2
+
+
+def _dense_span(profile: np.ndarray, max_gap: int) -> Optional[Tuple[int, int]]:
+    """在投影曲线上找出内容区间 [start, end)
+
+    间隔不超过 max_gap 的区间先合并，再取内容量不低于最大区间 MIN_SPAN_SHARE 的所有区间的并集，
+    只去掉内容很少的侧边栏、图标等。
+    """
+    active = np.concatenate(([False], profile >= MIN_DENSITY, [False]))
+    changes = np.flatnonzero(np.diff(active.astype(np.int8)))
+    if changes.size == 0:
+        return None
+    starts, ends = changes[0::2], changes[1::2]
+
+    # 合并间隔较小的相邻区间
+    keep = starts[1:] - ends[:-1] > max_gap
+    starts = starts[np.concatenate(([True], keep))]
+    ends = ends[np.concatenate((keep, [True]))]
+
+    # 保留边缘像素总量接近最大区间的所有区间
+    cumulative = np.concatenate(([0.0], np.cumsum(profile)))
+    mass = cumulative[ends] - cumulative[starts]
+    kept = np.flatnonzero(mass >= mass.max() * MIN_SPAN_SHARE)
+    return int(starts[kept[0]]), int(ends[kept[-1]])
+
+
+def find_content_box(img: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+    """用行/列投影找出截图中文字密集的区域
+
+    先把缩略图按灰度梯度二值化（同时适用于浅色和深色主题），
+    再在列投影上找出内容区间以去掉侧边栏，然后在该区间内用行投影去掉浏览器工具栏等。
+    返回原图坐标的裁剪框 (left, top, right, bottom)，不需要裁剪或检测不可靠时返回 None。
+    """
+    width, height = img.size
+    thumb = img.convert("L")
+    thumb.thumbnail((CROP_THUMBNAIL_EDGE, CROP_THUMBNAIL_EDGE))
+    gray = np.asarray(thumb, dtype=np.int16)
+    if gray.shape[0] < 8 or gray.shape[1] < 8:
+        return None
+    thumb_h, thumb_w = gray.shape
+
+    # 二值化：水平或垂直方向的灰度突变即为笔画边缘
+    edges = np.zeros(gray.shape, dtype=bool)
+    edges[:, 1:] |= np.abs(np.diff(gray, axis=1)) > EDGE_THRESHOLD
+    edges[1:, :] |= np.abs(np.diff(gray, axis=0)) > EDGE_THRESHOLD
+
+    # 贯穿整行的水平线（工具栏边界、分隔线）会让所有列都显得有内容，投影前去掉
+    text_rows = edges.mean(axis=1) < LINE_DENSITY
+    if not text_rows.any():
+        return None
+    columns = _dense_span(edges[text_rows].mean(axis=0), max(1, int(thumb_w * MAX_GAP_RATIO)))
+    if columns is None:
+        return None
+    left, right = columns
+    region = edges[:, left:right]
+    text_columns = region.mean(axis=0) < LINE_DENSITY
+    if not text_columns.any():
+        return None
+    # 同样去掉贯穿整行的水平线本身
+    row_profile = np.where(text_rows, region[:, text_columns].mean(axis=1), 0.0)
+    rows = _dense_span(row_profile, max(1, int(thumb_h * MAX_GAP_RATIO)))
+    if rows is None:
+        return None
+    top, bottom = rows
+
+    # 加上边距，避免切掉文字边缘
+    margin_x = int(thumb_w * MARGIN_RATIO) + 1
+    margin_y = int(thumb_h * MARGIN_RATIO) + 1
+    left, right = max(0, left - margin_x), min(thumb_w, right + margin_x)
+    top, bottom = max(0, top - margin_y), min(thumb_h, bottom + margin_y)
+
+    box_w, box_h = (right - left) / thumb_w, (bottom - top) / thumb_h
+    if box_w < MIN_SIDE_RATIO or box_h < MIN_SIDE_RATIO or box_w * box_h >= MAX_KEEP_RATIO:
+        return None
+
+    # 换算回原图坐标
+    scale_x, scale_y = width / thumb_w, height / thumb_h
+    return (
+        int(left * scale_x),
+        int(top * scale_y),
+        min(width, int(np.ceil(right * scale_x))),
+        min(height, int(np.ceil(bottom * scale_y))),
+    )
@@ -0,0 +1,44 @@
+import io
+from typing import Optional, Union
+
+from PIL import Image
+
+# 图片来源：内存中的字节或磁盘文件路径
+ImageSource = Union[bytes, str]
+
+# 识别图片类型只需要文件头的前16个字节
+SNIFF_BYTES = 16
+
+SUPPORTED_FORMATS_MESSAGE = (
+    "Unsupported image format. Supported formats: BMP, DIB, ICNS, ICO, JPEG, JPEG2000, PNG, SGI, TIFF, WEBP"
+)
+
+
+def sniff_image_mime(header: bytes) -> Optional[str]:
+    """根据文件头的魔数识别图片 MIME 类型，不支持的格式返回 None"""
+    if header.startswith(b'\xff\xd8'):
+        return "image/jpeg"
+    if header.startswith(b'\x89PNG'):
+        return "image/png"
+    if header.startswith(b'BM'):
+        return "image/bmp"
+    if header.startswith(b'II') or header.startswith(b'MM'):
+        return "image/tiff"
+    if header.startswith(b'RIFF') and b'WEBP' in header[:12]:
+        return "image/webp"
+    if header.startswith(b'\x00\x00\x01\x00') or header.startswith(b'\x00\x00\x02\x00'):
+        return "image/x-icon"
+    if header.startswith(b'icns'):
+        return "image/x-icns"
+    if header.startswith(b'\x01\xda'):
+        return "image/x-sgi"
+    if header.startswith(b'\x00\x00\x00\x0c'):
+        return "image/jp2"
+    return None
+
+
+def open_image(source: ImageSource) -> Image.Image:
+    """打开图片，文件路径直接交给 Pillow 按需读取，不需要先把整个文件读入内存"""
+    if isinstance(source, bytes):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
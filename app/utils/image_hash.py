@@ -0,0 +1,133 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from utils.image_crop import find_content_box
+from utils.image_format import ImageSource, open_image
+
+# dHash 边长，生成 hash_size * hash_size 位的哈希
+HASH_SIZE = 16
+# 用于二次确认的整图灰度缩略图边长，以及比较时的分块边长
+THUMBNAIL_SIZE = 96
+THUMBNAIL_BLOCK = 8
+
+
+class ImageFingerprint(NamedTuple):
+    """截图的近似匹配指纹"""
+    phash: int  # 题目区域的 dHash，用于在索引中查找候选
+    thumbnail: bytes  # 整图的 THUMBNAIL_SIZE x THUMBNAIL_SIZE 灰度像素，用于确认候选
+
+
+def _dhash_pixels(gray: Image.Image, hash_size: int) -> int:
+    pixels = np.asarray(gray.resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    diff = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(diff.flatten()).tobytes(), "big")
+
+
+def dhash(source: ImageSource, hash_size: int = HASH_SIZE) -> int:
+    """计算整张图片的差值哈希（dHash）
+
+    将图片缩放为 (hash_size + 1) x hash_size 的灰度图，比较每行相邻像素的明暗，
+    得到 hash_size * hash_size 位的整数。对重新拍照、轻微裁剪、压缩等变化不敏感。
+    CPU 密集，调用方应放在线程池中执行。
+    """
+    with open_image(source) as img:
+        # JPEG 解码时直接按缩小的尺寸解码，大图可以省去大部分解码开销
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        return _dhash_pixels(img.convert("L"), hash_size)
+
+
+def image_fingerprint(source: ImageSource, hash_size: int = HASH_SIZE) -> ImageFingerprint:
+    """计算截图的近似匹配指纹
+
+    同一网站或 IDE 的截图整体布局几乎相同，整图哈希区分不了不同的题目，
+    因此哈希只针对裁剪出的文字区域；裁剪可能落在各题相同的代码模板上，
+    所以候选还要用整图缩略图逐块确认（见 thumbnail_distance）。
+    CPU 密集，调用方应放在线程池中执行。
+    """
+    with open_image(source) as img:
+        img.draft("L", (THUMBNAIL_SIZE * 8, THUMBNAIL_SIZE * 8))
+        gray = img.convert("L")
+    thumbnail = gray.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR).tobytes()
+    box = find_content_box(gray)
+    region = gray.crop(box) if box is not None else gray
+    return ImageFingerprint(_dhash_pixels(region, hash_size), thumbnail)
+
+
+def thumbnail_distance(a: bytes, b: bytes) -> float:
+    """两个缩略图差异最大的分块的平均灰度差
+
+    不同题目的文字差异集中在局部，取最大分块而不是整图均值，避免被大片相同的背景稀释；
+    尺寸不同时视为完全不同。
+    """
+    if len(a) != len(b) or len(a) != THUMBNAIL_SIZE * THUMBNAIL_SIZE:
+        return float("inf")
+    diff = np.abs(
+        np.frombuffer(a, dtype=np.uint8).astype(np.int16) - np.frombuffer(b, dtype=np.uint8)
+    ).reshape(THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+    blocks = THUMBNAIL_SIZE // THUMBNAIL_BLOCK
+    return float(diff.reshape(blocks, THUMBNAIL_BLOCK, blocks, THUMBNAIL_BLOCK).mean(axis=(1, 3)).max())
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """两个哈希之间的汉明距离"""
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """按汉明距离组织的 BK 树，用于在大量哈希中查找近似重复
+
+    每个节点的子节点按与该节点的距离分桶，查询时利用三角不等式剪枝，
+    阈值较小时只需访问很少的节点。
+    """
+
+    def __init__(self, items: Optional[Iterable[int]] = None):
+        # 节点结构：(哈希值, {距离: 子节点})
+        self._root: Optional[Tuple[int, Dict[int, tuple]]] = None
+        self._size = 0
+        for item in items or ():
+            self.add(item)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, item: int) -> bool:
+        """插入哈希，已存在时返回 False"""
+        if self._root is None:
+            self._root = (item, {})
+            self._size = 1
+            return True
+
+        node = self._root
+        while True:
+            value, children = node
+            distance = hamming_distance(item, value)
+            if distance == 0:
+                return False
+            child = children.get(distance)
+            if child is None:
+                children[distance] = (item, {})
+                self._size += 1
+                return True
+            node = child
+
+    def search(self, item: int, max_distance: int) -> List[Tuple[int, int]]:
+        """查找距离不超过 max_distance 的所有哈希，按距离升序返回 (距离, 哈希)"""
+        if self._root is None:
+            return []
+
+        results = []
+        stack = [self._root]
+        while stack:
+            value, children = stack.pop()
+            distance = hamming_distance(item, value)
+            if distance <= max_distance:
+                results.append((distance, value))
+            low, high = distance - max_distance, distance + max_distance
+            for child_distance, child in children.items():
+                if low <= child_distance <= high:
+                    stack.append(child)
+
+        results.sort()
+        return results
@@ -0,0 +1,74 @@
+import io
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from utils.image_crop import find_content_box
+from utils.image_format import ImageSource, open_image
+
+# 输出格式对应的 MIME 类型和扩展名
+OUTPUT_FORMATS = {
+    "JPEG": ("image/jpeg", ".jpg"),
+    "WEBP": ("image/webp", ".webp"),
+}
+
+
+def preprocess_image(
+    source: ImageSource,
+    max_edge: int = 1600,
+    grayscale: bool = True,
+    output_format: str = "JPEG",
+    quality: int = 80,
+    crop: bool = True
+) -> Tuple[Optional[bytes], Dict[str, Any]]:
+    """把上传的原图处理成发送给上游模型的衍生图
+
+    1. 按 EXIF 方向信息旋转，去掉方向标记
+    2. 可选裁剪到文字密集区域，去掉浏览器工具栏、侧边栏等无关区域
+    3. 最长边缩小到 max_edge（不放大）
+    4. 可选转为灰度（题目截图和照片基本不依赖颜色）
+    5. 以指定质量重新编码为 JPEG 或 WebP
+
+    在进程池中执行，只使用可序列化的参数和返回值；传入文件路径时由子进程自己读取文件。
+    返回 (衍生图字节, 信息)；衍生图不比原图小时返回 None，继续使用原图。
+    """
+    output_format = output_format.upper()
+    mime_type, extension = OUTPUT_FORMATS[output_format]
+    original_bytes = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+    info: Dict[str, Any] = {"original_bytes": original_bytes}
+
+    with open_image(source) as img:
+        info["original_size"] = img.size
+        # JPEG 按接近目标尺寸的比例解码，大幅减少解码开销
+        img.draft("L" if grayscale else "RGB", (max_edge, max_edge))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert("L" if grayscale else "RGB")
+        if crop:
+            box = None
+            try:
+                box = find_content_box(img)
+            except Exception:
+                # 检测失败时保留整图
+                pass
+            if box is not None:
+                img = img.crop(box)
+            info["crop_box"] = box
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        info["output_size"] = img.size
+
+        buffer = io.BytesIO()
+        save_options = {"quality": quality}
+        if output_format == "JPEG":
+            save_options.update(optimize=True, progressive=False)
+        else:
+            save_options.update(method=4)
+        img.save(buffer, format=output_format, **save_options)
+
+    output = buffer.getvalue()
+    info["output_bytes"] = len(output)
+    info["mime_type"] = mime_type
+    info["extension"] = extension
+    if len(output) >= original_bytes:
+        return None, info
+    return output, info
@@ -0,0 +1,67 @@
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from utils.image_format import ImageSource, open_image
+
+# 在缩小后的灰度图上计算指标，最长边像素数
+QUALITY_THUMBNAIL_EDGE = 512
+
+
+def measure_image_quality(source: ImageSource) -> Dict[str, Any]:
+    """计算图片质量指标
+
+    - width/height：原图分辨率（只读取文件头）
+    - brightness：平均亮度（0-255）
+    - contrast：亮度第99与第1百分位之差，深色主题截图平均亮度很低，但文字与背景的反差很大
+    - sharpness：拉普拉斯算子响应的方差，越小越模糊
+    """
+    with open_image(source) as img:
+        width, height = img.size
+        # JPEG 直接按 1/2~1/8 比例解码，避免解码整张大图；
+        # 目标取一半边长，让解码器尽量多缩小，剩下的由 thumbnail 完成
+        img.draft("L", (QUALITY_THUMBNAIL_EDGE // 2, QUALITY_THUMBNAIL_EDGE // 2))
+        gray = img.convert("L")
+        gray.thumbnail((QUALITY_THUMBNAIL_EDGE, QUALITY_THUMBNAIL_EDGE))
+        pixels = np.asarray(gray, dtype=np.float32)
+
+    # 4 邻域拉普拉斯算子
+    laplacian = (
+        pixels[:-2, 1:-1] + pixels[2:, 1:-1] + pixels[1:-1, :-2] + pixels[1:-1, 2:]
+        - 4 * pixels[1:-1, 1:-1]
+    )
+    low, high = np.percentile(pixels, (1, 99))
+    return {
+        "width": width,
+        "height": height,
+        "brightness": round(float(pixels.mean()), 2),
+        "contrast": round(float(high - low), 2),
+        "sharpness": round(float(laplacian.var()) if laplacian.size else 0.0, 2),
+    }
+
+
+def check_image_quality(
+    source: ImageSource,
+    min_edge: int = 240,
+    min_brightness: float = 25.0,
+    min_sharpness: float = 30.0,
+    min_contrast: float = 40.0
+) -> Optional[Dict[str, Any]]:
+    """检查图片是否可用于解题，可用时返回 None，否则返回原因、提示和指标
+
+    平均亮度低且反差也低才判定为过暗，深色背景的 IDE、终端截图不受影响。
+    """
+    try:
+        metrics = measure_image_quality(source)
+    except Exception:
+        return {"reason": "unreadable", "message": "图片无法解析，请重新拍摄或截图", "metrics": {}}
+
+    if min(metrics["width"], metrics["height"]) < min_edge:
+        reason, message = "low_resolution", f"图片分辨率过低，短边至少需要 {min_edge} 像素"
+    elif metrics["brightness"] < min_brightness and metrics["contrast"] < min_contrast:
+        reason, message = "too_dark", "图片过暗，请在光线充足处重新拍摄"
+    elif metrics["sharpness"] < min_sharpness:
+        reason, message = "blurry", "图片模糊，请对焦后重新拍摄"
+    else:
+        return None
+    return {"reason": reason, "message": message, "metrics": metrics}
@@ -0,0 +1,50 @@
+import json
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时回退到标准库
+    orjson = None
+
+
+def dumps(data: Any) -> bytes:
+    """序列化为 UTF-8 JSON 字节，中文等非 ASCII 字符不做 \\uXXXX 转义"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_event(
+    event: str,
+    data: Any = None,
+    event_id: Optional[str] = None,
+    compact: bool = False
+) -> bytes:
+    """把事件编码为 SSE 帧字节
+
+    - message 事件默认保持原有格式 ``{"role": "assistant", "content": ...}``；
+      compact 模式下省略 ``event:`` 行（SSE 默认事件类型即为 message）和 role 字段，
+      数据为 ``{"c": ...}``
+    - 字符串数据视为已经序列化好的内容原样输出，dict 数据序列化为 JSON
+    - 提供 event_id 时输出 ``id:`` 字段用于断线续传
+    """
+    parts = []
+    if event_id:
+        parts.append(b"id: " + event_id.encode("ascii") + b"\n")
+
+    if event == "message":
+        if compact:
+            parts.append(b"data: " + dumps({"c": data}) + b"\n\n")
+        else:
+            parts.append(b"event: message\ndata: " + dumps({"role": "assistant", "content": data}) + b"\n\n")
+        return b"".join(parts)
+
+    parts.append(b"event: " + event.encode("utf-8") + b"\n")
+    if data is None:
+        payload = b""
+    elif isinstance(data, (dict, list)):
+        payload = dumps(data)
+    else:
+        payload = str(data).encode("utf-8")
+    parts.append(b"data: " + payload + b"\n\n")
+    return b"".join(parts)
@@ -0,0 +1,90 @@
+import asyncio
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, List, Tuple
+
+# 源事件流结束标记
+_END = object()
+
+
+async def _pump(source: AsyncIterator[Tuple[str, Any]], queue: asyncio.Queue) -> None:
+    """把源事件流搬运到队列中，异常也放入队列由消费方抛出"""
+    try:
+        async for item in source:
+            await queue.put(item)
+        await queue.put(_END)
+    except Exception as e:
+        await queue.put(e)
+
+
+async def coalesce_events(
+    source: AsyncIterator[Tuple[str, Any]],
+    flush_interval: float,
+    flush_bytes: int
+) -> AsyncGenerator[Tuple[str, Any], None]:
+    """把连续的 message 文本增量合并成更大的帧
+
+    - 第一个 message 立即输出，不增加首字延迟
+    - 之后的增量累积到 flush_bytes 字节，或距离第一个未输出增量超过 flush_interval 秒时输出
+    - 其他事件（queue、usage、done、error 等）先输出已累积的文本，再原样输出
+    - flush_interval 或 flush_bytes 不大于 0 时不合并
+    """
+    if flush_interval <= 0 or flush_bytes <= 0:
+        async for item in source:
+            yield item
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+    pump = asyncio.create_task(_pump(source, queue))
+    buffer: List[str] = []
+    buffered_bytes = 0
+    deadline = 0.0
+    first_message = True
+
+    try:
+        while True:
+            if buffer:
+                timeout = max(0.0, deadline - time.monotonic())
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    yield "message", "".join(buffer)
+                    buffer, buffered_bytes = [], 0
+                    continue
+            else:
+                item = await queue.get()
+
+            if item is _END or isinstance(item, Exception):
+                if buffer:
+                    yield "message", "".join(buffer)
+                    buffer, buffered_bytes = [], 0
+                if item is _END:
+                    return
+                raise item
+
+            event, data = item
+            if event != "message":
+                if buffer:
+                    yield "message", "".join(buffer)
+                    buffer, buffered_bytes = [], 0
+                yield event, data
+                continue
+
+            if first_message:
+                first_message = False
+                yield event, data
+                continue
+
+            if not buffer:
+                deadline = time.monotonic() + flush_interval
+            buffer.append(data)
+            buffered_bytes += len(data.encode("utf-8"))
+            if buffered_bytes >= flush_bytes:
+                yield "message", "".join(buffer)
+                buffer, buffered_bytes = [], 0
+    finally:
+        if not pump.done():
+            pump.cancel()
+            try:
+                await pump
+            except (asyncio.CancelledError, Exception):
+                pass
@@ -0,0 +1,156 @@
+"""VLM 任务 worker 入口
+
+在 VLM_EXECUTION_MODE=queue 时使用：API 节点只负责提交任务和转发结果，
+worker 进程从 Redis Streams 队列中消费任务、调用上游模型，并把事件写入任务事件流。
+
+启动方式：python worker.py
+"""
+import asyncio
+import logging
+import os
+import signal
+import socket
+from typing import Dict
+
+from dotenv import load_dotenv
+
+from services.redis_service import redis_service
+from services.vlm_client import vlm_client_manager
+from services.blob_storage import blob_storage
+from services.distributed_semaphore import vlm_semaphore
+from services.task_queue import task_queue
+from services.task_stream import task_stream
+from services.task_cancellation import task_cancellation
+from services.metering import metering
+from services.vlm_task import start_task_in_background, load_task_image, refund_task, SERVICE_FEE
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("vlm_worker")
+
+VLM_WORKER_CONCURRENCY = int(os.getenv("VLM_WORKER_CONCURRENCY", "4"))  # 单个 worker 进程同时执行的任务数
+VLM_QUEUE_MAX_DEFERRALS = int(os.getenv("VLM_QUEUE_MAX_DEFERRALS", "3"))  # 因单用户并发已满最多延后的次数
+VLM_QUEUE_CLAIM_INTERVAL = float(os.getenv("VLM_QUEUE_CLAIM_INTERVAL", "60"))  # 检查崩溃 worker 遗留消息的间隔（秒）
+
+# 已经结束的任务状态
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+
+async def fail_task(task_id: str, task: Dict, reason: str, refund: bool) -> None:
+    """标记任务失败并通知客户端"""
+    if refund:
+        refund_task(task["user_id"], task_id, SERVICE_FEE)
+    await task_stream.publish(task_id, "error", {"error": reason})
+    await redis_service.update_task_status(task_id, "failed", reason)
+
+
+async def handle_message(consumer: str, lane: str, message_id: str, fields: Dict[str, str]) -> None:
+    """执行一条队列消息对应的任务"""
+    task_id, user_id = fields["task_id"], fields["user_id"]
+    task = await redis_service.get_task(task_id)
+    if not task or task["status"] in FINAL_STATUSES:
+        # 任务已过期、已取消或已完成
+        await task_queue.ack(lane, message_id, user_id)
+        return
+
+    if task["status"] == "processing":
+        if await task_queue.is_running(task_id):
+            # 执行者仍然存活（例如续期前被认领），由它确认原消息，这里只删除重复的消息
+            logger.info(f"任务仍在执行，忽略重复消息 | 任务：{task_id}")
+            await task_queue.discard(lane, message_id)
+            return
+        # 之前的 worker 在生成过程中崩溃（租约已过期），无法确定已输出的内容，按失败处理并退款
+        logger.warning(f"任务在执行中断后被认领，按失败处理 | 任务：{task_id}")
+        await fail_task(task_id, task, "任务执行中断，请重新提交", refund=True)
+        await task_queue.ack(lane, message_id, user_id)
+        return
+
+    # 单用户公平性：该用户的上游并发已满时延后执行，把 worker 让给其他用户
+    deferrals = int(fields.get("deferrals", "0"))
+    if deferrals < VLM_QUEUE_MAX_DEFERRALS and \
+            await vlm_semaphore.get_user_usage(user_id) >= vlm_semaphore.per_user_limit:
+        await task_queue.requeue(lane, message_id, fields, "low")
+        return
+
+    try:
+        # 先取得执行租约再标记为执行中，其他 worker 认领到该消息时据此判断执行者是否存活
+        async with task_queue.lease(lane, message_id, task_id, consumer):
+            await redis_service.update_task_status(task_id, "processing")
+            try:
+                image = await load_task_image(task)
+            except FileNotFoundError as e:
+                await fail_task(task_id, task, str(e), refund=False)
+                return
+
+            # 在单独的 asyncio 任务中执行，客户端断开时只取消该任务，不影响消费协程
+            await start_task_in_background(task_id, task, image)
+    finally:
+        await task_queue.ack(lane, message_id, user_id)
+
+
+async def consume_loop(consumer: str, stop_event: asyncio.Event) -> None:
+    """单个消费协程，循环读取并执行任务"""
+    while not stop_event.is_set():
+        try:
+            item = await task_queue.read(consumer)
+            if item:
+                await handle_message(consumer, *item)
+        except Exception as e:
+            logger.error(f"消费任务出错 | 消费者：{consumer} | 原因：{str(e)}", exc_info=True)
+            await asyncio.sleep(1)
+
+
+async def reclaim_loop(consumer: str, stop_event: asyncio.Event) -> None:
+    """定期认领崩溃 worker 遗留的消息，放入高优先级队列"""
+    while not stop_event.is_set():
+        try:
+            for lane, message_id, fields in await task_queue.claim_stale(consumer):
+                logger.info(f"认领遗留任务 | 任务：{fields.get('task_id')} | 原队列：{lane}")
+                await task_queue.requeue(lane, message_id, fields, "high")
+        except Exception as e:
+            logger.error(f"认领遗留任务出错：{str(e)}", exc_info=True)
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=VLM_QUEUE_CLAIM_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main() -> None:
+    await redis_service.connect()
+    await vlm_client_manager.start()
+    await blob_storage.start()
+    await task_queue.ensure_groups()
+    task_cancellation.start()
+    metering.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"VLM worker 启动 | 消费者：{consumer} | 并发：{VLM_WORKER_CONCURRENCY}")
+    workers = [
+        asyncio.create_task(consume_loop(f"{consumer}-{i}", stop_event))
+        for i in range(VLM_WORKER_CONCURRENCY)
+    ]
+    workers.append(asyncio.create_task(reclaim_loop(consumer, stop_event)))
+
+    try:
+        # 收到退出信号后等待正在执行的任务完成
+        await asyncio.gather(*workers)
+    finally:
+        await task_cancellation.close()
+        await metering.close()
+        await vlm_client_manager.close()
+        await blob_storage.close()
+        await redis_service.disconnect()
+        logger.info("VLM worker 已退出")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+"""题目区域自动裁剪基准
+
+统计 utils/image_crop.py 中投影裁剪在样例截图上的单张耗时和像素数减少比例。
+不指定目录时生成一组模拟的刷题网站截图（浏览器工具栏 + 侧边栏 + 题目正文，
+包含浅色和深色主题）。
+
+运行方式：
+    python tests/bench_image_crop.py                  # 使用生成的模拟截图
+    python tests/bench_image_crop.py path/to/samples  # 使用目录中的真实截图
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from utils.image_crop import find_content_box  # noqa: E402
+
+REPEAT = 20  # 每张图片重复次数，取平均耗时
+
+
+def draw_text_lines(draw: ImageDraw.ImageDraw, box, color, rng, line_height=22):
+    """用随机长度的短横条模拟文字行"""
+    left, top, right, bottom = box
+    y = top
+    while y + line_height <= bottom:
+        if rng.random() > 0.15:  # 偶尔空一行作为段落间距
+            x = left
+            line_end = left + int((right - left) * rng.uniform(0.4, 1.0))
+            while x < line_end:
+                word = int(rng.integers(20, 70))
+                draw.rectangle((x, y + 4, min(x + word, line_end), y + line_height - 6), fill=color)
+                x += word + 8
+        y += line_height
+
+
+def make_screenshot(seed: int, size=(1920, 1080), dark=False) -> Image.Image:
+    """生成一张模拟的刷题网站截图"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    background, foreground = ((30, 30, 30), (220, 220, 220)) if dark else ((255, 255, 255), (40, 40, 40))
+    img = Image.new("RGB", size, background)
+    draw = ImageDraw.Draw(img)
+
+    # 浏览器标签栏和地址栏
+    draw.rectangle((0, 0, width, 80), fill=(222, 225, 230))
+    draw.rectangle((120, 45, width - 200, 70), fill=(255, 255, 255))
+    # 左侧导航栏
+    sidebar = int(width * rng.uniform(0.1, 0.18))
+    draw.rectangle((0, 80, sidebar, height), fill=(245, 246, 248) if not dark else (45, 45, 48))
+    for y in range(110, height - 40, 48):
+        draw.rectangle((20, y, sidebar - 30, y + 14), fill=(160, 160, 160))
+    # 题目正文
+    split = int(width * rng.uniform(0.5, 0.6))
+    draw_text_lines(draw, (sidebar + 40, 120, split - 40, height - 60), foreground, rng)
+    return img
+
+
+def load_samples(directory: str):
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        try:
+            with Image.open(path) as img:
+                yield name, img.convert("L")
+        except OSError:
+            continue
+
+
+def synthetic_samples():
+    for seed in range(12):
+        size = (1920, 1080) if seed % 3 else (2560, 1440)
+        yield f"synthetic-{seed}{'-dark' if seed % 2 else ''}", make_screenshot(seed, size, dark=bool(seed % 2)).convert("L")
+
+
+def main():
+    samples = load_samples(sys.argv[1]) if len(sys.argv) > 1 else synthetic_samples()
+
+    print(f"{'图片':<24}{'原始尺寸':>14}{'裁剪后':>14}{'像素占比':>10}{'耗时(ms)':>10}")
+    total_pixels = kept_pixels = 0
+    timings = []
+    for name, img in samples:
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            box = find_content_box(img)
+        elapsed_ms = (time.perf_counter() - start) / REPEAT * 1000
+        timings.append(elapsed_ms)
+
+        width, height = img.size
+        if box is None:
+            cropped = (width, height)
+        else:
+            cropped = (box[2] - box[0], box[3] - box[1])
+        total_pixels += width * height
+        kept_pixels += cropped[0] * cropped[1]
+        ratio = cropped[0] * cropped[1] / (width * height)
+        print(f"{name:<26}{f'{width}x{height}':>14}{f'{cropped[0]}x{cropped[1]}':>14}{ratio:>10.1%}{elapsed_ms:>10.2f}")
+
+    if not timings:
+        print("没有可用的样例图片")
+        return
+    print()
+    print(f"样例数：{len(timings)}")
+    print(f"单张耗时：平均 {np.mean(timings):.2f} ms，P95 {np.percentile(timings, 95):.2f} ms")
+    print(f"像素数减少：{1 - kept_pixels / total_pixels:.1%}")
+
+
+if __name__ == "__main__":
+    main()
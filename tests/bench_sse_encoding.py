@@ -0,0 +1,78 @@
+"""SSE 编码微基准
+
+对比原有的 message 帧格式（json.dumps 默认 ensure_ascii=True，每帧重复 role 字段）
+与 utils/sse.py 中的 UTF-8 编码、精简格式在传输字节数和编码耗时上的差异。
+
+运行方式：python tests/bench_sse_encoding.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from utils.sse import encode_event, orjson  # noqa: E402
+
+# 模拟一次典型的中文解题回答
+SAMPLE_ANSWER = """### 解题思路
+- 使用哈希表记录每个数字出现的位置，遍历数组时查找 target - nums[i] 是否已经出现过
+- 只需要遍历一次数组，找到即返回两个下标
+- 时间复杂度 O(n)，空间复杂度 O(n)
+
+### 代码实现
+```python
+def two_sum(nums, target):
+    # 记录数字到下标的映射
+    seen = {}
+    for i, num in enumerate(nums):
+        # 查找配对的数字是否出现过
+        if target - num in seen:
+            return [seen[target - num], i]
+        seen[num] = i
+    return []
+```
+""" * 4
+
+TOKEN_SIZE = 3  # 上游每个增量的平均字符数
+COALESCED_SIZE = 120  # 合并后每帧的平均字符数
+
+
+def split(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def legacy_encode(content: str) -> bytes:
+    """原有格式"""
+    message = {"role": "assistant", "content": content}
+    return f"event: message\ndata: {json.dumps(message)}\n\n".encode("utf-8")
+
+
+def measure(name: str, chunks, encoder, number: int = 200):
+    total_bytes = sum(len(encoder(chunk)) for chunk in chunks)
+    seconds = timeit.timeit(lambda: [encoder(chunk) for chunk in chunks], number=number)
+    per_frame_us = seconds / number / len(chunks) * 1e6
+    print(f"{name:<28}{len(chunks):>8}{total_bytes:>12}{per_frame_us:>14.3f}")
+    return total_bytes
+
+
+def main():
+    print(f"JSON 后端：{'orjson' if orjson is not None else 'json（标准库）'}")
+    print(f"回答长度：{len(SAMPLE_ANSWER)} 字符，UTF-8 {len(SAMPLE_ANSWER.encode('utf-8'))} 字节\n")
+    print(f"{'格式':<24}{'帧数':>8}{'传输字节':>10}{'每帧耗时(us)':>12}")
+
+    tokens = split(SAMPLE_ANSWER, TOKEN_SIZE)
+    coalesced = split(SAMPLE_ANSWER, COALESCED_SIZE)
+
+    baseline = measure("legacy (ascii, role)", tokens, legacy_encode)
+    utf8 = measure("utf-8", tokens, lambda c: encode_event("message", c))
+    compact = measure("utf-8 compact", tokens, lambda c: encode_event("message", c, compact=True))
+    merged = measure("utf-8 compact + coalesced", coalesced, lambda c: encode_event("message", c, compact=True))
+
+    print()
+    for name, size in (("utf-8", utf8), ("utf-8 compact", compact), ("utf-8 compact + coalesced", merged)):
+        print(f"{name:<28}相对原格式字节数 {size / baseline:.1%}")
+
+
+if __name__ == "__main__":
+    main()